@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from ollama import AsyncClient
+
+from integration_test_code.agent_api_generate import APIGenerator
+from integration_test_code.analyze_api import AnalyzeAPI
+from llm_cache import default_cache
+from tracing import enable_tracing, export_trace
+
+__doc__ = """
+resumable batch generation driven by a JSONL file of generation requests
+
+one request per line:
+{"request_id": "r-1", "controller": "path/to/UserController.java", "endpoint": "GET /api/users/{userId}",
+ "requirements": "...", "template": "..."}
+
+"endpoint" may be a method name or "<HTTP method> <api path>", without it every endpoint of the controller is
+generated. without "controller" the endpoint is looked up in every controller of the project, scanned once per
+run through the endpoint cache. a line needs at least one of the two. "template" replaces the example test. the input is read line by line with at most
+`parallelism` requests in flight, each result is appended to the output JSONL as soon as it finishes, and the
+ids of completed requests are checkpointed so an interrupted run resumes where it stopped,
+failed requests are tried again on the next run.
+"""
+
+
+def read_completed(checkpoint_path, output_path):
+    """
+    ids of requests that already succeeded, from the checkpoint and the output written before a crash
+    """
+    completed = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            completed.update(line.strip() for line in f if line.strip())
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record['ok']:
+                        completed.add(record['request_id'])
+                except (ValueError, KeyError):
+                    # a line cut off by a crash is generated again
+                    continue
+    return completed
+
+
+def iter_requests(requests_path):
+    """
+    requests of the JSONL file, a line that is no JSON object yields {"request_id": "line-<n>", "invalid": reason}
+    """
+    with open(requests_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {'request_id': f"line-{line_number}", 'invalid': f"line {line_number} is not valid JSON: {e}"}
+                continue
+            if not isinstance(request, dict):
+                yield {'request_id': f"line-{line_number}", 'invalid': f"line {line_number} is not a JSON object"}
+                continue
+            request.setdefault('request_id', f"line-{line_number}")
+            if not request.get('controller') and not request.get('endpoint'):
+                request['invalid'] = f"line {line_number} names neither a controller nor an endpoint"
+            yield request
+
+
+def select_endpoints(endpoints, selector):
+    if not selector:
+        return endpoints
+    if ' ' in selector:
+        http_method, api_path = selector.split(' ', 1)
+        return [endpoint for endpoint in endpoints
+                if endpoint.http_method == http_method.upper() and endpoint.api_path == api_path.strip()]
+    return [endpoint for endpoint in endpoints if endpoint.method == selector]
+
+
+class BatchRunner:
+    def __init__(self, generator, output_path, checkpoint_path, parallelism=4, timeout=600.0,
+                 endpoint_cache='.endpoint_cache.sqlite3'):
+        self.generator = generator
+        self.endpoint_cache = endpoint_cache
+        # scan of the whole project, started by the first request that names no controller
+        self.project_scan = None
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.client = AsyncClient()
+        self.example_code = generator.load_example_code()
+        self.processed = 0
+        self.failed = 0
+
+    async def run(self, requests_path):
+        completed = read_completed(self.checkpoint_path, self.output_path)
+        skipped = 0
+        slots = asyncio.Semaphore(self.parallelism)
+        tasks = set()
+        with open(self.output_path, 'a', encoding='utf-8') as output, \
+                open(self.checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+            try:
+                for request in iter_requests(requests_path):
+                    if request['request_id'] in completed:
+                        skipped += 1
+                        continue
+                    if 'invalid' in request:
+                        self.write(request, {'request_id': request['request_id'], 'ok': False,
+                                             'error': request['invalid'], 'results': [], 'seconds': 0.0},
+                                   output, checkpoint)
+                        continue
+                    # the next line is only read once a slot is free, so memory does not grow with the input
+                    await slots.acquire()
+                    task = asyncio.create_task(self.process(request, output, checkpoint, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                # requests in flight are finished and written even when reading the input fails
+                await asyncio.gather(*tasks)
+        print(f"processed {self.processed} requests, {self.failed} failed, {skipped} already done")
+
+    async def process(self, request, output, checkpoint, slots):
+        start = time.perf_counter()
+        try:
+            record = await self.generate(request)
+        except Exception as e:
+            record = {'request_id': request['request_id'], 'ok': False, 'error': repr(e), 'results': []}
+        finally:
+            slots.release()
+        record['seconds'] = time.perf_counter() - start
+        self.write(request, record, output, checkpoint)
+
+    def write(self, request, record, output, checkpoint):
+        self.processed += 1
+        self.failed += 0 if record['ok'] else 1
+
+        # result first, then checkpoint, both flushed to disk before the request counts as done.
+        # failed requests are not checkpointed, a resumed run tries them again and appends a newer record
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        output.flush()
+        os.fsync(output.fileno())
+        if record['ok']:
+            checkpoint.write(request['request_id'] + '\n')
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        print(f"{'ok    ' if record['ok'] else 'failed'} {record['seconds']:7.1f}s {request['request_id']}")
+
+    def scan_project(self):
+        # runs in a thread, so it gets its own analyzer, parser and SQLite connection
+        return AnalyzeAPI(self.generator.project_dir, self.endpoint_cache).analyze()
+
+    async def generate(self, request):
+        if request.get('controller'):
+            # parsing one controller takes milliseconds, and a tree-sitter parser must not be shared between threads
+            endpoints = self.generator.analyzer.scan_file(request['controller'])
+            where = request['controller']
+        else:
+            if self.project_scan is None:
+                self.project_scan = asyncio.ensure_future(asyncio.to_thread(self.scan_project))
+            endpoints = await self.project_scan
+            where = self.generator.project_dir
+        endpoints = select_endpoints(endpoints, request.get('endpoint'))
+        if not endpoints:
+            raise ValueError(f"no endpoint {request.get('endpoint')!r} in {where}")
+        example_code = request.get('template') or self.example_code
+        results = []
+        for endpoint in endpoints:
+            code = await asyncio.wait_for(
+                self.generator.agenerate(endpoint, example_code, request.get('requirements'), client=self.client),
+                self.timeout
+            )
+            results.append({'http_method': endpoint.http_method, 'api_path': endpoint.api_path, 'code': code})
+        return {'request_id': request['request_id'], 'ok': True, 'error': None, 'results': results}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="generate integration tests for a JSONL file of requests")
+    arg_parser.add_argument('requests', nargs='?', default='requests.jsonl')
+    arg_parser.add_argument('--output', default='results.jsonl')
+    arg_parser.add_argument('--checkpoint', help="completed request ids, <output>.done by default")
+    arg_parser.add_argument('--project-dir', default='spring-request')
+    arg_parser.add_argument('--parallelism', type=int, default=4)
+    arg_parser.add_argument('--timeout', type=float, default=600.0)
+    arg_parser.add_argument('--endpoint-cache', default='.endpoint_cache.sqlite3',
+                            help="endpoint cache of the project scan for requests without a controller")
+    arg_parser.add_argument('--trace', help="write a Chrome trace of the run to this JSON file")
+    args = arg_parser.parse_args()
+    if args.trace:
+        enable_tracing()
+
+    runner = BatchRunner(APIGenerator(project_dir=args.project_dir), args.output,
+                         args.checkpoint or args.output + '.done', args.parallelism, args.timeout,
+                         args.endpoint_cache)
+    asyncio.run(runner.run(args.requests))
+    print("llm cache = ", default_cache().stats())
+    if args.trace:
+        export_trace(args.trace)
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.stub_llm_server import start_stub_server
+from benchmarks.synthetic_repo import generate
+
+__doc__ = """
+offline benchmarks of the scan, context and generation pipeline
+
+every benchmark runs in its own subprocess against a synthetic Spring Boot project and a local stub of the
+ollama and OpenAI APIs, so numbers do not depend on a model, a GPU or the network, and peak RSS is the peak
+of that benchmark alone. results are printed as a table and can be saved as a baseline, later runs compared
+with --baseline fail when wall time or peak memory regress by more than --threshold.
+
+    python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json --threshold 0.2
+"""
+
+SIZES = {
+    'small': {'controllers': 5, 'endpoints': 4, 'dtos': 5},
+    'medium': {'controllers': 40, 'endpoints': 8, 'dtos': 30},
+    'large': {'controllers': 200, 'endpoints': 12, 'dtos': 120},
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def bench_scan_serial(project_dir, stub_url):
+    from integration_test_code.analyze_api import AnalyzeAPI
+    endpoints = AnalyzeAPI(project_dir).analyze()
+    return len(endpoints), 'endpoints'
+
+
+def bench_scan_parallel(project_dir, stub_url):
+    from integration_test_code.analyze_api import AnalyzeAPI
+    endpoints = AnalyzeAPI(project_dir).analyze(workers=os.cpu_count() or 1)
+    return len(endpoints), 'endpoints'
+
+
+def bench_scan_cached(project_dir, stub_url):
+    from integration_test_code.analyze_api import AnalyzeAPI
+    cache_path = os.path.join(project_dir, '.endpoint_cache.sqlite3')
+    AnalyzeAPI(project_dir, cache_path).analyze()
+    start = time.perf_counter()
+    endpoints = AnalyzeAPI(project_dir, cache_path).analyze()
+    # only the warm scan is measured
+    return len(endpoints), 'endpoints', time.perf_counter() - start
+
+
+def bench_symbol_index(project_dir, stub_url):
+    from integration_test_code.symbol_index import SymbolIndex
+    index = SymbolIndex(project_dir)
+    return len(index.by_qualified_name), 'classes'
+
+
+def bench_context_packing(project_dir, stub_url):
+    from integration_test_code.analyze_api import AnalyzeAPI
+    from integration_test_code.context_packer import ContextPacker
+    from integration_test_code.symbol_index import SymbolIndex
+    endpoints = AnalyzeAPI(project_dir).analyze()
+    index = SymbolIndex(project_dir)
+    packer = ContextPacker(index)
+    start = time.perf_counter()
+    for endpoint in endpoints:
+        packer.pack(endpoint)
+    return len(endpoints), 'endpoints', time.perf_counter() - start
+
+
+def bench_generate_all(project_dir, stub_url):
+    from integration_test_code.agent_api_generate import APIGenerator
+    generator = APIGenerator(project_dir)
+    endpoints = generator.analyzer.analyze()
+    results = asyncio.run(generator.generate_all(
+        endpoints, os.path.join(project_dir, 'generated_tests'), concurrency=8, timeout=60.0))
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"{len(failed)} generations failed: {failed[0].error}")
+    return len(results), 'endpoints'
+
+
+def bench_generate_grouped(project_dir, stub_url):
+    from integration_test_code.agent_api_generate import APIGenerator
+    generator = APIGenerator(project_dir)
+    endpoints = generator.analyzer.analyze()
+    results = asyncio.run(generator.generate_grouped(
+        endpoints, os.path.join(project_dir, 'generated_tests'), timeout=60.0))
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"{len(failed)} generations failed: {failed[0].error}")
+    stats = generator.prefix_stats
+    return len(results), 'endpoints', None, {'prefix_hit_rate': stats.hit_rate,
+                                             'prefill_saved_seconds': stats.saved_seconds}
+
+
+def bench_llama_index(project_dir, stub_url):
+    from llama.code_parser import CodeParser
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    embed_model = OpenAIEmbedding(api_base=stub_url + '/v1', api_key='stub', embed_batch_size=64)
+    parser = CodeParser(input_dir=project_dir, storage_path=os.path.join(project_dir, '.storage'),
+                        embed_model=embed_model)
+    retriever = parser.index.as_retriever(similarity_top_k=5)
+    queries = ['create user request validation', 'delete resource by id', 'find resource with query parameter']
+    for query in queries:
+        retriever.retrieve(query)
+    return len(parser.index.docstore.docs), 'nodes'
+
+
+def bench_langchain_index(project_dir, stub_url):
+    from langchain_openai import OpenAIEmbeddings
+    from lang_chain.lang_chain_parser import load_and_embed_documents
+    embeddings = OpenAIEmbeddings(base_url=stub_url + '/v1', api_key='stub', check_embedding_ctx_length=False)
+    vector_store, embeddings = load_and_embed_documents(
+        project_dir, os.path.join(project_dir, '.faiss_index'), embeddings=embeddings)
+    queries = ['create user request validation', 'delete resource by id', 'find resource with query parameter']
+    for query in queries:
+        vector_store.similarity_search_by_vector(embeddings.embed_query(query), k=5)
+    return vector_store.index.ntotal, 'chunks'
+
+
+BENCHMARKS = {
+    'scan_serial': bench_scan_serial,
+    'scan_parallel': bench_scan_parallel,
+    'scan_cached': bench_scan_cached,
+    'symbol_index': bench_symbol_index,
+    'context_packing': bench_context_packing,
+    'generate_all': bench_generate_all,
+    'generate_grouped': bench_generate_grouped,
+    'llama_index': bench_llama_index,
+    'langchain_index': bench_langchain_index,
+}
+
+
+def run_one(name, project_dir, stub_url):
+    """
+    run one benchmark in this process and print its result as JSON
+    """
+    start = time.perf_counter()
+    try:
+        measured = BENCHMARKS[name](project_dir, stub_url)
+    except ImportError as e:
+        print(json.dumps({'name': name, 'skipped': f"missing dependency: {e.name or e}"}))
+        return
+    seconds = measured[2] if len(measured) > 2 and measured[2] is not None else time.perf_counter() - start
+    count, unit = measured[0], measured[1]
+    print(json.dumps({
+        'name': name,
+        'seconds': seconds,
+        'count': count,
+        'unit': unit,
+        'throughput': count / seconds if seconds else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        # benchmark specific measurements, such as the prefix cache hit rate
+        **(measured[3] if len(measured) > 3 else {}),
+    }))
+
+
+def run_isolated(name, project_dir, stub_url, cache_dir):
+    env = dict(os.environ)
+    # ollama clients talk to the stub, and cached answers of earlier runs are never reused
+    env['OLLAMA_HOST'] = stub_url
+    env['LLM_CACHE_PATH'] = os.path.join(cache_dir, f"{name}.sqlite3")
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.run_benchmarks', '--run-one', name, '--project-dir', project_dir,
+         '--stub-url', stub_url],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    lines = [line for line in completed.stdout.splitlines() if line.startswith('{')]
+    if completed.returncode != 0 or not lines:
+        error = completed.stderr.strip().splitlines()[-1:] or ['no result']
+        return {'name': name, 'error': error[0]}
+    return json.loads(lines[-1])
+
+
+def compare(results, baseline, threshold):
+    """
+    regressions of wall time and peak memory against the baseline, as printable lines
+    """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None or 'seconds' not in result or 'seconds' not in previous:
+            continue
+        for metric in ('seconds', 'peak_rss_mb'):
+            if previous[metric] > 0 and result[metric] > previous[metric] * (1 + threshold):
+                change = result[metric] / previous[metric] - 1
+                regressions.append(f"{result['name']}: {metric} {previous[metric]:.3f} -> {result[metric]:.3f}"
+                                   f" (+{change:.0%})")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':18} {'seconds':>9} {'throughput':>16} {'peak rss':>10}")
+    for result in results:
+        if 'seconds' in result:
+            print(f"{result['name']:18} {result['seconds']:9.3f} "
+                  f"{result['throughput']:9.1f} {result['unit'] + '/s':>6} {result['peak_rss_mb']:8.1f}MB")
+            if 'prefix_hit_rate' in result:
+                print(f"{'':18} prefix cache hit rate {result['prefix_hit_rate']:.1%}, "
+                      f"prefill saved {result['prefill_saved_seconds']:.2f}s")
+        else:
+            print(f"{result['name']:18} {result.get('skipped') or 'failed: ' + result.get('error', '')}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="run the offline benchmarks")
+    arg_parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run, all of {', '.join(BENCHMARKS)}")
+    arg_parser.add_argument('--size', choices=SIZES, default='medium')
+    arg_parser.add_argument('--first-token-latency', type=float, default=0.05)
+    arg_parser.add_argument('--token-latency', type=float, default=0.001)
+    arg_parser.add_argument('--prefill-latency', type=float, default=0.0,
+                            help="stub prefill seconds per prompt token that is not in its prefix cache")
+    arg_parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    arg_parser.add_argument('--baseline', help="compare against the results in this JSON file")
+    arg_parser.add_argument('--threshold', type=float, default=0.2, help="allowed relative regression")
+    arg_parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--project-dir', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--stub-url', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one, args.project_dir, args.stub_url)
+        sys.exit(0)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        arg_parser.error(f"unknown benchmarks {', '.join(unknown)}")
+
+    server, stub_url = start_stub_server(first_token_latency=args.first_token_latency,
+                                         token_latency=args.token_latency, prefill_latency=args.prefill_latency)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in names:
+            # a fresh project per benchmark, so no benchmark sees indexes or caches of another
+            project_dir = os.path.join(work_dir, name)
+            generate(project_dir, **SIZES[args.size])
+            results.append(run_isolated(name, project_dir, stub_url, work_dir))
+    server.shutdown()
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({result['name']: result for result in results if 'seconds' in result}, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("regression", regression)
+        if regressions:
+            sys.exit(1)
+    if any('error' in result for result in results):
+        sys.exit(1)
@@ -0,0 +1,224 @@
+import argparse
+import hashlib
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__doc__ = """
+local stub of the ollama and OpenAI HTTP APIs for offline benchmarks
+
+chat answers with a fixed Java test class after a configurable first token latency and per token latency,
+prompts are prefilled at prefill_latency per token with a single slot prefix cache per model like ollama's,
+only the part after the prefix shared with the previous prompt is evaluated and counted in prompt_eval_count.
+embeddings are deterministic unit vectors derived from a hash of the text, so retrieval is repeatable.
+point ollama clients at it with OLLAMA_HOST and OpenAI clients with base_url=<url>/v1
+"""
+
+STUB_TEST_CLASS = """<think>
+the endpoint needs a MockMvc test.
+</think>
+
+```java
+@SpringBootTest
+@AutoConfigureMockMvc
+class GeneratedIntegrationTest {
+
+    @Autowired
+    private MockMvc mockMvc;
+
+    @Test
+    void returnsOk() throws Exception {
+        mockMvc.perform(get("/api/users/1")).andExpect(status().isOk());
+    }
+}
+```
+"""
+
+
+def stub_embedding(text, dimensions):
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f"{counter}:{text}".encode('utf-8')).digest()
+        values.extend((byte - 127.5) / 127.5 for byte in digest)
+        counter += 1
+    values = values[:dimensions]
+    norm = math.sqrt(sum(value * value for value in values)) or 1.0
+    return [value / norm for value in values]
+
+
+def _tokens(text):
+    # whitespace separated pieces keep their separators, so joining them gives the text back
+    pieces = []
+    current = ''
+    for char in text:
+        current += char
+        if char in ' \n':
+            pieces.append(current)
+            current = ''
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = 'StubLLM/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._json({'models': []})
+        elif self.path == '/api/version':
+            self._json({'version': '0.0.0-stub'})
+        else:
+            self._json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        request = self._body()
+        self.server.stats['requests'] += 1
+        if self.path == '/api/chat':
+            self._ollama_chat(request)
+        elif self.path == '/api/embed':
+            inputs = request.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._json({'model': request.get('model'), 'embeddings': self._embed(inputs)})
+        elif self.path == '/api/show':
+            # LlamaIndex reads the context window of the model from here
+            self._json({'modelfile': '', 'parameters': '', 'template': '', 'details': {},
+                        'model_info': {'general.architecture': 'stub', 'stub.context_length': 32768}})
+        elif self.path == '/api/embeddings':
+            self._json({'embedding': self._embed([request.get('prompt', '')])[0]})
+        elif self.path == '/v1/chat/completions':
+            self._openai_chat(request)
+        elif self.path == '/v1/embeddings':
+            inputs = request.get('input', [])
+            inputs = [inputs] if isinstance(inputs, (str, int)) or (inputs and isinstance(inputs[0], int)) else inputs
+            data = [{'object': 'embedding', 'index': index, 'embedding': vector}
+                    for index, vector in enumerate(self._embed([str(item) for item in inputs]))]
+            self._json({'object': 'list', 'data': data, 'model': request.get('model'),
+                        'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+        else:
+            self._json({'error': 'not found'}, 404)
+
+    def _embed(self, inputs):
+        self.server.stats['embedded'] += len(inputs)
+        time.sleep(self.server.embed_latency * len(inputs))
+        return [stub_embedding(text, self.server.dimensions) for text in inputs]
+
+    def _prompt_tokens(self, messages):
+        return sum(len(str(message.get('content', ''))) for message in messages) // 4
+
+    def _prefill(self, model, messages):
+        """
+        evaluate the prompt after the prefix it shares with the previous prompt of the model
+        """
+        prompt = ''.join(f"{message.get('role')}:{message.get('content', '')}" for message in messages)
+        with self.server.lock:
+            previous = self.server.last_prompts.get(model, '')
+            self.server.last_prompts[model] = prompt
+        shared = 0
+        for a, b in zip(prompt, previous):
+            if a != b:
+                break
+            shared += 1
+        evaluated = (len(prompt) - shared) // 4
+        time.sleep(self.server.prefill_latency * evaluated)
+        return {'prompt_eval_count': evaluated,
+                'prompt_eval_duration': int(self.server.prefill_latency * evaluated * 1e9)}
+
+    def _ollama_chat(self, request):
+        model = request.get('model', 'stub')
+        prefill = self._prefill(model, request.get('messages', []))
+        tokens = _tokens(STUB_TEST_CLASS)
+        time.sleep(self.server.first_token_latency)
+        if not request.get('stream', True):
+            time.sleep(self.server.token_latency * len(tokens))
+            self._json({'model': model, 'created_at': '1970-01-01T00:00:00Z',
+                        'message': {'role': 'assistant', 'content': STUB_TEST_CLASS}, 'done': True,
+                        'done_reason': 'stop', 'eval_count': len(tokens), **prefill})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for token in tokens:
+                chunk = {'model': model, 'created_at': '1970-01-01T00:00:00Z',
+                         'message': {'role': 'assistant', 'content': token}, 'done': False}
+                self.wfile.write(json.dumps(chunk).encode('utf-8') + b'\n')
+                self.wfile.flush()
+                time.sleep(self.server.token_latency)
+            final = {'model': model, 'created_at': '1970-01-01T00:00:00Z',
+                     'message': {'role': 'assistant', 'content': ''}, 'done': True, 'done_reason': 'stop',
+                     'eval_count': len(tokens), **prefill}
+            self.wfile.write(json.dumps(final).encode('utf-8') + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client aborted the stream early
+            pass
+        self.close_connection = True
+
+    def _openai_chat(self, request):
+        tokens = _tokens(STUB_TEST_CLASS)
+        time.sleep(self.server.first_token_latency + self.server.token_latency * len(tokens))
+        self._json({
+            'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': request.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': STUB_TEST_CLASS},
+                         'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': self._prompt_tokens(request.get('messages', [])),
+                      'completion_tokens': len(tokens),
+                      'total_tokens': self._prompt_tokens(request.get('messages', [])) + len(tokens)},
+        })
+
+
+def start_stub_server(host='127.0.0.1', port=0, first_token_latency=0.05, token_latency=0.001,
+                      embed_latency=0.0, dimensions=384, prefill_latency=0.0):
+    """
+    start the stub in a daemon thread, returns the server and its base url
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.first_token_latency = first_token_latency
+    server.token_latency = token_latency
+    server.embed_latency = embed_latency
+    server.dimensions = dimensions
+    server.prefill_latency = prefill_latency
+    server.last_prompts = {}
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'embedded': 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="stub ollama and OpenAI server")
+    arg_parser.add_argument('--port', type=int, default=11435)
+    arg_parser.add_argument('--first-token-latency', type=float, default=0.05)
+    arg_parser.add_argument('--token-latency', type=float, default=0.001)
+    arg_parser.add_argument('--embed-latency', type=float, default=0.0)
+    arg_parser.add_argument('--dimensions', type=int, default=384)
+    arg_parser.add_argument('--prefill-latency', type=float, default=0.0, help="seconds per evaluated prompt token")
+    args = arg_parser.parse_args()
+    server, url = start_stub_server(port=args.port, first_token_latency=args.first_token_latency,
+                                    token_latency=args.token_latency, embed_latency=args.embed_latency,
+                                    dimensions=args.dimensions, prefill_latency=args.prefill_latency)
+    print(f"stub LLM server on {url}, OLLAMA_HOST={url}, OpenAI base_url={url}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
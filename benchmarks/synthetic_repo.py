@@ -0,0 +1,135 @@
+import argparse
+import os
+import random
+
+__doc__ = """
+generate synthetic Spring Boot projects for benchmarks
+
+every controller has a class level @RequestMapping prefix and a mix of GET/POST/PUT/DELETE endpoints with
+@PathVariable, @RequestParam and @RequestBody parameters, request bodies are DTO classes with validation
+annotations, and each controller gets a service interface it depends on, like a real code base
+"""
+
+PACKAGE = 'com.example.synthetic'
+
+FIELD_TEMPLATES = [
+    ('String', ['@NotBlank(message = "{name} cannot be blank")', '@Size(min = 2, max = 50)']),
+    ('String', ['@Email(message = "Invalid email format")', '@NotNull']),
+    ('int', ['@Min(value = 18)', '@Max(value = 120)']),
+    ('Long', ['@NotNull', '@Positive']),
+    ('String', ['@Pattern(regexp = "^[A-Z]{{3}}$")']),
+    ('java.math.BigDecimal', ['@DecimalMin("0.0")', '@Digits(integer = 10, fraction = 2)']),
+]
+
+
+def _dto_source(name, fields, rng):
+    lines = [f"package {PACKAGE}.dto;", "", "import jakarta.validation.constraints.*;", "",
+             f"public class {name} {{"]
+    accessors = []
+    for index in range(fields):
+        java_type, annotations = rng.choice(FIELD_TEMPLATES)
+        field_name = f"field{index}"
+        for annotation in annotations:
+            lines.append("    " + annotation.format(name=field_name))
+        lines.append(f"    private {java_type} {field_name};")
+        lines.append("")
+        accessor = field_name[0].upper() + field_name[1:]
+        accessors.append(f"    public {java_type} get{accessor}() {{ return {field_name}; }}")
+        accessors.append(f"    public void set{accessor}({java_type} {field_name}) {{ this.{field_name} = {field_name}; }}")
+    lines.extend(accessors)
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _controller_source(index, endpoints, dto_names, rng):
+    name = f"Resource{index}"
+    service = f"{name}Service"
+    lines = [
+        f"package {PACKAGE}.controller;",
+        "",
+        f"import {PACKAGE}.dto.*;",
+        f"import {PACKAGE}.service.{service};",
+        "import jakarta.validation.Valid;",
+        "import org.springframework.beans.factory.annotation.Autowired;",
+        "import org.springframework.http.ResponseEntity;",
+        "import org.springframework.web.bind.annotation.*;",
+        "",
+        "@RestController",
+        f'@RequestMapping("/api/resource{index}")',
+        f"public class {name}Controller {{",
+        "",
+        "    @Autowired",
+        f"    private {service} service;",
+        "",
+    ]
+    for number in range(endpoints):
+        kind = number % 4
+        dto = rng.choice(dto_names)
+        if kind == 0:
+            lines += [f'    @GetMapping("/{{id}}/item{number}")',
+                      f'    public ResponseEntity<String> get{number}(@PathVariable Long id, '
+                      f'@RequestParam(name = "q", required = false) String query) {{',
+                      f'        return ResponseEntity.ok(service.find(id, query));']
+        elif kind == 1:
+            lines += [f'    @PostMapping("/item{number}")',
+                      f'    public ResponseEntity<String> create{number}(@Valid @RequestBody {dto} request) {{',
+                      f'        return ResponseEntity.ok(service.save(request.toString()));']
+        elif kind == 2:
+            lines += [f'    @PutMapping(value = "/{{id}}/item{number}")',
+                      f'    public ResponseEntity<String> update{number}(@PathVariable("id") Long id, '
+                      f'@Valid @RequestBody {dto} request) {{',
+                      f'        return ResponseEntity.ok(service.save(id + request.toString()));']
+        else:
+            lines += [f'    @RequestMapping(path = "/{{id}}/item{number}", method = RequestMethod.DELETE)',
+                      f'    public ResponseEntity<Void> delete{number}(@PathVariable Long id) {{',
+                      f'        service.delete(id);',
+                      f'        return ResponseEntity.noContent().build();']
+        lines += ["    }", ""]
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _service_source(index):
+    return (f"package {PACKAGE}.service;\n\n"
+            f"public interface Resource{index}Service {{\n"
+            f"    String find(Long id, String query);\n"
+            f"    String save(String value);\n"
+            f"    void delete(Long id);\n"
+            f"}}\n")
+
+
+def generate(root, controllers=10, endpoints=8, dtos=10, dto_fields=6, seed=0):
+    """
+    write a Spring Boot project to root and return the number of files written
+    """
+    rng = random.Random(seed)
+    base = os.path.join(root, 'src', 'main', 'java', *PACKAGE.split('.'))
+    for package in ('controller', 'dto', 'service'):
+        os.makedirs(os.path.join(base, package), exist_ok=True)
+
+    dto_names = [f"Request{index}" for index in range(dtos)]
+    written = 0
+    for name in dto_names:
+        with open(os.path.join(base, 'dto', f"{name}.java"), 'w', encoding='utf-8') as f:
+            f.write(_dto_source(name, dto_fields, rng))
+        written += 1
+    for index in range(controllers):
+        with open(os.path.join(base, 'controller', f"Resource{index}Controller.java"), 'w', encoding='utf-8') as f:
+            f.write(_controller_source(index, endpoints, dto_names, rng))
+        with open(os.path.join(base, 'service', f"Resource{index}Service.java"), 'w', encoding='utf-8') as f:
+            f.write(_service_source(index))
+        written += 2
+    return written
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="generate a synthetic Spring Boot project")
+    arg_parser.add_argument('root')
+    arg_parser.add_argument('--controllers', type=int, default=10)
+    arg_parser.add_argument('--endpoints', type=int, default=8)
+    arg_parser.add_argument('--dtos', type=int, default=10)
+    arg_parser.add_argument('--dto-fields', type=int, default=6)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    count = generate(args.root, args.controllers, args.endpoints, args.dtos, args.dto_fields, args.seed)
+    print(f"wrote {count} files to {args.root}")
@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import span
+
+__doc__ = """
+long lived local embedding service on a Unix socket
+
+models are loaded once, on first use or with --preload, and stay resident, so CLIs stop paying the model
+cold start and every process stops holding its own copy of the weights. requests of all clients for the same
+model are batched dynamically: a batch is encoded as soon as it has max_batch texts or the oldest request
+waited max_wait_ms. the LlamaIndex and LangChain adapters in llama/embedding_backend.py and
+lang_chain/embedding_backend.py use EmbeddingClient, and fall back to loading the model in process when no
+server is running.
+
+    python embedding_server.py --preload BAAI/bge-large-en-v1.5
+
+protocol: every message is a 4 byte big endian length and a JSON object.
+request {"model": name, "texts": [...]}, response {"shape": [n, dim], "data": base64 float32} or {"error": ...}
+request {"model": name, "info": true}, response {"model": name, "backend": "torch", "dimension": dim}
+"""
+
+DEFAULT_SOCKET_PATH = os.getenv('EMBEDDING_SOCKET', '/tmp/spring-test-embeddings.sock')
+HEADER = struct.Struct('>I')
+# every path that embeds in process encodes like the server, so their vectors can share one index
+ENCODE_KWARGS = {'normalize_embeddings': True}
+
+
+class SentenceTransformerBackend:
+    """
+    a model loaded with sentence-transformers, normalized like the HuggingFace embedding wrappers
+    """
+    # recorded with the vectors, backends of another name compute another embedding space
+    name = 'torch'
+
+    def __init__(self, model_name, device=None, batch_size=64):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device=device, trust_remote_code=True)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        # a single large request is encoded in batches of batch_size, not all at once
+        return self.model.encode(texts, batch_size=min(len(texts), self.batch_size), convert_to_numpy=True,
+                                 **ENCODE_KWARGS).astype('float32')
+
+    def embed(self, texts):
+        return self.encode(list(texts)).tolist()
+
+    def info(self):
+        return {'backend': self.name, 'dimension': self.dimension}
+
+
+def _pack(vectors):
+    return {'shape': list(vectors.shape), 'data': base64.b64encode(vectors.tobytes()).decode('ascii')}
+
+
+def _unpack(response):
+    if 'error' in response:
+        raise RuntimeError(f"embedding server: {response['error']}")
+    count, dimension = response['shape']
+    values = array('f', base64.b64decode(response['data']))
+    return [values[i * dimension:(i + 1) * dimension].tolist() for i in range(count)]
+
+
+async def _read_message(reader):
+    length = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    return json.loads(await reader.readexactly(length))
+
+
+def _encode_message(message):
+    body = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+class ModelBatcher:
+    """
+    queue of pending requests for one model, encoded in batches by a single worker
+    """
+
+    def __init__(self, backend, executor, max_batch=64, max_wait_ms=5.0):
+        self.backend = backend
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def embed(self, texts):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            # gather more requests until the batch is full or the first one waited long enough
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                with span('embedding_server.batch', texts=len(texts), requests=len(pending)):
+                    vectors = await loop.run_in_executor(self.executor, self.backend.encode, texts)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_texts, future in pending:
+                if not future.done():
+                    future.set_result(vectors[start:start + len(request_texts)])
+                start += len(request_texts)
+
+
+class EmbeddingServer:
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, max_batch=64, max_wait_ms=5.0, device=None,
+                 backend_factory=SentenceTransformerBackend):
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.device = device
+        self.backend_factory = backend_factory
+        # one thread runs the models, so batches never compete for the same cores or GPU
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {}
+        self.loading = {}
+        self.requests = 0
+
+    async def batcher(self, model_name):
+        if model_name not in self.batchers:
+            if model_name not in self.loading:
+                self.loading[model_name] = asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.load, model_name)
+            try:
+                backend = await self.loading[model_name]
+            except Exception:
+                # a model that failed to load is tried again by the next request
+                self.loading.pop(model_name, None)
+                raise
+            if model_name not in self.batchers:
+                self.batchers[model_name] = ModelBatcher(backend, self.executor, self.max_batch, self.max_wait_ms)
+        return self.batchers[model_name]
+
+    def load(self, model_name):
+        start = time.perf_counter()
+        with span('embedding_server.load', model=model_name):
+            backend = self.backend_factory(model_name, device=self.device, batch_size=self.max_batch)
+        print(f"loaded {model_name} in {time.perf_counter() - start:.1f}s")
+        return backend
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                self.requests += 1
+                try:
+                    if request.get('info'):
+                        backend = (await self.batcher(request['model'])).backend
+                        response = {'model': request['model'], **backend_info(backend)}
+                    elif request.get('texts'):
+                        batcher = await self.batcher(request['model'])
+                        response = _pack(await batcher.embed(request['texts']))
+                    else:
+                        response = {'shape': [0, 0], 'data': '', 'models': list(self.batchers)}
+                except Exception as e:
+                    response = {'error': repr(e)}
+                writer.write(_encode_message(response))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, preload=()):
+        for model_name in preload:
+            await self.batcher(model_name)
+        if server_available(self.socket_path):
+            raise RuntimeError(f"an embedding server is already listening on {self.socket_path}")
+        if os.path.exists(self.socket_path):
+            # left behind by a server that did not shut down cleanly
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        print(f"embedding server on {self.socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def backend_info(backend):
+    """
+    name and dimension of an embedding backend, the dimension is None when the backend does not report it
+    """
+    if hasattr(backend, 'info'):
+        return backend.info()
+    return {'backend': getattr(backend, 'name', type(backend).__name__),
+            'dimension': getattr(backend, 'dimension', None)}
+
+
+class EmbeddingClient:
+    """
+    blocking client of the embedding server, one connection per client reused for every request
+    """
+
+    def __init__(self, model_name, socket_path=DEFAULT_SOCKET_PATH, timeout=300.0):
+        self.model_name = model_name
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connection = None
+        # requests of several threads take turns on the one connection
+        self.lock = threading.Lock()
+        self._info = None
+
+    def _connect(self):
+        if self.connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            self.connection = connection
+        return self.connection
+
+    def _receive(self, size):
+        chunks = []
+        while size:
+            chunk = self.connection.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("embedding server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _request(self, message):
+        with self.lock:
+            try:
+                self._connect().sendall(_encode_message(message))
+                length = HEADER.unpack(self._receive(HEADER.size))[0]
+                response = json.loads(self._receive(length))
+            except OSError:
+                self.close()
+                raise
+        if 'error' in response:
+            raise RuntimeError(f"embedding server: {response['error']}")
+        return response
+
+    def embed(self, texts):
+        if not texts:
+            return []
+        return _unpack(self._request({'model': self.model_name, 'texts': list(texts)}))
+
+    def info(self):
+        """
+        backend and dimension the server runs the model with, asked once per client
+        """
+        if self._info is None:
+            response = self._request({'model': self.model_name, 'info': True})
+            self._info = {'backend': response['backend'], 'dimension': response['dimension']}
+        return self._info
+
+    async def aembed(self, texts):
+        if not texts:
+            return []
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(_encode_message({'model': self.model_name, 'texts': list(texts)}))
+            await writer.drain()
+            return _unpack(await asyncio.wait_for(_read_message(reader), self.timeout))
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def server_available(socket_path=DEFAULT_SOCKET_PATH):
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(1.0)
+            connection.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def default_backend(model_name, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    a client of the running embedding server, None when there is no server to talk to
+    """
+    if server_available(socket_path):
+        return EmbeddingClient(model_name, socket_path)
+    return None
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="resident embedding server on a Unix socket")
+    arg_parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH)
+    arg_parser.add_argument('--preload', nargs='*', default=[], help="models to load before accepting requests")
+    arg_parser.add_argument('--max-batch', type=int, default=64)
+    arg_parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    arg_parser.add_argument('--device', help="cpu, cuda or mps, picked by sentence-transformers by default")
+    arg_parser.add_argument('--backend', choices=['torch', 'quantized'], default=os.getenv('EMBEDDING_BACKEND', 'torch'),
+                            help="quantized runs the models as int8 ONNX Runtime graphs on CPU")
+    args = arg_parser.parse_args()
+    backend_factory = SentenceTransformerBackend
+    if args.backend == 'quantized':
+        from quantized_embedding import QuantizedBackend
+        backend_factory = QuantizedBackend
+    server = EmbeddingServer(args.socket, args.max_batch, args.max_wait_ms, args.device, backend_factory)
+    try:
+        asyncio.run(server.serve(args.preload))
+    except KeyboardInterrupt:
+        pass
@@ -5,21 +5,62 @@ this class want to help generate Java Spring Boot API integration test code
 2. generate integration test code with template code
 3. add mock some bean and mock data into test code
 
-I think there is an AI agent task because it has to ask AI many times 
-we will give a Spring boot Controller file content to AI.
-firstly, we have to ask AI where it is related code and get code file path, for this step we can require structure JSON format
-secondly, we can read code file and get code content
-thirdly, we can ask AI to generate integration test code with template prompt
+the related code is found without a model: tree-sitter extracts the endpoints of a controller
+and a project symbol index resolves request body and URL parameter types to their source files.
+then we read the related code and ask AI to generate integration test code with template prompt
+
+the prompt starts with what endpoints with the same request classes share (instructions, example test,
+request class sources) and ends with the endpoint, so the model server reuses the KV cache of the prefix.
+--group-by-dto sends the endpoints of each request class group back to back.
+
+model calls go through a ModelRouter: generation to its tier of models, and parameter types the symbol index
+can not resolve (a class outside the scanned sources, a parse error) to a small model first, whose JSON is
+validated against RequestParameter and escalated to the big model only when it does not validate.
 """
 
-import json
+import argparse
+import asyncio
 import os
-from ollama import chat
+import re
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from ollama import AsyncClient
 from pydantic import BaseModel
 
+from llm_cache import cache_key, default_cache
+from tracing import enable_tracing, export_trace, span
+from integration_test_code.analyze_api import AnalyzeAPI, Endpoint
+from integration_test_code.context_packer import ContextPacker, estimate_tokens
+from integration_test_code.model_router import ModelRouter
+from integration_test_code.prompt_scheduler import PrefixCacheStats, group_by_request_classes
+from integration_test_code.streaming import stream_chat
+from integration_test_code.symbol_index import IDENTIFIER, SymbolIndex
+
+
+DEFAULT_REQUIREMENTS = "I want to generate test case which include assertion for different assert annotation, for example @NotBlank @Size @NotNull"
 
 example_code_path = ['spring-request/src/test/java/pro/demo/springrequest/UserControllerIntegrationTest.java']
 
+# types that never have a project source file, an unresolved one of them needs no model call
+JDK_TYPES = {
+    'boolean', 'byte', 'char', 'short', 'int', 'long', 'float', 'double', 'void', 'Object', 'String', 'Boolean',
+    'Byte', 'Character', 'Short', 'Integer', 'Long', 'Float', 'Double', 'Number', 'BigDecimal', 'BigInteger',
+    'List', 'Set', 'Map', 'Collection', 'Optional', 'UUID', 'Date', 'LocalDate', 'LocalDateTime', 'Instant',
+}
+LIBRARY_PACKAGES = ('java.', 'javax.', 'jakarta.', 'org.springframework.')
+
+EXTRACTION_PROMPT = """Fill in the request parameter of a Spring Boot controller as JSON.
+parameter name = {name}, type = {type}
+controller = {file_path}, package = {package_name}
+imports of the controller:
+{imports}
+class_name is the simple class name of the type, package_name the package it is imported from or the
+controller package, full_file_path the source file under {project_dir} or an empty string when it is not
+part of the project.
+"""
+
 class RequestParameter(BaseModel):
     class_name: str
     full_file_path: str
@@ -37,83 +78,402 @@ class APIInformation(BaseModel):
     request_body: list[RequestParameter]
 
 
+def validate_file_path(extracted):
+    if extracted.full_file_path and not os.path.isfile(extracted.full_file_path):
+        return f"{extracted.full_file_path} does not exist"
+    return None
+
+
+@dataclass
+class GenerationResult:
+    endpoint: Endpoint
+    output_path: str
+    ok: bool
+    seconds: float
+    error: Optional[str] = None
+
+
 class APIGenerator:
-    def __init__(self):
-        pass
+    def __init__(self, project_dir='spring-request', token_budget=6000, tiers=None):
+        self.project_dir = project_dir
+        self.analyzer = AnalyzeAPI(project_dir)
+        self.symbol_index = SymbolIndex(project_dir)
+        # prompt context is sliced with tree-sitter and packed into token_budget
+        self.context_packer = ContextPacker(self.symbol_index, token_budget)
+        # StreamStats of every streamed generation: time to first token, total tokens, abort reason
+        self.stream_stats = []
+        # prompt tokens the model server evaluated and reused from its prefix cache
+        self.prefix_stats = PrefixCacheStats()
+        # model tier of each task and the tier that served every call
+        self.router = ModelRouter(tiers)
 
-    def analyze(self, file_path):
+    def analyze(self, file_path, stream=False, max_tokens=None):
         """
         analyze API relate code
+
+        with stream=True the test code is written to result.txt and stdout while it is generated
         """
-        # read file
-        code_content = ''
-        with open(file_path, 'r', encoding='utf-8') as f:
-            code_content = f.read()
-        api_information = self.find_api_relation_code(code_content, file_path)
-        if api_information is None:
+        endpoints = self.analyzer.scan_file(file_path)
+        if not endpoints:
             raise Exception("can not find API relate code")
 
+        example_code = self.load_example_code()
+        with open('result.txt', 'w', encoding='utf-8') as output:
+            for endpoint in endpoints:
+                api_information = self.find_api_relation_code(endpoint)
+                message = self.build_message(endpoint, api_information, example_code)
+                if stream:
+                    self.generate_integration_test_code(message, stream=True, output=output, max_tokens=max_tokens)
+                else:
+                    response = self.generate_integration_test_code(message)
+                    print(response)
+                    output.write(response)
+                output.write('\n\n')
+
+    async def generate_all(self, endpoints, output_dir='generated_tests', concurrency=4, timeout=600.0,
+                           progress=None):
+        """
+        generate integration tests for many endpoints concurrently, one output file per endpoint
+
+        at most `concurrency` requests run against ollama at a time and each one is limited to `timeout` seconds,
+        a slow or failed endpoint is reported in its GenerationResult and never stops the others.
+        `async def progress(result)` is awaited as soon as each endpoint finishes.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        example_code = self.load_example_code()
+
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        output_paths = self.output_paths(endpoints, output_dir)
 
-        request_body_file_content = ''
-        if api_information.request_body:
-            for parameter in api_information.request_body:
-                path = parameter.full_file_path
-                request_body_file_content += open(path, 'r', encoding='utf-8').read()
-        request_parameter_file_content = ''
-        if api_information.request_parameter_for_url:
-            for parameter in api_information.request_parameter_for_url:
-                path = parameter.full_file_path
-                request_parameter_file_content += open(path, 'r', encoding='utf-8').read()
+        async def generate(endpoint, output_path):
+            result = await generate_one(endpoint, output_path)
+            if progress is not None:
+                await progress(result)
+            return result
 
+        async def generate_one(endpoint, output_path):
+            async with semaphore:
+                return await self.generate_file(endpoint, output_path, example_code, client, timeout)
 
+        results = await asyncio.gather(*(generate(endpoint, path) for endpoint, path in zip(endpoints, output_paths)))
+        self.print_results(results)
+        return results
+
+    async def generate_grouped(self, endpoints, output_dir='generated_tests', keep_alive='30m', timeout=600.0,
+                               progress=None):
+        """
+        generate endpoints one group of shared request classes after the other, the endpoints of a group back
+        to back, so the model server prefills the shared prompt prefix once per group
+
+        keep_alive keeps the model loaded between requests, a reloaded model starts with an empty cache
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        example_code = self.load_example_code()
+        client = AsyncClient()
+        output_paths = dict(zip(endpoints, self.output_paths(endpoints, output_dir)))
+        groups = group_by_request_classes(endpoints, self.request_classes)
+        results = []
+        for shared_classes, group in groups:
+            for endpoint in group:
+                result = await self.generate_file(endpoint, output_paths[endpoint], example_code, client, timeout,
+                                                  shared_classes=shared_classes, keep_alive=keep_alive)
+                if progress is not None:
+                    await progress(result)
+                results.append(result)
+        self.print_results(results)
+        print(f"{len(endpoints)} endpoints in {len(groups)} request class groups, "
+              f"prefix cache = {self.prefix_stats.to_dict()}")
+        return results
+
+    async def generate_file(self, endpoint, output_path, example_code, client, timeout, **kwargs):
+        """
+        generate one endpoint into output_path, failures and timeouts are reported in the GenerationResult
+        """
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.agenerate(endpoint, example_code, client=client, **kwargs),
+                                              timeout)
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(response)
+            return GenerationResult(endpoint, output_path, True, time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            return GenerationResult(endpoint, output_path, False, time.perf_counter() - start,
+                                    f"timed out after {timeout}s")
+        except Exception as e:
+            return GenerationResult(endpoint, output_path, False, time.perf_counter() - start, repr(e))
+
+    def print_results(self, results):
+        for result in results:
+            status = 'ok    ' if result.ok else 'failed'
+            print(f"{status} {result.seconds:7.1f}s {result.endpoint.http_method:6} {result.endpoint.api_path}"
+                  f" -> {result.output_path}" + (f" ({result.error})" if result.error else ''))
+
+    async def agenerate(self, endpoint, example_code, requirements=None, client=None, shared_classes=None,
+                        keep_alive=None):
+        """
+        generate the integration test of one endpoint with the async ollama client
+        """
+        async with span('generate.endpoint', api_path=endpoint.api_path):
+            endpoint = self.current(endpoint)
+            api_information = await self.afind_api_relation_code(endpoint, client)
+            message = self.build_message(endpoint, api_information, example_code, requirements, shared_classes)
+            options = {'keep_alive': keep_alive} if keep_alive is not None else {}
+            return await self.router.agenerate(
+                'generation', [{"role": "user", "content": message}], client=client,
+                on_response=lambda response: self.prefix_stats.record(estimate_tokens(message), response), **options)
+
+    def current(self, endpoint):
+        """
+        the endpoint as its controller is now, scanned again when the file changed since it was scanned
+        """
+        if self.analyzer.file_version(endpoint.file_path) == endpoint.file_version:
+            return endpoint
+        identity = (endpoint.class_name, endpoint.method, endpoint.http_method, endpoint.path)
+        for scanned in self.analyzer.scan_file(endpoint.file_path):
+            if (scanned.class_name, scanned.method, scanned.http_method, scanned.path) == identity:
+                return scanned
+        raise ValueError(f"{endpoint.http_method} {endpoint.api_path} is no longer in {endpoint.file_path}")
+
+    def output_paths(self, endpoints, output_dir, extension='.txt'):
+        """
+        one file name per endpoint, such as UserController_getUser_GET.txt, numbered when a name repeats
+        """
+        paths = []
+        used = set()
+        for endpoint in endpoints:
+            name = re.sub(r'[^\w.-]', '_', f"{endpoint.class_name}_{endpoint.method}_{endpoint.http_method}")
+            candidate, number = name, 2
+            while candidate in used:
+                candidate, number = f"{name}_{number}", number + 1
+            used.add(candidate)
+            paths.append(os.path.join(output_dir, candidate + extension))
+        return paths
+
+    def load_example_code(self):
         example_code = ''
         for file in example_code_path:
-            example_code = open(file, 'r', encoding='utf-8').read()
+            with open(file, 'r', encoding='utf-8') as f:
+                example_code = f.read()
+        return example_code
 
-        # generate integration test code
-        message = f"here's Java code with SpringBoot framework, I ask you generate integration test code, full_file_path = {file_path}, content = {code_content}, api_information = {api_information}, request_body_file_content = {request_body_file_content}, request_parameter_file_content = {request_parameter_file_content} I want to generate test case which include assertion for different assert annotation, for example @NotBlank @Size @NotNull, you have to use Spring Boot mvc test framework, and you have to mock some bean and mock data, this is a example code {example_code}"
+    def request_classes(self, endpoint):
+        """
+        project classes of the endpoint's parameters, the endpoints of a prompt prefix group share them
+        """
+        classes = []
+        for parameter in endpoint.parameters:
+            for java_class in self.symbol_index.resolve_type(parameter.type, endpoint.file_path):
+                if java_class not in classes:
+                    classes.append(java_class)
+        return classes
 
-        response = self.generate_integration_test_code(message)
-        print(response)
-        open('result.txt', 'w', encoding='utf-8').write(response)
+    def build_prompt(self, endpoint, api_information, example_code, requirements=None, shared_classes=None):
+        """
+        (prefix, suffix) of the prompt, the prefix only depends on the requirements, the example and the
+        shared request classes, the request classes of the endpoint by default
 
+        the prefix gets at most half of the token budget and the endpoint context the rest
+        """
+        requirements = requirements or DEFAULT_REQUIREMENTS
+        endpoint = self.current(endpoint)
+        shared_classes = self.request_classes(endpoint) if shared_classes is None else shared_classes
+        budget = self.context_packer.token_budget
+        with span('prompt.pack', api_path=endpoint.api_path) as current:
+            shared = self.context_packer.pack_shared(shared_classes, example_code, budget // 2)
+            context = self.context_packer.pack(endpoint, shared_classes=shared_classes,
+                                               token_budget=budget - shared.tokens)
+            truncated = shared.truncated + context.truncated
+            dropped = shared.dropped + context.dropped
+            current.set(tokens=shared.tokens + context.tokens, prefix_tokens=shared.tokens,
+                        truncated=len(truncated), dropped=len(dropped))
+        if truncated or dropped:
+            print(f"context of {endpoint.api_path}: {shared.tokens + context.tokens} tokens, "
+                  f"truncated = {truncated}, dropped = {dropped}")
+        prefix = f"I ask you generate integration test code for Java code with SpringBoot framework. {requirements}, you have to use Spring Boot mvc test framework, and you have to mock some bean and mock data, this is a example code {shared.text('example')}\nrequest_class_content = {shared.text('class:')}, imports = {shared.text('imports')}\n"
+        suffix = f"here's the endpoint to test, full_file_path = {endpoint.file_path}, content = {context.text('endpoint')}, api_information = {api_information}, request_class_content = {context.text('class:')}, imports = {context.text('imports')}"
+        return prefix, suffix
 
+    def build_message(self, endpoint, api_information, example_code, requirements=None, shared_classes=None):
+        """
+        prompt with the packed context of the endpoint instead of whole files, the shared prefix first
+
+        requirements replace the default request for validation annotation test cases
+        """
+        prefix, suffix = self.build_prompt(endpoint, api_information, example_code, requirements, shared_classes)
+        return prefix + suffix
 
-    def find_api_relation_code(self, code_content, file_path) -> APIInformation:
+    def find_api_relation_code(self, endpoint) -> APIInformation:
         """
         find API relate code, such as request parameter class and API path
+
+        the endpoint comes from AnalyzeAPI and its parameter types are resolved with the project symbol index,
+        so the file paths are real files. only project types the index can not resolve are asked from a model
         """
-        message = f"here's Java code with SpringBoot framework, I ask you read it and find API endpoint information, full_file_path = {file_path}, content = {code_content} in general, API endpoint is a method with annotation like @GetMapping, @PostMapping, @PutMapping, @DeleteMapping, @RequestMapping and it has a path, such as @GetMapping(\"/hello/name\"), I want to know method name, api path, relative file path, full file path, request parameter for url, request body. try to figure out parameter class type and full file path"
-        print("request = " + message)
-        response = chat(
-            model="deepseek-r1:32b",
-            messages=[
-                {
-                    "role": "user",
-                    "content": message
-
-                }],
-            stream=False,
-            format=APIInformation.model_json_schema()
+        extracted = {parameter: self.extract_request_parameter(parameter, endpoint.file_path)
+                     for parameter in self.unresolved_parameters(endpoint)}
+        return self.api_information(endpoint, extracted)
+
+    async def afind_api_relation_code(self, endpoint, client=None) -> APIInformation:
+        """
+        find_api_relation_code with the model calls for unresolved types on the async ollama client
+        """
+        extracted = {}
+        for parameter in self.unresolved_parameters(endpoint):
+            extracted[parameter] = await self.aextract_request_parameter(parameter, endpoint.file_path, client)
+        return self.api_information(endpoint, extracted)
+
+    def api_information(self, endpoint, extracted) -> APIInformation:
+        """
+        extracted maps the parameters resolved by a model to their RequestParameter, None when it failed
+        """
+        request_parameter_for_url = []
+        request_body = []
+        with span('prompt.resolve', parameters=len(endpoint.parameters)):
+            for parameter in endpoint.parameters:
+                target = request_body if parameter.source == 'body' else request_parameter_for_url
+                target.append(extracted.get(parameter) or self.build_request_parameter(parameter, endpoint.file_path))
+        return APIInformation(
+            method_name=endpoint.method,
+            api_path=endpoint.api_path,
+            relative_file_path=os.path.relpath(endpoint.file_path, self.project_dir),
+            full_file_path=os.path.abspath(endpoint.file_path),
+            class_name=endpoint.class_name,
+            request_parameter_for_url=request_parameter_for_url,
+            request_body=request_body,
         )
-        print(response.message.content)
-        return APIInformation(**json.loads(response.message.content))
-
-    def generate_integration_test_code(self, message):
-        response = chat(
-            model="deepseek-r1:32b",
-            messages=[
-                {
-                    "role": "user",
-                    "content": message
-
-                }],
-            stream=False
+
+    def build_request_parameter(self, parameter, context_file) -> RequestParameter:
+        # JDK types such as Long or String are not part of the project, they have no file to read
+        resolved = self.symbol_index.resolve_type(parameter.type, context_file)
+        java_class = resolved[0] if resolved else None
+        return RequestParameter(
+            class_name=java_class.name if java_class else parameter.type,
+            full_file_path=os.path.abspath(java_class.file_path) if java_class else '',
+            package_name=java_class.package_name if java_class else '',
+            name=parameter.name,
         )
-        return response.message.content
+
+    def unresolved_parameters(self, endpoint):
+        """
+        parameters of project types the symbol index can not resolve
+        """
+        return [parameter for parameter in endpoint.parameters
+                if not self.symbol_index.resolve_type(parameter.type, endpoint.file_path)
+                and self.is_project_type(parameter.type, endpoint.file_path)]
+
+    def is_project_type(self, type_text, context_file):
+        """
+        whether a type names a class that is neither a JDK type nor imported from a library package
+        """
+        context = self.symbol_index.by_file.get(context_file, [])
+        imports = context[0].imports if context else ()
+        for name in IDENTIFIER.findall(type_text):
+            simple_name = name.rsplit('.', 1)[-1]
+            if name in JDK_TYPES or name.startswith(LIBRARY_PACKAGES):
+                continue
+            if any(imported.endswith('.' + simple_name) and imported.startswith(LIBRARY_PACKAGES)
+                   for imported in imports):
+                continue
+            return True
+        return False
+
+    def extraction_messages(self, parameter, context_file):
+        context = self.symbol_index.by_file.get(context_file, [])
+        message = EXTRACTION_PROMPT.format(
+            name=parameter.name, type=parameter.type, file_path=context_file,
+            package_name=context[0].package_name if context else '',
+            imports='\n'.join(context[0].imports) if context else '', project_dir=os.path.abspath(self.project_dir))
+        return [{"role": "user", "content": message}]
+
+    def extract_request_parameter(self, parameter, context_file):
+        """
+        ask the extraction tier for a parameter the symbol index could not resolve, None when no tier
+        returned a RequestParameter with an existing (or empty) file path
+        """
+        try:
+            extracted = self.router.extract('extraction', self.extraction_messages(parameter, context_file),
+                                            RequestParameter, validate=validate_file_path)
+        except ValueError as e:
+            print(f"can not resolve {parameter.type} {parameter.name}: {e}")
+            return None
+        # the name is the one from the source, whatever the model answered
+        return extracted.model_copy(update={'name': parameter.name})
+
+    async def aextract_request_parameter(self, parameter, context_file, client=None):
+        try:
+            extracted = await self.router.aextract('extraction', self.extraction_messages(parameter, context_file),
+                                                   RequestParameter, validate=validate_file_path, client=client)
+        except ValueError as e:
+            print(f"can not resolve {parameter.type} {parameter.name}: {e}")
+            return None
+        return extracted.model_copy(update={'name': parameter.name})
+
+    def generate_integration_test_code(self, message, use_cache=True, stream=False, output=None, max_tokens=None):
+        """
+        generate test code for the prompt
+
+        stream=True writes the code to output and stdout token by token, strips <think> blocks and stops
+        once a complete Java class was emitted or max_tokens is reached
+        """
+        messages = [
+            {
+                "role": "user",
+                "content": message
+
+            }]
+        if not stream:
+            return self.router.generate('generation', messages, use_cache=use_cache)
+
+        # a streamed response is written as it arrives and can not be escalated, it goes to the first tier
+        model = self.router.models('generation')[0]
+        key = cache_key(model, messages)
+        with span('llm.cache_lookup', model=model) as current:
+            cached = default_cache().get(key) if use_cache else None
+            current.set(cache_hit=cached is not None)
+        if cached is not None:
+            if output is not None:
+                output.write(cached)
+            print(cached)
+            return cached
+        stats = stream_chat(model, messages, output=output, max_tokens=max_tokens)
+        self.stream_stats.append(stats)
+        print(f"\ntime to first token = {stats.time_to_first_token}, tokens = {stats.tokens}, "
+              f"total = {stats.total_seconds:.1f}s, aborted = {stats.aborted}")
+        # a response cut by the token budget is incomplete and must not be served from the cache later
+        if use_cache and stats.aborted != 'token_budget':
+            default_cache().put(key, stats.content)
+        return stats.content
 
 
 if __name__ == '__main__':
-    api_generator = APIGenerator()
-    api_generator.analyze(
-        '')
+    arg_parser = argparse.ArgumentParser(description="generate Spring Boot integration tests")
+    arg_parser.add_argument('file_path', nargs='?', help="controller file, all endpoints of the project when omitted")
+    arg_parser.add_argument('--project-dir', default='spring-request')
+    arg_parser.add_argument('--output-dir', default='generated_tests')
+    arg_parser.add_argument('--concurrency', type=int, default=4)
+    arg_parser.add_argument('--timeout', type=float, default=600.0)
+    arg_parser.add_argument('--stream', action='store_true', help="stream the generated code of a single controller")
+    arg_parser.add_argument('--max-tokens', type=int, help="abort a streamed generation after this many tokens")
+    arg_parser.add_argument('--group-by-dto', action='store_true',
+                            help="send endpoints with the same request classes back to back to reuse the prompt cache")
+    arg_parser.add_argument('--keep-alive', default='30m', help="how long ollama keeps the model loaded")
+    arg_parser.add_argument('--trace', help="write a Chrome trace of the run to this JSON file")
+    args = arg_parser.parse_args()
+    if args.trace:
+        enable_tracing()
+
+    api_generator = APIGenerator(project_dir=args.project_dir)
+    if args.file_path:
+        api_generator.analyze(args.file_path, stream=args.stream, max_tokens=args.max_tokens)
+    elif args.group_by_dto:
+        asyncio.run(api_generator.generate_grouped(
+            api_generator.analyzer.analyze(), args.output_dir, args.keep_alive, args.timeout))
+    else:
+        asyncio.run(api_generator.generate_all(
+            api_generator.analyzer.analyze(), args.output_dir, args.concurrency, args.timeout))
+        print("prefix cache = ", api_generator.prefix_stats.to_dict())
+    print("model router = ", api_generator.router.stats())
+    print("llm cache = ", default_cache().stats())
+    if args.trace:
+        export_trace(args.trace)
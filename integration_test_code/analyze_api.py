@@ -1,9 +1,14 @@
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, replace
 
-from langchain_community.document_loaders import TextLoader
-from tree_sitter import Language, Parser
+from tree_sitter import Language, Parser, Query, QueryCursor
 import tree_sitter_java as java
 
+from integration_test_code.endpoint_cache import EndpointCache, content_hash
+from tracing import enable_tracing, export_trace, span
+
 __doc__ = """
 use tree-sitter to analyse Java code and find API endpoint
 
@@ -11,103 +16,432 @@ use tree-sitter to analyse Java code and find API endpoint
 
 JAVA_LANGUAGE = Language(java.language())
 
+MAPPING_HTTP_METHODS = {
+    'GetMapping': 'GET',
+    'PostMapping': 'POST',
+    'PutMapping': 'PUT',
+    'DeleteMapping': 'DELETE',
+    'PatchMapping': 'PATCH',
+    'RequestMapping': 'ANY',
+}
+
+PARAMETER_SOURCES = {
+    'PathVariable': 'path',
+    'RequestParam': 'query',
+    'RequestBody': 'body',
+}
+
+# compiled once per process, one cursor over it captures class prefixes, endpoint methods and their parameters
+ENDPOINT_QUERY = Query(JAVA_LANGUAGE, """
+(class_declaration
+  (modifiers
+    (annotation
+      name: (identifier) @class.annotation
+      arguments: (annotation_argument_list) @class.arguments))
+  (#eq? @class.annotation "RequestMapping"))
+
+(method_declaration
+  (modifiers
+    [(annotation
+       name: (identifier) @method.annotation
+       arguments: (annotation_argument_list) @method.arguments)
+     (marker_annotation
+       name: (identifier) @method.annotation)])
+  name: (identifier) @method.name
+  (#match? @method.annotation "^(Get|Post|Put|Delete|Patch|Request)Mapping$")) @method
+
+(formal_parameter
+  (modifiers
+    [(annotation
+       name: (identifier) @parameter.annotation
+       arguments: (annotation_argument_list) @parameter.arguments)
+     (marker_annotation
+       name: (identifier) @parameter.annotation)])
+  type: (_) @parameter.type
+  name: (identifier) @parameter.name
+  (#match? @parameter.annotation "^(PathVariable|RequestParam|RequestBody)$")) @parameter
+""")
+
+
+@dataclass(frozen=True, slots=True)
+class EndpointParameter:
+    name: str
+    type: str
+    # path, query or body
+    source: str
+
+
+@dataclass(frozen=True, slots=True)
+class Endpoint:
+    method: str
+    # mapping annotation, such as GetMapping
+    type: str
+    http_method: str
+    # path of the method annotation and the full path including the class level @RequestMapping prefix
+    path: str
+    api_path: str
+    class_name: str
+    class_prefix: str
+    file_path: str
+    parameters: tuple[EndpointParameter, ...]
+    # byte range of the method declaration in the file
+    start_byte: int
+    end_byte: int
+    # (mtime_ns, size) of the file when it was scanned, the byte range is only valid for that version
+    file_version: tuple[int, ...] = ()
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        parameters = tuple(EndpointParameter(**parameter) for parameter in data['parameters'])
+        return cls(**{**data, 'parameters': parameters, 'file_version': tuple(data.get('file_version', ()))})
+
+
+def _text(node):
+    return node.text.decode('utf-8')
+
+
+def _string_values(node):
+    """
+    values of a string literal or an array of string literals, other expressions are kept as source text
+    """
+    if node.type == 'string_literal':
+        return [''.join(_text(child) for child in node.named_children)]
+    if node.type == 'element_value_array_initializer':
+        return [value for child in node.named_children for value in _string_values(child)]
+    return [_text(node)]
+
+
+def _annotation_arguments(arguments):
+    """
+    map annotation arguments to their values, a positional argument is stored under 'value'
+    """
+    result = {}
+    if arguments is None:
+        return result
+    for child in arguments.named_children:
+        if child.type == 'element_value_pair':
+            result[_text(child.child_by_field_name('key'))] = child.child_by_field_name('value')
+        else:
+            result['value'] = child
+    return result
+
+
+def _join_path(prefix, path):
+    joined = '/'.join(part.strip('/') for part in (prefix, path) if part.strip('/'))
+    return '/' + joined
+
+
+def _point(source, offset):
+    row = source.count(b'\n', 0, offset)
+    return row, offset - (source.rfind(b'\n', 0, offset) + 1)
+
+
+def _common_prefix_length(a, b, limit):
+    # binary search over slice comparisons, which run in C, instead of a byte by byte loop
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _source_edit(old, new):
+    """
+    the single edit that turns old into new, as the keyword arguments of Tree.edit
+    """
+    start = _common_prefix_length(old, new, min(len(old), len(new)))
+    limit = min(len(old), len(new)) - start
+    suffix = _common_prefix_length(old[::-1], new[::-1], limit)
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    return dict(
+        start_byte=start,
+        old_end_byte=old_end,
+        new_end_byte=new_end,
+        start_point=_point(old, start),
+        old_end_point=_point(old, old_end),
+        new_end_point=_point(new, new_end),
+    )
+
+
+def _enclosing(node, node_type):
+    node = node.parent
+    while node is not None and node.type != node_type:
+        node = node.parent
+    return node
+
+
 class AnalyzeAPI:
-    def __init__(self, dir_path):
+    def __init__(self, dir_path, cache_path=None):
         self.dir_path = dir_path
+        self.parser = Parser(JAVA_LANGUAGE)
+        # optional on-disk cache, files with unchanged content are never parsed again
+        self.cache = EndpointCache(cache_path) if cache_path else None
+        # parsed source and tree of every watched file, reused for incremental parsing
+        self.trees = {}
+
+    def analyze(self, workers=1):
+        """
+        find API endpoints in all controller files under dir_path
+
+        with workers > 1 the files are parsed by a process pool, the result is the same as the serial scan
+        """
+        with span('analyze.walk', dir_path=self.dir_path) as current:
+            java_files = self.find_controller_files()
+            current.set(files=len(java_files))
+        print("all controller file = ", java_files)
+
+        if self.cache:
+            with span('analyze.cache_lookup', files=len(java_files)) as current:
+                endpoints_by_file = self.load_cached(java_files)
+                current.set(cache_hits=len(endpoints_by_file))
+        else:
+            endpoints_by_file = {}
+        to_parse = [java_file for java_file in java_files if java_file not in endpoints_by_file]
+        if workers > 1 and len(to_parse) > 1:
+            # a few chunks per worker keeps the pool busy without paying IPC per file
+            chunksize = max(1, len(to_parse) // (workers * 4))
+            # spans of the worker processes are lost, the pool is traced as one stage
+            with span('analyze.parse_parallel', files=len(to_parse), workers=workers), \
+                    ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(self.dir_path,)) as executor:
+                # map keeps input order, so the endpoint list is deterministic
+                for java_file, api_information in zip(to_parse, executor.map(_scan_file, to_parse, chunksize=chunksize)):
+                    endpoints_by_file[java_file] = api_information
+        else:
+            for java_file in to_parse:
+                endpoints_by_file[java_file] = self.scan_file(java_file)
+
+        if self.cache:
+            for java_file in to_parse:
+                self.store_cached(java_file, endpoints_by_file[java_file])
+            self.cache.prune(java_files)
+            self.cache.commit()
+
+        result = [endpoint for java_file in java_files for endpoint in endpoints_by_file[java_file]]
+        print("api_information = ", result)
+        return result
+
+    def load_cached(self, java_files):
+        """
+        endpoints of all files whose content is unchanged since they were cached
+        """
+        result = {}
+        for java_file in java_files:
+            stat = os.stat(java_file)
+            cached = self.cache.get_by_stat(java_file, stat)
+            if cached is None:
+                with open(java_file, 'rb') as f:
+                    cached = self.cache.get_by_hash(java_file, stat, content_hash(f.read()))
+            if cached is not None:
+                # the content is unchanged, so the byte ranges hold for the current version
+                version = (stat.st_mtime_ns, stat.st_size)
+                result[java_file] = [replace(Endpoint.from_dict(item), file_version=version) for item in cached]
+        return result
+
+    def store_cached(self, java_file, endpoints, source=None):
+        # stat before reading, so a write racing with the scan is seen as a change on the next run
+        stat = os.stat(java_file)
+        if source is None:
+            with open(java_file, 'rb') as f:
+                source = f.read()
+        self.cache.put(java_file, stat, content_hash(source), [endpoint.to_dict() for endpoint in endpoints])
 
-    def analyze(self):
-        # scan package for all files
-        # based on java file
+    def find_controller_files(self):
+        """
+        scan package for all controller files, sorted so the scan order does not depend on the file system
+        """
         java_files = []
-        # scan package for all files based on java file
         for root, dirs, files in os.walk(self.dir_path):
             for file in files:
                 if file.endswith('Controller.java'):
                     java_files.append(os.path.join(root, file))
+        java_files.sort()
+        return java_files
 
-        print("all controller file = ", java_files)
-        # Now java_files contains the paths to all .java files in the directory
-        result = []
-        for java_file in java_files:
-            # You can add your analysis logic here
-            print(f"Analyzing file: {java_file}")
-            # Example: Load and parse the Java file using tree-sitter
-            parser = Parser(JAVA_LANGUAGE)
-            with open(java_file, 'r', encoding='utf-8') as f:
-                tree = parser.parse(f.read().encode('utf-8'))
-                api_information = self.find_api_endpoints(tree.root_node, java_file)
-                if len(api_information) > 0:
-                    result.extend(api_information)
-        print("api_information = ", result)
-        print(result)
+    @staticmethod
+    def file_version(java_file):
+        stat = os.stat(java_file)
+        return stat.st_mtime_ns, stat.st_size
+
+    def scan_file(self, java_file):
+        """
+        parse one Java file and return its API endpoints
+        """
+        # tree-sitter parses bytes, so read them as they are instead of decoding and encoding again
+        with span('analyze.parse', file=java_file) as current:
+            # stat before reading, so a write racing with the scan makes the endpoints look outdated
+            version = self.file_version(java_file)
+            with open(java_file, 'rb') as f:
+                source = f.read()
+            tree = self.parser.parse(source)
+            endpoints = self.find_api_endpoints(tree.root_node, java_file, version)
+            current.set(bytes=len(source), endpoints=len(endpoints))
+        return endpoints
 
-    def find_api_endpoints(self, node, java_file):
+    def reparse_file(self, java_file):
         """
-        Finds API endpoints in the given node using iteration.
+        parse a file again after it changed, reusing its previous tree through Tree.edit
+
+        tree-sitter only re-parses the edited region, so a one line change costs milliseconds
         """
+        version = self.file_version(java_file)
+        with open(java_file, 'rb') as f:
+            source = f.read()
+        previous = self.trees.get(java_file)
+        if previous is None:
+            tree = self.parser.parse(source)
+        else:
+            old_source, old_tree = previous
+            old_tree.edit(**_source_edit(old_source, source))
+            tree = self.parser.parse(source, old_tree)
+        self.trees[java_file] = (source, tree)
+        endpoints = self.find_api_endpoints(tree.root_node, java_file, version)
+        if self.cache:
+            self.store_cached(java_file, endpoints, source)
+            self.cache.commit()
+        return endpoints
+
+    def watch(self):
+        """
+        keep the endpoint table live while files change, yields the full endpoint list after every change
+
+        needs the watchfiles package, which uses inotify (or the platform equivalent) instead of polling
+        """
+        from watchfiles import Change, watch
+
+        endpoints_by_file = {java_file: self.reparse_file(java_file) for java_file in self.find_controller_files()}
+        yield [endpoint for java_file in sorted(endpoints_by_file) for endpoint in endpoints_by_file[java_file]]
+        for changes in watch(self.dir_path, watch_filter=lambda change, path: path.endswith('Controller.java')):
+            for change, path in changes:
+                # same form as the paths of find_controller_files
+                java_file = os.path.join(self.dir_path, os.path.relpath(path, os.path.abspath(self.dir_path)))
+                if change == Change.deleted:
+                    endpoints_by_file.pop(java_file, None)
+                    self.trees.pop(java_file, None)
+                    if self.cache:
+                        self.cache.remove(java_file)
+                        self.cache.commit()
+                else:
+                    endpoints_by_file[java_file] = self.reparse_file(java_file)
+            yield [endpoint for java_file in sorted(endpoints_by_file) for endpoint in endpoints_by_file[java_file]]
+
+    def find_api_endpoints(self, node, java_file, file_version=()):
+        """
+        Finds API endpoints in the given node with the precompiled ENDPOINT_QUERY.
+        """
+        class_prefixes = {}
+        methods = {}
+        parameters = {}
+        for pattern, captures in QueryCursor(ENDPOINT_QUERY).matches(node):
+            if 'class.annotation' in captures:
+                arguments = _annotation_arguments(captures['class.arguments'][0])
+                path = arguments.get('value', arguments.get('path'))
+                class_declaration = captures['class.annotation'][0].parent.parent.parent
+                class_prefixes[class_declaration.id] = _string_values(path)[0] if path else ''
+            elif 'method.annotation' in captures:
+                # a method is an endpoint once, even if it carries several mapping annotations
+                methods.setdefault(captures['method'][0].id, captures)
+            else:
+                parameter = captures['parameter'][0]
+                method = _enclosing(parameter, 'method_declaration')
+                # a parameter of a constructor or of a lambda outside any method belongs to no endpoint
+                if method is None:
+                    continue
+                parameters.setdefault(method.id, {}).setdefault(parameter.id, self.get_parameter(captures))
+
         result = []
-        nodes_to_visit = [node]
-        
-        while nodes_to_visit:
-            current_node = nodes_to_visit.pop(0)
-            
-            if current_node.type == 'method_declaration':
-                annotations = self.get_annotations(current_node)
-                for annotation in annotations:
-                    if annotation['type'] in ['RequestMapping', 'GetMapping', 'PostMapping', 'PutMapping', 'DeleteMapping']:
-                        method_name = self.get_method_name(current_node)
-                        result.append({
-                            'method': method_name,
-                            'type': annotation['type'],
-                            'api_path': annotation['path'],
-                            'file_path': java_file,
-                            # parameters
-                            # body
-                        })
-            
-            # Add all children to the queue
-            nodes_to_visit.extend(current_node.children)
-            
+        for captures in methods.values():
+            result.extend(self.get_endpoints(captures, class_prefixes, parameters, java_file, file_version))
+        result.sort(key=lambda endpoint: endpoint.start_byte)
         return result
 
-    def get_annotations(self, node):
-        """
-        Extracts annotations from a given node.
-        """
-        annotations = []
-        for child in node.children:
-            if child.type == 'modifiers':  # Change from 'annotation' to 'modifiers'
-                for modifier in child.children:  # Iterate through modifier children
-                    annotations_text = modifier.text.decode("utf-8").strip()
-                    if annotations_text.startswith('@'):  # Check if it's an annotation
-                        mapping_type = None
-                        value = None
-                        
-                        # Extract the mapping type
-                        mapping_type = annotations_text.split('@')[1].split('(')[0]
-                        
-                        # Extract the value if present
-                        if '(' in annotations_text and ')' in annotations_text:
-                            value = annotations_text.split('(')[1].split(')')[0]
-                        else:
-                            value = ""
-                        
-                        if mapping_type in ['RequestMapping', 'GetMapping', 'PostMapping', 'PutMapping', 'DeleteMapping']:
-                            annotations.append({'type': mapping_type, 'path': value})
-        return annotations
-
-    def get_annotation_value(self, node):
-        value_node = node.child_by_field_name('value')
-        if value_node:
-            return value_node.text.decode('utf-8').strip('"')
-        return ""
-
-    def get_method_name(self, node):
-        name_node = node.child_by_field_name('name')
-        if name_node:
-            return name_node.text.decode('utf-8')
-        return ""
+    def get_endpoints(self, captures, class_prefixes, parameters, java_file, file_version=()):
+        """
+        build one endpoint record per path and HTTP method of a mapped method
+        """
+        method = captures['method'][0]
+        annotation = _text(captures['method.annotation'][0])
+        arguments = _annotation_arguments(captures.get('method.arguments', [None])[0])
+        path_node = arguments.get('value', arguments.get('path'))
+        paths = _string_values(path_node) if path_node else ['']
+        if 'method' in arguments:
+            http_methods = [value.rsplit('.', 1)[-1] for value in _string_values(arguments['method'])]
+        else:
+            http_methods = [MAPPING_HTTP_METHODS[annotation]]
+
+        class_declaration = _enclosing(method, 'class_declaration')
+        class_name = _text(class_declaration.child_by_field_name('name')) if class_declaration else ''
+        class_prefix = class_prefixes.get(class_declaration.id, '') if class_declaration else ''
+        return [
+            Endpoint(
+                method=_text(captures['method.name'][0]),
+                type=annotation,
+                http_method=http_method,
+                path=path,
+                api_path=_join_path(class_prefix, path),
+                class_name=class_name,
+                class_prefix=class_prefix,
+                file_path=java_file,
+                parameters=tuple(parameters.get(method.id, {}).values()),
+                start_byte=method.start_byte,
+                end_byte=method.end_byte,
+                file_version=file_version,
+            )
+            for path in paths
+            for http_method in http_methods
+        ]
+
+    def get_parameter(self, captures):
+        """
+        build a parameter record, the name given in the annotation wins over the Java parameter name
+        """
+        annotation = _text(captures['parameter.annotation'][0])
+        arguments = _annotation_arguments(captures.get('parameter.arguments', [None])[0])
+        name_node = arguments.get('value', arguments.get('name'))
+        name = _string_values(name_node)[0] if name_node else _text(captures['parameter.name'][0])
+        return EndpointParameter(
+            name=name,
+            type=_text(captures['parameter.type'][0]),
+            source=PARAMETER_SOURCES[annotation],
+        )
+
+
+# per worker process analyzer, created once by _init_worker so every worker keeps one parser
+_worker_api = None
+
+
+def _init_worker(dir_path):
+    global _worker_api
+    _worker_api = AnalyzeAPI(dir_path)
+
+
+def _scan_file(java_file):
+    return _worker_api.scan_file(java_file)
+
 
 if __name__ == '__main__':
-    api = AnalyzeAPI(dir_path='')
-    api.analyze()
+    arg_parser = argparse.ArgumentParser(description="find API endpoints in Spring Boot controllers")
+    arg_parser.add_argument('dir_path', nargs='?', default='')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    arg_parser.add_argument('--cache', help="SQLite file caching endpoints of unchanged files")
+    arg_parser.add_argument('--watch', action='store_true', help="keep watching the files and print the endpoint table")
+    arg_parser.add_argument('--trace', help="write a Chrome trace of the scan to this JSON file")
+    args = arg_parser.parse_args()
+    if args.trace:
+        enable_tracing()
+    api = AnalyzeAPI(dir_path=args.dir_path, cache_path=args.cache)
+    if args.watch:
+        for endpoints in api.watch():
+            print(f"{len(endpoints)} endpoints")
+            for endpoint in endpoints:
+                print(f"  {endpoint.http_method:6} {endpoint.api_path}  {endpoint.class_name}.{endpoint.method}")
+    else:
+        api.analyze(workers=args.workers)
+        if args.trace:
+            export_trace(args.trace)
@@ -0,0 +1,201 @@
+import asyncio
+from collections import deque
+
+from tracing import span
+from integration_test_code.context_packer import CHARS_PER_TOKEN, estimate_tokens
+
+__doc__ = """
+conversation memory with a hard token budget, for long generation sessions
+
+the prompt context is the pinned artifacts (the example test template, conventions learned earlier), a rolling
+summary and the most recent turns. turns that no longer fit are evicted oldest first and folded into the
+summary by a background task, a prompt never waits for the summarizer and always uses the latest finished
+summary. pinned artifacts and the summary have budgets of their own, so the context never grows over
+token_budget however many tests a session generates. evicted turns waiting for the summarizer are capped at
+backlog_tokens, the oldest are dropped when the summarizer falls behind.
+"""
+
+SUMMARY_HEADER = "summary of earlier work:\n"
+
+SUMMARY_PROMPT = """
+Progressively summarize this test generation session, keep decisions and conventions that later tests should follow.
+
+Current summary:
+{summary}
+
+New lines:
+{lines}
+
+Return the new summary in at most {tokens} tokens.
+"""
+
+
+def truncate_tokens(text, tokens, count_tokens=estimate_tokens):
+    if count_tokens(text) <= tokens:
+        return text
+    return text[:tokens * CHARS_PER_TOKEN].rsplit('\n', 1)[0]
+
+
+def llm_summarizer(llm, summary_tokens):
+    """
+    async summarize(summary, turns) backed by a LangChain chat model
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import PromptTemplate
+
+    chain = PromptTemplate.from_template(SUMMARY_PROMPT) | llm | StrOutputParser()
+
+    async def summarize(summary, turns):
+        lines = '\n'.join(f"{role}: {text}" for role, text in turns)
+        return await chain.ainvoke({'summary': summary or '(empty)', 'lines': lines, 'tokens': summary_tokens})
+
+    return summarize
+
+
+class BoundedMemory:
+    def __init__(self, token_budget=2000, summary_tokens=300, pinned_tokens=800, summarize=None,
+                 count_tokens=estimate_tokens, backlog_tokens=None):
+        if summary_tokens + pinned_tokens >= token_budget:
+            raise ValueError("token_budget has to leave room for recent turns next to summary and pinned artifacts")
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.pinned_tokens = pinned_tokens
+        self.summarize = summarize
+        self.count_tokens = count_tokens
+        # name -> text, in the order they were pinned
+        self.pinned = {}
+        self.summary = ''
+        # (role, text, tokens) of the turns in the context, oldest first
+        self.turns = deque()
+        self.turn_tokens = 0
+        # (role, text, tokens) of the evicted turns waiting for the summarizer, at most backlog_tokens
+        self.evicted = []
+        self.backlog_tokens = backlog_tokens or token_budget
+        self.task = None
+        self.summaries = 0
+        # evicted turns dropped without being summarized
+        self.dropped = 0
+
+    @property
+    def turn_budget(self):
+        # the summary budget is reserved even while the summary is short, so the context size does not creep up.
+        # one token per part for the blank lines between pinned artifacts, summary and turns
+        return self.token_budget - self.summary_tokens - self.pinned_tokens - 2
+
+    def pin(self, name, text):
+        """
+        keep text in every context, such as the example test template, replaces an artifact of the same name
+        """
+        self.pinned[name] = text
+
+    def add_convention(self, convention):
+        """
+        pin a convention learned during the session, the oldest conventions go once the pinned budget is full
+        """
+        conventions = [line for line in self.pinned.get('conventions', '').split('\n') if line]
+        if convention in conventions:
+            return
+        conventions.append(convention)
+        others = sum(self.count_tokens(text) for name, text in self.pinned.items() if name != 'conventions')
+        while conventions[1:] and others + self.count_tokens('\n'.join(conventions)) > self.pinned_tokens:
+            conventions.pop(0)
+        self.pinned['conventions'] = '\n'.join(conventions)
+
+    def add(self, role, text):
+        text = truncate_tokens(text, self.turn_budget - self.count_tokens(role) - 1, self.count_tokens)
+        # counted as it appears in the context, with the role and the line break
+        tokens = self.count_tokens(f"{role}: {text}\n")
+        self.turns.append((role, text, tokens))
+        self.turn_tokens += tokens
+        evicted = []
+        while self.turn_tokens > self.turn_budget:
+            turn = self.turns.popleft()
+            self.turn_tokens -= turn[2]
+            evicted.append(turn)
+        self.queue(evicted)
+        if self.evicted:
+            self.schedule_summary()
+
+    def add_turn(self, user, assistant):
+        self.add('user', user)
+        self.add('assistant', assistant)
+
+    def queue(self, turns):
+        """
+        add evicted turns to the summarizer backlog, the oldest go once it is over backlog_tokens
+        """
+        self.evicted.extend(turns)
+        tokens = sum(tokens for _, _, tokens in self.evicted)
+        while len(self.evicted) > 1 and tokens > self.backlog_tokens:
+            tokens -= self.evicted.pop(0)[2]
+            self.dropped += 1
+
+    def schedule_summary(self):
+        """
+        start the background summarizer when there is none running, needs a running event loop
+        """
+        if self.summarize is None:
+            # without a summarizer evicted turns are forgotten
+            self.evicted.clear()
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # summarized by the next add or flush that runs inside a loop
+            return
+        if self.task is not None and not self.task.done() and self.task.get_loop() is loop:
+            return
+        self.task = loop.create_task(self._summarize())
+
+    async def _summarize(self):
+        while self.evicted:
+            turns, self.evicted = self.evicted, []
+            with span('memory.summarize', turns=len(turns)):
+                try:
+                    summary = await self.summarize(self.summary, [(role, text) for role, text, _ in turns])
+                except asyncio.CancelledError:
+                    # the loop closed, such as at the end of asyncio.run, the next loop summarizes them
+                    evicted, self.evicted = self.evicted, []
+                    self.queue(turns + evicted)
+                    raise
+                except Exception as e:
+                    # the summary stays as it was, a failing summarizer must not break generation
+                    print(f"memory summary failed: {e!r}")
+                    continue
+            self.summary = truncate_tokens(summary.strip(), self.summary_tokens - self.count_tokens(SUMMARY_HEADER),
+                                           self.count_tokens)
+            self.summaries += 1
+
+    async def flush(self):
+        """
+        wait until every evicted turn is part of the summary
+        """
+        self.schedule_summary()
+        if self.task is not None and self.task.get_loop() is asyncio.get_running_loop():
+            await self.task
+
+    def context(self):
+        """
+        the text to put into the next prompt, at most token_budget tokens
+        """
+        parts = []
+        pinned = '\n\n'.join(f"{name}:\n{text}" for name, text in self.pinned.items())
+        if pinned:
+            parts.append(truncate_tokens(pinned, self.pinned_tokens, self.count_tokens))
+        if self.summary:
+            parts.append(SUMMARY_HEADER + self.summary)
+        if self.turns:
+            parts.append('\n'.join(f"{role}: {text}" for role, text, _ in self.turns))
+        return '\n\n'.join(parts)
+
+    def stats(self):
+        return {
+            'turns': len(self.turns),
+            'turn_tokens': self.turn_tokens,
+            'summary_tokens': self.count_tokens(self.summary),
+            'pinned_tokens': sum(self.count_tokens(text) for text in self.pinned.values()),
+            'context_tokens': self.count_tokens(self.context()),
+            'pending': len(self.evicted),
+            'summaries': self.summaries,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,219 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+from tree_sitter import Parser
+
+from integration_test_code.analyze_api import JAVA_LANGUAGE
+
+__doc__ = """
+pack the prompt context of one endpoint into a token budget
+
+instead of whole files the prompt gets tree-sitter slices: the endpoint method inside its class header and
+the controller fields (the beans a test has to mock), the fields of request classes with their validation
+annotations, the imports those slices use, and the example test. sections are added by priority and the
+ones that do not fit into the budget are truncated or dropped.
+"""
+
+CHARS_PER_TOKEN = 4
+
+# lower is more important
+ENDPOINT_PRIORITY = 0
+REQUEST_CLASS_PRIORITY = 1
+IMPORTS_PRIORITY = 2
+EXAMPLE_PRIORITY = 3
+NESTED_CLASS_PRIORITY = 4
+
+# a section is only truncated when at least this many tokens of it still fit
+MIN_TRUNCATED_TOKENS = 64
+
+IDENTIFIER = re.compile(r'[A-Za-z_$][\w$]*')
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@dataclass
+class ContextSection:
+    name: str
+    text: str
+    priority: int
+    tokens: int = 0
+
+
+@dataclass
+class PackedContext:
+    sections: list[ContextSection]
+    tokens: int
+    truncated: list[str] = field(default_factory=list)
+    dropped: list[str] = field(default_factory=list)
+
+    def text(self, prefix):
+        """
+        text of all sections whose name starts with prefix, in packing order
+        """
+        return '\n\n'.join(section.text for section in self.sections if section.name.startswith(prefix))
+
+
+class ContextPacker:
+    def __init__(self, symbol_index, token_budget=6000, count_tokens=estimate_tokens):
+        self.symbol_index = symbol_index
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.parser = Parser(JAVA_LANGUAGE)
+        # (mtime, size, source, tree) of every controller packed so far, endpoints of one controller share them
+        self.files = {}
+
+    def pack(self, endpoint, example_code='', shared_classes=(), token_budget=None):
+        """
+        context of one endpoint, classes in shared_classes are left out because the shared prefix has them
+        """
+        sections = [ContextSection('endpoint', self.endpoint_slice(endpoint), ENDPOINT_PRIORITY)]
+        used_classes = []
+        for parameter in endpoint.parameters:
+            for java_class in self.symbol_index.resolve_type(parameter.type, endpoint.file_path):
+                if java_class not in used_classes:
+                    used_classes.append(java_class)
+                    if java_class not in shared_classes:
+                        sections.append(ContextSection(
+                            f"class:{java_class.name}", self.class_slice(java_class), REQUEST_CLASS_PRIORITY))
+        # classes used by fields of the request classes, such as an AddressRequest inside UserRequest
+        for java_class in list(used_classes):
+            for java_field in java_class.fields:
+                for nested in self.symbol_index.resolve_type(java_field.type, java_class.file_path):
+                    if nested not in used_classes and nested not in shared_classes:
+                        used_classes.append(nested)
+                        sections.append(ContextSection(
+                            f"class:{nested.name}", self.class_slice(nested), NESTED_CLASS_PRIORITY))
+        files = [endpoint.file_path] + [java_class.file_path for java_class in used_classes
+                                        if java_class not in shared_classes]
+        imports = self.used_imports(files, [section.text for section in sections])
+        if imports:
+            sections.append(ContextSection('imports', imports, IMPORTS_PRIORITY))
+        if example_code:
+            sections.append(ContextSection('example', example_code, EXAMPLE_PRIORITY))
+        return self.fit(sections, token_budget)
+
+    def pack_shared(self, shared_classes, example_code='', token_budget=None):
+        """
+        the context endpoints with the same request classes share: the example test, the class slices and
+        their imports. it depends on nothing else, so it is byte identical for every endpoint of a group
+        """
+        classes = sorted(shared_classes, key=lambda java_class: (java_class.name, java_class.file_path))
+        sections = [ContextSection('example', example_code, EXAMPLE_PRIORITY)] if example_code else []
+        class_sections = [ContextSection(f"class:{java_class.name}", self.class_slice(java_class),
+                                         REQUEST_CLASS_PRIORITY) for java_class in classes]
+        imports = self.used_imports([java_class.file_path for java_class in classes],
+                                    [section.text for section in class_sections])
+        if imports:
+            sections.append(ContextSection('imports', imports, IMPORTS_PRIORITY))
+        return self.fit(sections + class_sections, token_budget)
+
+    def fit(self, sections, token_budget=None):
+        """
+        add sections by priority until the budget is used up, keeping their original order in the result
+        """
+        for section in sections:
+            section.tokens = self.count_tokens(section.text)
+        remaining = self.token_budget if token_budget is None else token_budget
+        kept = set()
+        truncated = []
+        dropped = []
+        for section in sorted(sections, key=lambda section: section.priority):
+            if section.tokens <= remaining:
+                kept.add(id(section))
+                remaining -= section.tokens
+            elif remaining >= MIN_TRUNCATED_TOKENS or section.priority == ENDPOINT_PRIORITY:
+                section.text = self.truncate(section.text, remaining)
+                section.tokens = self.count_tokens(section.text)
+                kept.add(id(section))
+                truncated.append(section.name)
+                remaining -= section.tokens
+            else:
+                dropped.append(section.name)
+        result = [section for section in sections if id(section) in kept]
+        return PackedContext(result, sum(section.tokens for section in result), truncated, dropped)
+
+    def truncate(self, text, tokens):
+        lines = []
+        used = 0
+        for line in text.splitlines(keepends=True):
+            line_tokens = self.count_tokens(line)
+            if used + line_tokens > tokens:
+                break
+            lines.append(line)
+            used += line_tokens
+        return ''.join(lines)
+
+    def parse(self, file_path):
+        stat = os.stat(file_path)
+        cached = self.files.get(file_path)
+        # a controller edited since it was parsed is parsed again, APIGenerator.current scans its endpoints again
+        # so their byte ranges refer to the new source
+        if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(file_path, 'rb') as f:
+                source = f.read()
+            cached = self.files[file_path] = (stat.st_mtime_ns, stat.st_size, source, self.parser.parse(source))
+        return cached[2:]
+
+    def endpoint_slice(self, endpoint):
+        """
+        the endpoint method inside its class header, with the package and the fields of the controller
+        """
+        source, tree = self.parse(endpoint.file_path)
+        method = tree.root_node.descendant_for_byte_range(endpoint.start_byte, endpoint.end_byte)
+        while method is not None and method.type != 'method_declaration':
+            method = method.parent
+        if method is None:
+            return source[endpoint.start_byte:endpoint.end_byte].decode('utf-8', errors='replace')
+        class_node = method.parent
+        while class_node is not None and class_node.type != 'class_declaration':
+            class_node = class_node.parent
+        if class_node is None:
+            return source[endpoint.start_byte:endpoint.end_byte].decode('utf-8')
+
+        body = class_node.child_by_field_name('body')
+        header = source[class_node.start_byte:body.start_byte].decode('utf-8').rstrip()
+        controller = next((java_class for java_class in self.symbol_index.by_file.get(endpoint.file_path, [])
+                           if java_class.name == endpoint.class_name), None)
+        parts = []
+        if controller and controller.package_name:
+            parts.append(f"package {controller.package_name};\n\n")
+        parts.append(header + ' {\n')
+        for java_field in controller.fields if controller else ():
+            parts.append(f"    {java_field.source}\n")
+        indent = ' ' * method.start_point[1]
+        parts.append(f"\n{indent}{source[method.start_byte:method.end_byte].decode('utf-8')}\n}}")
+        return ''.join(parts)
+
+    def class_slice(self, java_class):
+        """
+        a request type reduced to its declaration header, enum constants and fields with their validation
+        annotations, without methods. the header keeps the kind, type parameters and record components
+        """
+        lines = []
+        if java_class.package_name:
+            lines.append(f"package {java_class.package_name};\n")
+        lines.append(f"{java_class.header or 'public class ' + java_class.name} {{")
+        if java_class.constants:
+            lines.append(f"    {', '.join(java_class.constants)};")
+        lines.extend(f"    {java_field.source}" for java_field in java_class.fields)
+        lines.append("}")
+        return '\n'.join(lines)
+
+    def used_imports(self, files, texts):
+        """
+        imports of the files, such as the controller and request classes, whose simple name occurs in the slices
+        """
+        identifiers = set()
+        for text in texts:
+            identifiers.update(IDENTIFIER.findall(text))
+        result = []
+        for file_path in files:
+            classes = self.symbol_index.by_file.get(file_path, [])
+            for imported in classes[0].imports if classes else ():
+                name = imported.rsplit('.', 1)[-1]
+                if (name == '*' or name in identifiers) and imported not in result:
+                    result.append(imported)
+        return '\n'.join(f"import {imported};" for imported in result)
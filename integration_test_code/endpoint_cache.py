@@ -0,0 +1,85 @@
+import hashlib
+import json
+import sqlite3
+
+__doc__ = """
+SQLite cache of extracted API endpoints, keyed by file path and content hash
+
+a file whose size and modification time did not change is answered without reading it,
+a file that was touched but has the same content is answered after hashing it,
+only files with new content have to be parsed again
+
+endpoints are stored as the JSON of their dict form, see Endpoint.to_dict and Endpoint.from_dict
+"""
+
+
+def content_hash(source):
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+
+class EndpointCache:
+    def __init__(self, db_path='.endpoint_cache.sqlite3'):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                endpoints TEXT NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get_by_stat(self, path, stat):
+        """
+        endpoint dicts of a file whose size and modification time match the cached entry, otherwise None
+        """
+        row = self.connection.execute(
+            "SELECT endpoints FROM files WHERE path = ? AND mtime_ns = ? AND size = ?",
+            (path, stat.st_mtime_ns, stat.st_size)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_hash(self, path, stat, digest):
+        """
+        endpoint dicts of a file whose content hash matches the cached entry, otherwise None
+
+        the stored stat is refreshed on a hit so the next lookup does not have to hash the file again
+        """
+        row = self.connection.execute(
+            "SELECT endpoints FROM files WHERE path = ? AND hash = ?", (path, digest)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?", (stat.st_mtime_ns, stat.st_size, path)
+        )
+        return json.loads(row[0])
+
+    def put(self, path, stat, digest, endpoints):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, mtime_ns, size, hash, endpoints) VALUES (?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, digest, json.dumps(endpoints))
+        )
+
+    def remove(self, path):
+        self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def prune(self, existing_paths):
+        """
+        drop entries of files that are no longer part of the scan
+        """
+        existing_paths = set(existing_paths)
+        stale = [path for (path,) in self.connection.execute("SELECT path FROM files") if path not in existing_paths]
+        self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in stale])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from typing import Optional
+
+from llama_index.core.workflow import Event, StartEvent, StopEvent, Workflow, step
+from tree_sitter import Parser
+
+from tracing import enable_tracing, export_trace, span
+from integration_test_code.agent_api_generate import APIGenerator, APIInformation
+from integration_test_code.analyze_api import JAVA_LANGUAGE, Endpoint
+from integration_test_code.model_router import ModelRouter, extract_java, syntax_errors
+
+__doc__ = """
+resumable integration test generation as a LlamaIndex Workflow
+
+endpoint -> dependency resolution -> context packing -> generation -> validation, every step stores the
+payload of the event it emits under checkpoint_dir/<run id>/<step>.json before the next step starts. a rerun
+of the same endpoint, prompt and model loads the stored events and continues at the first step without a
+checkpoint, so a crash during validation no longer throws away the finished 32B generation.
+the run id is a hash of the endpoint, the requirements, the model and the contents of the controller, its
+request classes and the example test, so editing any of them starts a new run.
+
+    python -m integration_test_code.generation_workflow spring-request/src/main/java/pro/demo/springrequest/UserController.java
+"""
+
+DEFAULT_CHECKPOINT_DIR = '.workflow_checkpoints'
+
+
+class EndpointEvent(Event):
+    run_dir: str
+    endpoint: dict
+    requirements: Optional[str] = None
+
+
+class DependenciesEvent(Event):
+    run_dir: str
+    endpoint: dict
+    requirements: Optional[str] = None
+    api_information: dict
+
+
+class ContextEvent(Event):
+    run_dir: str
+    endpoint: dict
+    message: str
+
+
+class GenerationEvent(Event):
+    run_dir: str
+    endpoint: dict
+    response: str
+
+
+def content_hash(texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(hashlib.sha256(text.encode('utf-8')).digest())
+    return digest.hexdigest()
+
+
+def run_id(endpoint, requirements, model, sources=()):
+    # the file version changes when the controller is only touched, its content is part of sources
+    identity = {key: value for key, value in endpoint.to_dict().items() if key != 'file_version'}
+    payload = json.dumps([identity, requirements, model, content_hash(sources)], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class GenerationWorkflow(Workflow):
+    def __init__(self, generator=None, checkpoint_dir=DEFAULT_CHECKPOINT_DIR, model=None,
+                 output_dir='generated_tests', example_code=None, **kwargs):
+        super().__init__(**kwargs)
+        self.generator = generator or APIGenerator()
+        self.checkpoint_dir = checkpoint_dir
+        # the generation tiers of the generator's router, a single model when one is given
+        self.router = ModelRouter({'generation': [model]}) if model else self.generator.router
+        self.model = ','.join(self.router.models('generation'))
+        self.output_dir = output_dir
+        self.example_code = example_code
+        self.parser = Parser(JAVA_LANGUAGE)
+        # steps loaded from a checkpoint in this process, to report what a rerun skipped
+        self.resumed = []
+
+    def load_example(self):
+        return self.example_code if self.example_code is not None else self.generator.load_example_code()
+
+    def sources(self, endpoint):
+        """
+        texts the generated test depends on: the controller, the files of its request classes and the example
+        """
+        paths = [endpoint.file_path]
+        for java_class in self.generator.request_classes(endpoint):
+            if java_class.file_path not in paths:
+                paths.append(java_class.file_path)
+        texts = []
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                texts.append(f.read())
+        return texts + [self.load_example()]
+
+    def checkpoint_path(self, run_dir, name):
+        return os.path.join(run_dir, name + '.json')
+
+    def load_checkpoint(self, run_dir, name, event_class):
+        path = self.checkpoint_path(run_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            event = event_class(**json.load(f))
+        self.resumed.append(name)
+        return event
+
+    def save_checkpoint(self, run_dir, name, event):
+        path = self.checkpoint_path(run_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(event.model_dump(), f)
+        # a crash while writing leaves the previous state, never half a checkpoint
+        os.replace(tmp_path, path)
+        return event
+
+    @step
+    async def endpoint(self, ev: StartEvent) -> EndpointEvent:
+        endpoint = ev.endpoint
+        requirements = ev.get('requirements')
+        run_dir = os.path.join(self.checkpoint_dir, run_id(endpoint, requirements, self.model,
+                                                              self.sources(endpoint)))
+        os.makedirs(run_dir, exist_ok=True)
+        return (self.load_checkpoint(run_dir, 'endpoint', EndpointEvent)
+                or self.save_checkpoint(run_dir, 'endpoint', EndpointEvent(
+                    run_dir=run_dir, endpoint=endpoint.to_dict(), requirements=requirements)))
+
+    @step
+    async def dependencies(self, ev: EndpointEvent) -> DependenciesEvent:
+        cached = self.load_checkpoint(ev.run_dir, 'dependencies', DependenciesEvent)
+        if cached:
+            return cached
+        api_information = await self.generator.afind_api_relation_code(Endpoint.from_dict(ev.endpoint))
+        return self.save_checkpoint(ev.run_dir, 'dependencies', DependenciesEvent(
+            run_dir=ev.run_dir, endpoint=ev.endpoint, requirements=ev.requirements,
+            api_information=api_information.model_dump()))
+
+    @step
+    async def context(self, ev: DependenciesEvent) -> ContextEvent:
+        cached = self.load_checkpoint(ev.run_dir, 'context', ContextEvent)
+        if cached:
+            return cached
+        message = self.generator.build_message(Endpoint.from_dict(ev.endpoint), APIInformation(**ev.api_information),
+                                               self.load_example(), ev.requirements)
+        return self.save_checkpoint(ev.run_dir, 'context', ContextEvent(
+            run_dir=ev.run_dir, endpoint=ev.endpoint, message=message))
+
+    @step
+    async def generation(self, ev: ContextEvent) -> GenerationEvent:
+        cached = self.load_checkpoint(ev.run_dir, 'generation', GenerationEvent)
+        if cached:
+            return cached
+        response = await self.router.agenerate('generation', [{"role": "user", "content": ev.message}])
+        return self.save_checkpoint(ev.run_dir, 'generation', GenerationEvent(
+            run_dir=ev.run_dir, endpoint=ev.endpoint, response=response))
+
+    @step
+    async def validation(self, ev: GenerationEvent) -> StopEvent:
+        path = self.checkpoint_path(ev.run_dir, 'validation')
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            if os.path.exists(result['output_path']):
+                self.resumed.append('validation')
+                return StopEvent(result={**result, 'resumed': list(self.resumed)})
+        endpoint = Endpoint.from_dict(ev.endpoint)
+        code = extract_java(ev.response)
+        with span('workflow.validate', api_path=endpoint.api_path) as current:
+            errors = syntax_errors(code, self.parser)
+            current.set(errors=len(errors))
+        os.makedirs(self.output_dir, exist_ok=True)
+        output_path = self.generator.output_paths([endpoint], self.output_dir, extension='.java')[0]
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(code)
+        result = {'api_path': endpoint.api_path, 'output_path': output_path, 'ok': not errors,
+                  'syntax_errors': errors, 'resumed': list(self.resumed)}
+        # only a valid result completes the run, an invalid response is dropped and generated again on the next run
+        if not errors:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+        else:
+            os.remove(self.checkpoint_path(ev.run_dir, 'generation'))
+        return StopEvent(result=result)
+
+
+async def generate_file(file_path, project_dir='spring-request', checkpoint_dir=DEFAULT_CHECKPOINT_DIR,
+                        model=None, output_dir='generated_tests', requirements=None, timeout=1800.0):
+    """
+    run the workflow for every endpoint of a controller, one after the other
+    """
+    generator = APIGenerator(project_dir)
+    example_code = generator.load_example_code()
+    results = []
+    for endpoint in generator.analyzer.scan_file(file_path):
+        workflow = GenerationWorkflow(generator, checkpoint_dir, model, output_dir, example_code, timeout=timeout)
+        result = await workflow.run(endpoint=endpoint, requirements=requirements)
+        status = 'ok    ' if result['ok'] else 'invalid'
+        print(f"{status} {endpoint.http_method:6} {endpoint.api_path} -> {result['output_path']}"
+              + (f" (resumed {', '.join(result['resumed'])})" if result['resumed'] else '')
+              + (f" syntax errors at {result['syntax_errors']}" if result['syntax_errors'] else ''))
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="resumable integration test generation")
+    arg_parser.add_argument('file_path', help="controller file")
+    arg_parser.add_argument('--project-dir', default='spring-request')
+    arg_parser.add_argument('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR)
+    arg_parser.add_argument('--output-dir', default='generated_tests')
+    arg_parser.add_argument('--model', help="generate with this model instead of the generation tiers")
+    arg_parser.add_argument('--draw', help="write the workflow graph to this HTML file and exit")
+    arg_parser.add_argument('--trace', help="write a Chrome trace of the run to this JSON file")
+    args = arg_parser.parse_args()
+    if args.draw:
+        from llama_index.utils.workflow import draw_all_possible_flows
+        draw_all_possible_flows(GenerationWorkflow, filename=args.draw)
+        raise SystemExit(0)
+    if args.trace:
+        enable_tracing()
+    asyncio.run(generate_file(args.file_path, args.project_dir, args.checkpoint_dir, args.model, args.output_dir))
+    if args.trace:
+        export_trace(args.trace)
@@ -1,45 +1,81 @@
+import asyncio
+import hashlib
+
 from langchain.chains.llm import LLMChain
 from langchain.chains.sequential import SequentialChain
-from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
 from langchain_community.chat_models import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 
+from llm_cache import cache_key, default_cache, langchain_cache
+from tracing import span
+from integration_test_code.bounded_memory import BoundedMemory, llm_summarizer
+
+__doc__ = """
+analysis -> test design -> code generation chain for a unit of code
+
+the analysis depends only on the code, so it is stored under a hash of the code (with the model and the
+analysis prompt) in the shared on-disk cache and computed once per code unit, also across runs. concurrent
+requests for the same code share one in-flight analysis. generate_many runs the design and generation
+stages of every requirement set concurrently from that one analysis, N requirement sets cost 1 + 2N
+model calls instead of 3N, with the N design -> generation pairs running in parallel.
+
+the generation prompt carries a BoundedMemory of the session: the pinned example test and conventions, a
+rolling summary and the latest designs, so its size stays the same however many tests are generated.
+"""
+
+
+def code_hash(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
 
 class TestGenerator:
-    def __init__(self):
-        # 保持对话上下文，记住之前的测试生成逻辑
-        self.memory = ConversationBufferMemory()
-        # 或使用总结记忆，处理长对话
-        self.summary_memory = ConversationSummaryMemory()
-        self.llm = ChatOpenAI(temperature=0.1)
-        self.memory = ConversationBufferMemory()
+    def __init__(self, use_cache=True, concurrency=4, memory_tokens=2000, summary_tokens=300, pinned_tokens=800,
+                 example_template=None):
+        self.llm = ChatOpenAI(temperature=0.1, cache=langchain_cache() if use_cache else False)
+        # 保持对话上下文，记住之前的测试生成逻辑；超出预算的旧对话在后台合并进摘要
+        self.memory = BoundedMemory(memory_tokens, summary_tokens, pinned_tokens,
+                                    summarize=llm_summarizer(self.llm, summary_tokens))
+        if example_template:
+            self.memory.pin('example test', example_template)
+        self.use_cache = use_cache
         self.code_analysis_prompt = self.create_code_analysis_prompt()
         self.test_design_prompt = self.create_test_design_prompt()
         self.code_generation_prompt = self.create_code_generation_prompt()
+        self.analyze_chain = LLMChain(llm=self.llm, prompt=self.code_analysis_prompt, output_key="analysis")
+        self.design_chain = LLMChain(llm=self.llm, prompt=self.test_design_prompt, output_key="design")
+        self.generate_chain = LLMChain(llm=self.llm, prompt=self.code_generation_prompt, output_key="test_code")
+        # design -> generation pairs of generate_many running at the same time
+        self.concurrency = concurrency
+        # code hash -> task of the analysis being computed, shared by concurrent requests for the same code
+        self.pending_analyses = {}
 
     def create_test_chain(self):
         # 1. 代码分析链
         analyze_chain = LLMChain(
             llm=self.llm,
-            prompt=self.code_analysis_prompt
+            prompt=self.code_analysis_prompt,
+            output_key="analysis"
         )
 
         # 2. 测试设计链
         design_chain = LLMChain(
             llm=self.llm,
-            prompt=self.test_design_prompt
+            prompt=self.test_design_prompt,
+            output_key="design"
         )
 
         # 3. 代码生成链
         generate_chain = LLMChain(
             llm=self.llm,
-            prompt=self.code_generation_prompt
+            prompt=self.code_generation_prompt,
+            output_key="test_code"
         )
 
         # 串联所有处理步骤
         return SequentialChain(
             chains=[analyze_chain, design_chain, generate_chain],
-            input_variables=["code", "requirements"]
+            input_variables=["code", "requirements"],
+            output_variables=["analysis", "design", "test_code"]
         )
 
     def create_code_analysis_prompt(self):
@@ -51,4 +87,107 @@ class TestGenerator:
             input_variables=["code"]
         )
 
-    
\ No newline at end of file
+    def create_test_design_prompt(self):
+        return PromptTemplate(
+            template="""
+            Based on this analysis of the code:
+            {analysis}
+
+            Design the test cases for the following requirements:
+            {requirements}
+
+            List every test case with its input, the mocked dependencies and the expected result.
+            """,
+            input_variables=["analysis", "requirements"]
+        )
+
+    def create_code_generation_prompt(self):
+        return PromptTemplate(
+            template="""
+            Code:
+            {code}
+
+            Test design:
+            {design}
+
+            Session context:
+            {memory}
+
+            Generate the complete test class implementing every test case of the design.
+            """,
+            input_variables=["code", "design"],
+            # read when the prompt is formatted, every generation sees the memory as it is at that moment
+            partial_variables={"memory": self.memory.context}
+        )
+
+    def analysis_key(self, code):
+        """
+        memo key of the analysis: the code hash, the model settings and the analysis prompt
+        """
+        return cache_key('analysis', [{'code_sha256': code_hash(code), 'llm': self.llm._get_llm_string(),
+                                       'prompt': self.code_analysis_prompt.template}])
+
+    async def aanalyze(self, code):
+        key = self.analysis_key(code)
+        if key not in self.pending_analyses:
+            self.pending_analyses[key] = asyncio.ensure_future(self._analyze(key, code))
+        try:
+            return await self.pending_analyses[key]
+        finally:
+            # finished analyses are served by the memo, a failed one is computed again on the next request
+            task = self.pending_analyses.get(key)
+            if task is not None and task.done():
+                del self.pending_analyses[key]
+
+    async def _analyze(self, key, code):
+        with span('generator.analysis', code_bytes=len(code)) as current:
+            analysis = default_cache().get(key) if self.use_cache else None
+            current.set(memo_hit=analysis is not None)
+            if analysis is None:
+                analysis = (await self.analyze_chain.ainvoke({"code": code}))["analysis"]
+                if self.use_cache:
+                    default_cache().put(key, analysis)
+        return analysis
+
+    async def agenerate(self, code, requirements, analysis=None):
+        """
+        design and generate the test of code for one requirement set, from the memoized analysis
+        """
+        analysis = analysis if analysis is not None else await self.aanalyze(code)
+        with span('generator.design'):
+            design = (await self.design_chain.ainvoke({"analysis": analysis, "requirements": requirements}))["design"]
+        with span('generator.generate'):
+            test_code = (await self.generate_chain.ainvoke({"code": code, "design": design}))["test_code"]
+        self.memory.add_turn(requirements, design)
+        return {"analysis": analysis, "design": design, "test_code": test_code}
+
+    async def agenerate_many(self, code, requirements_list):
+        """
+        one analysis of code, then design and generation of every requirement set concurrently
+        """
+        analysis = await self.aanalyze(code)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def generate(requirements):
+            async with semaphore:
+                return await self.agenerate(code, requirements, analysis)
+
+        return await asyncio.gather(*(generate(requirements) for requirements in requirements_list))
+
+    def add_convention(self, convention):
+        """
+        pin a convention, such as "use MockMvc with @WebMvcTest", for every later generation
+        """
+        self.memory.add_convention(convention)
+
+    async def _run(self, coroutine):
+        result = await coroutine
+        # asyncio.run cancels the tasks still running when it returns, the summary has to finish before
+        await self.memory.flush()
+        return result
+
+    def generate(self, code, requirements):
+        return asyncio.run(self._run(self.agenerate(code, requirements)))
+
+    def generate_many(self, code, requirements_list):
+        return asyncio.run(self._run(self.agenerate_many(code, requirements_list)))
@@ -0,0 +1,305 @@
+import argparse
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from tree_sitter import Parser
+
+from llm_cache import achat, cache_key, chat, default_cache
+from tracing import span
+from integration_test_code.analyze_api import JAVA_LANGUAGE
+from integration_test_code.streaming import ThinkFilter
+
+__doc__ = """
+route model calls by task to tiers of models, cheapest first
+
+every task has a list of models. a call goes to the first one, its output is validated (a pydantic schema for
+structured extraction, a Java syntax check for generation) and escalates to the next tier only when the
+validation fails. <think> blocks of reasoning models are stripped before parsing. only responses that pass
+validation are written to the LLM cache, so a rejected one is asked again on the next run instead of being
+replayed and escalated forever. every call records the tier that served it, and a call that reached a model
+below the top tier is credited with the latency of the top model minus its own.
+
+tiers come from MODEL_TIERS, such as "extraction=llama3.2:3b,deepseek-r1:32b;generation=deepseek-r1:32b".
+the latency of a top model is the average of its calls in this process, or before it ran the baseline from
+MODEL_LATENCY in seconds per call, such as "deepseek-r1:32b=20;llama3.2:3b=1.5"
+"""
+
+DEFAULT_TIERS = {
+    'extraction': ['llama3.2:3b', 'deepseek-r1:32b'],
+    'generation': ['deepseek-r1:32b'],
+}
+
+JAVA_BLOCK = re.compile(r'```(?:java)?\s*\n(.*?)```', re.S)
+JSON_BLOCK = re.compile(r'```(?:json)?\s*\n(.*?)```', re.S)
+
+
+def strip_think(text):
+    think_filter = ThinkFilter()
+    return think_filter.feed(text) + think_filter.flush()
+
+
+def extract_json(text):
+    """
+    the JSON object of a model response: <think> blocks removed, a fenced block or the outermost braces
+    """
+    text = strip_think(text)
+    match = JSON_BLOCK.search(text)
+    if match:
+        return match.group(1).strip()
+    start, end = text.find('{'), text.rfind('}')
+    return text[start:end + 1] if start >= 0 and end > start else text.strip()
+
+
+def extract_java(response):
+    """
+    the Java code of a model response: <think> blocks removed, the first fenced block when there is one
+    """
+    text = strip_think(response)
+    match = JAVA_BLOCK.search(text)
+    return (match.group(1) if match else text).strip()
+
+
+def syntax_errors(code, parser=None):
+    """
+    (line, column) of every ERROR or missing node tree-sitter finds in the Java code
+    """
+    tree = (parser or Parser(JAVA_LANGUAGE)).parse(code.encode('utf-8'))
+    if not tree.root_node.has_error:
+        return []
+    errors = []
+    stack = [tree.root_node]
+    while stack:
+        node = stack.pop()
+        if node.is_error or node.is_missing:
+            errors.append((node.start_point[0] + 1, node.start_point[1] + 1))
+        elif node.has_error:
+            stack.extend(node.children)
+    return sorted(errors)
+
+
+def validate_java(response):
+    """
+    None when the response holds a Java class that parses, otherwise the reason
+    """
+    code = extract_java(response)
+    if 'class ' not in code:
+        return "no Java class in the response"
+    errors = syntax_errors(code)
+    return f"syntax errors at {errors[:5]}" if errors else None
+
+
+def parse_latencies(text):
+    latencies = {}
+    for part in filter(None, (part.strip() for part in text.split(';'))):
+        model, _, seconds = part.rpartition('=')
+        latencies[model.strip()] = float(seconds)
+    return latencies
+
+
+def parse_tiers(text):
+    tiers = {}
+    for part in filter(None, (part.strip() for part in text.split(';'))):
+        task, _, models = part.partition('=')
+        tiers[task.strip()] = [model.strip() for model in models.split(',') if model.strip()]
+    return tiers
+
+
+@dataclass
+class RouteRecord:
+    task: str
+    model: str
+    tier: int
+    seconds: float
+    # the response passed validation, a failed one escalates unless it came from the last tier
+    ok: bool
+    escalated: bool = False
+    error: Optional[str] = None
+    # served from the LLM cache, the model did not run
+    cached: bool = False
+
+
+class ModelRouter:
+    def __init__(self, tiers=None, use_cache=True, cache=None, latencies=None):
+        self.tiers = {**DEFAULT_TIERS, **parse_tiers(os.getenv('MODEL_TIERS', '')), **(tiers or {})}
+        self.use_cache = use_cache
+        self.cache = cache
+        self.records = []
+        # (task, model) -> (calls, seconds) of the calls that reached the model, cache hits excluded
+        self.latency = {}
+        # model -> seconds per call, the estimate for a top model that has not run in this process
+        self.baseline = {**parse_latencies(os.getenv('MODEL_LATENCY', '')), **(latencies or {})}
+
+    def models(self, task):
+        if task not in self.tiers or not self.tiers[task]:
+            raise KeyError(f"no model tier configured for task {task}")
+        return self.tiers[task]
+
+    def extract(self, task, messages, schema, validate=None, **kwargs):
+        """
+        the response of the first tier that parses into the pydantic schema, as an instance of it
+
+        validate(instance) returns why a parsed response is still wrong, such as a file path that does not
+        exist, or None. raises ValueError when no tier produced a valid response
+        """
+        parse = self._structured(schema, validate)
+        return self._route(task, messages, parse, format=schema.model_json_schema(), strict=True, **kwargs)
+
+    async def aextract(self, task, messages, schema, validate=None, **kwargs):
+        parse = self._structured(schema, validate)
+        return await self._aroute(task, messages, parse, format=schema.model_json_schema(), strict=True, **kwargs)
+
+    def generate(self, task, messages, validate=validate_java, **kwargs):
+        """
+        the text of the first tier whose output passes validate, the last tier's output when none does
+        """
+        return self._route(task, messages, self._text(validate), strict=False, **kwargs)
+
+    async def agenerate(self, task, messages, validate=validate_java, **kwargs):
+        return await self._aroute(task, messages, self._text(validate), strict=False, **kwargs)
+
+    def _structured(self, schema, validate):
+        def parse(content):
+            instance = schema.model_validate_json(extract_json(content))
+            error = validate(instance) if validate else None
+            if error:
+                raise ValueError(error)
+            return instance
+        return parse
+
+    def _text(self, validate):
+        def parse(content):
+            error = validate(content) if validate else None
+            if error:
+                raise ValueError(error)
+            return content
+        return parse
+
+    def _request(self, format, kwargs):
+        # structured output is deterministic, the JSON schema constrains the decoding of ollama
+        request = {'format': format, **kwargs}
+        if format is not None:
+            request['options'] = {'temperature': 0, **(kwargs.get('options') or {})}
+        use_cache = request.pop('use_cache', self.use_cache)
+        return request, use_cache
+
+    def _lookup(self, task, model, tier, messages, parse, request, current):
+        """
+        the cached response of the request when it still passes validation, (key, result, error)
+        """
+        key = cache_key(model, messages, request['format'], (request.get('options') or {}).get('temperature'))
+        content = (self.cache or default_cache()).get(key)
+        if content is None:
+            return key, None, 'cache miss'
+        try:
+            result = parse(content)
+        except ValueError as e:
+            # cached before a stricter validate, asked again
+            return key, None, str(e).splitlines()[0]
+        self.records.append(RouteRecord(task, model, tier, 0.0, True, cached=True))
+        current.set(ok=True, escalated=False, cache_hit=True)
+        return key, result, None
+
+    def _route(self, task, messages, parse, format=None, strict=True, **kwargs):
+        models = self.models(task)
+        request, use_cache = self._request(format, kwargs)
+        for tier, model in enumerate(models):
+            with span('router.call', task=task, model=model) as current:
+                if use_cache:
+                    key, result, error = self._lookup(task, model, tier, messages, parse, request, current)
+                    if error is None:
+                        return result
+                start = time.perf_counter()
+                content = chat(model=model, messages=messages, use_cache=False, **request)
+                result, error = self._check(task, model, tier, content, parse, start, current, strict)
+                if error is None and use_cache:
+                    (self.cache or default_cache()).put(key, content)
+            if error is None or (not strict and tier == len(models) - 1):
+                return result
+        raise ValueError(f"no tier of {task} produced a valid response: {error}")
+
+    async def _aroute(self, task, messages, parse, format=None, strict=True, **kwargs):
+        models = self.models(task)
+        request, use_cache = self._request(format, kwargs)
+        for tier, model in enumerate(models):
+            async with span('router.call', task=task, model=model) as current:
+                if use_cache:
+                    key, result, error = self._lookup(task, model, tier, messages, parse, request, current)
+                    if error is None:
+                        return result
+                start = time.perf_counter()
+                content = await achat(model=model, messages=messages, use_cache=False, **request)
+                result, error = self._check(task, model, tier, content, parse, start, current, strict)
+                if error is None and use_cache:
+                    (self.cache or default_cache()).put(key, content)
+            if error is None or (not strict and tier == len(models) - 1):
+                return result
+        raise ValueError(f"no tier of {task} produced a valid response: {error}")
+
+    def _check(self, task, model, tier, content, parse, start, current, strict):
+        """
+        parse one response of the model and record the call, returns (result, error)
+        """
+        seconds = time.perf_counter() - start
+        calls, total = self.latency.get((task, model), (0, 0.0))
+        self.latency[(task, model)] = (calls + 1, total + seconds)
+        try:
+            result, error = parse(content), None
+        except ValueError as e:
+            # pydantic's ValidationError is a ValueError. a non-strict caller gets the content of the last tier
+            result, error = (None if strict else content), str(e).splitlines()[0]
+        escalated = error is not None and tier < len(self.models(task)) - 1
+        self.records.append(RouteRecord(task, model, tier, seconds, error is None, escalated, error))
+        current.set(ok=error is None, escalated=escalated, cache_hit=False)
+        return result, error
+
+    def top_latency(self, task):
+        """
+        seconds per call of the top model of task, measured in this process or the configured baseline
+        """
+        top = self.models(task)[-1]
+        if (task, top) in self.latency:
+            calls, total = self.latency[(task, top)]
+            return total / calls
+        return self.baseline.get(top)
+
+    def saved_seconds(self):
+        """
+        estimated latency saved by model calls served below the top tier, 0 for a task whose top model has
+        neither run nor a baseline
+        """
+        saved = 0.0
+        for record in self.records:
+            if not record.ok or record.cached or record.model == self.models(record.task)[-1]:
+                continue
+            top_seconds = self.top_latency(record.task)
+            if top_seconds is not None:
+                saved += max(0.0, top_seconds - record.seconds)
+        return saved
+
+    def stats(self):
+        served = {}
+        for record in self.records:
+            if record.ok:
+                key = f"{record.task}:{record.model}"
+                served[key] = served.get(key, 0) + 1
+        return {
+            'calls': len(self.records),
+            'cached': sum(1 for record in self.records if record.cached),
+            'served': served,
+            'escalations': sum(1 for record in self.records if record.escalated),
+            'failures': sum(1 for record in self.records if not record.ok),
+            'saved_seconds': self.saved_seconds(),
+        }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="route one prompt through the model tiers of a task")
+    arg_parser.add_argument('task', choices=sorted(DEFAULT_TIERS))
+    arg_parser.add_argument('prompt')
+    args = arg_parser.parse_args()
+    router = ModelRouter()
+    print(router.generate(args.task, [{"role": "user", "content": args.prompt}], validate=None))
+    print(router.stats())
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+
+__doc__ = """
+order generation requests so the model server can reuse its prompt KV cache
+
+prompts start with a prefix that only depends on the request classes of an endpoint (instructions, example
+test, request class sources) and end with the endpoint itself. endpoints with the same request classes are
+sent back to back, with keep_alive holding the model in memory, so the shared prefix is prefilled once per
+group. ollama reports only the evaluated prompt tokens in prompt_eval_count, the difference to the prompt
+size is what the prefix cache saved.
+"""
+
+
+def class_key(java_class):
+    return f"{java_class.package_name}.{java_class.nested_name}" if java_class.package_name else java_class.nested_name
+
+
+def group_by_request_classes(endpoints, request_classes):
+    """
+    [(request classes, endpoints)] with the endpoints of each group in their original order
+
+    request_classes(endpoint) returns the project classes of an endpoint's parameters, groups come in the
+    order their first endpoint appears. endpoints without request classes share the group of ()
+    """
+    groups = {}
+    for endpoint in endpoints:
+        classes = request_classes(endpoint)
+        key = tuple(sorted(class_key(java_class) for java_class in classes))
+        if key not in groups:
+            groups[key] = (classes, [])
+        groups[key][1].append(endpoint)
+    return list(groups.values())
+
+
+@dataclass
+class PrefixCacheStats:
+    requests: int = 0
+    # estimated size of the prompts and what the server evaluated of them
+    prompt_tokens: int = 0
+    evaluated_tokens: int = 0
+    prefill_seconds: float = 0.0
+
+    def record(self, prompt_tokens, response):
+        """
+        add one ollama response, prompt_tokens is the estimated size of its prompt
+        """
+        evaluated = response.prompt_eval_count or 0
+        self.requests += 1
+        self.prompt_tokens += max(prompt_tokens, evaluated)
+        self.evaluated_tokens += evaluated
+        self.prefill_seconds += (response.prompt_eval_duration or 0) / 1e9
+
+    @property
+    def reused_tokens(self):
+        return self.prompt_tokens - self.evaluated_tokens
+
+    @property
+    def hit_rate(self):
+        return self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    @property
+    def saved_seconds(self):
+        # reused tokens would have been prefilled at the measured speed of the evaluated ones
+        if not self.evaluated_tokens:
+            return 0.0
+        return self.reused_tokens * self.prefill_seconds / self.evaluated_tokens
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'prompt_tokens': self.prompt_tokens,
+            'evaluated_tokens': self.evaluated_tokens,
+            'reused_tokens': self.reused_tokens,
+            'hit_rate': self.hit_rate,
+            'prefill_seconds': self.prefill_seconds,
+            'saved_seconds': self.saved_seconds,
+        }
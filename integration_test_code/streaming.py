@@ -0,0 +1,233 @@
+import re
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from tracing import span
+
+__doc__ = """
+streaming generation helpers
+
+tokens are written to disk and stdout as they arrive, <think> reasoning blocks are removed on the fly,
+and the generation is aborted once a complete Java class was emitted or the token budget is used up
+"""
+
+CLASS_HEADER = re.compile(r'\bclass\s+\w+')
+# a line that starts a class declaration, such as "public class UserControllerTest {"
+DECLARATION_START = re.compile(r'\s*(?:@\w+(?:\(.*\))?\s+)*(?:(?:public|protected|private|abstract|final|static)\s+)*'
+                               r'class\s+\w+')
+CODE_FENCE = re.compile(r'\s*```(?:java)?\s*$')
+
+
+def _partial_tag_length(text, tag):
+    """
+    length of the longest suffix of text that is a prefix of tag, a tag may be split across chunks
+    """
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class ThinkFilter:
+    """
+    removes <think>...</think> blocks from a stream of text chunks
+    """
+
+    def __init__(self, open_tag='<think>', close_tag='</think>'):
+        self.open_tag = open_tag
+        self.close_tag = close_tag
+        self.in_think = False
+        self.pending = ''
+
+    def feed(self, text):
+        buffer = self.pending + text
+        output = []
+        while True:
+            tag = self.close_tag if self.in_think else self.open_tag
+            index = buffer.find(tag)
+            if index >= 0:
+                if not self.in_think:
+                    output.append(buffer[:index])
+                buffer = buffer[index + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            keep = _partial_tag_length(buffer, tag)
+            if not self.in_think:
+                output.append(buffer[:len(buffer) - keep])
+            self.pending = buffer[len(buffer) - keep:]
+            return ''.join(output)
+
+    def flush(self):
+        rest = '' if self.in_think else self.pending
+        self.pending = ''
+        return rest
+
+
+class JavaClassDetector:
+    """
+    follows the braces of streamed Java code, skipping strings and comments,
+    and reports when a top level class declaration has been closed
+
+    text before the code is prose, where an apostrophe as in "Here's the test" is no char literal. tracking
+    starts after a ```java fence or at the first line that starts a class declaration
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.mode = 'prose'
+        # the current line of prose
+        self.line = ''
+        self.previous = ''
+        # code seen at depth 0 since the last statement or block, checked for a class header at the next {
+        self.header = ''
+        self.in_class = False
+        self.complete = False
+
+    def feed(self, text):
+        for char in text:
+            self._feed_char(char)
+        return self.complete
+
+    def _feed_prose(self, char):
+        """
+        returns whether char starts the code and has to be tracked
+        """
+        if char == '\n':
+            if CODE_FENCE.match(self.line):
+                self.mode = 'code'
+            elif DECLARATION_START.match(self.line):
+                # the opening brace of the class follows on the next line
+                self.mode = 'code'
+                self.header = self.line + char
+            self.line = ''
+            return False
+        self.line = (self.line + char)[:500]
+        if char == '{' and DECLARATION_START.match(self.line):
+            self.mode = 'code'
+            self.header = self.line[:-1]
+            return True
+        return False
+
+    def _feed_char(self, char):
+        if self.mode == 'prose':
+            if not self._feed_prose(char):
+                return
+        if self.mode == 'line_comment':
+            if char == '\n':
+                self.mode = 'code'
+        elif self.mode == 'block_comment':
+            if self.previous == '*' and char == '/':
+                self.mode = 'code'
+                char = ''
+        elif self.mode in ('string', 'char'):
+            quote = '"' if self.mode == 'string' else "'"
+            if char == quote and self.previous != '\\':
+                self.mode = 'code'
+            elif char == '\\' and self.previous == '\\':
+                # an escaped backslash must not escape the closing quote
+                char = ''
+        elif self.previous == '/' and char == '/':
+            self.mode = 'line_comment'
+        elif self.previous == '/' and char == '*':
+            self.mode = 'block_comment'
+            # the closing */ must not reuse this *
+            char = ''
+        elif char == '"':
+            self.mode = 'string'
+        elif char == "'":
+            self.mode = 'char'
+        elif char == '{':
+            if self.depth == 0:
+                self.in_class = bool(CLASS_HEADER.search(self.header))
+            self.depth += 1
+        elif char == '}':
+            self.depth = max(0, self.depth - 1)
+            if self.depth == 0:
+                self.complete = self.complete or self.in_class
+                self.header = ''
+        elif self.depth == 0:
+            self.header = '' if char == ';' else (self.header + char)[-200:]
+        self.previous = char
+
+
+@dataclass
+class StreamStats:
+    content: str
+    # first token of any kind, including reasoning, and first token written to the output
+    time_to_first_token: Optional[float]
+    time_to_first_output: Optional[float]
+    total_seconds: float
+    tokens: int
+    # complete_class, token_budget or None when the model finished on its own
+    aborted: Optional[str] = None
+
+
+def stream_chat(model, messages, output=None, echo=True, max_tokens=None, stop_on_complete_class=True,
+                options=None):
+    """
+    stream an ollama chat, writing the visible text to output (a text file) and stdout as it arrives
+    """
+    from ollama import chat
+
+    options = dict(options or {})
+    if max_tokens:
+        options.setdefault('num_predict', max_tokens)
+    think_filter = ThinkFilter()
+    detector = JavaClassDetector()
+    parts = []
+    tokens = 0
+    first_token = first_output = None
+    aborted = None
+
+    def emit(text):
+        nonlocal first_output
+        if not text:
+            return
+        if first_output is None:
+            first_output = time.perf_counter() - start
+        parts.append(text)
+        if output is not None:
+            output.write(text)
+            output.flush()
+        if echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        detector.feed(text)
+
+    with span('llm.stream', model=model) as current:
+        start = time.perf_counter()
+        stream = chat(model=model, messages=messages, stream=True, options=options)
+        try:
+            for chunk in stream:
+                piece = chunk.message.content or ''
+                if piece:
+                    tokens += 1
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                if chunk.done:
+                    tokens = chunk.eval_count or tokens
+                    current.set(prompt_tokens=chunk.prompt_eval_count or 0)
+                emit(think_filter.feed(piece))
+                if stop_on_complete_class and detector.complete:
+                    aborted = 'complete_class'
+                    break
+                if max_tokens and tokens >= max_tokens:
+                    aborted = 'token_budget'
+                    break
+        finally:
+            # closing the generator closes the HTTP stream, so the server stops generating too
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+        emit(think_filter.flush())
+        current.set(completion_tokens=tokens, time_to_first_token=first_token, aborted=aborted)
+    return StreamStats(
+        content=''.join(parts),
+        time_to_first_token=first_token,
+        time_to_first_output=first_output,
+        total_seconds=time.perf_counter() - start,
+        tokens=tokens,
+        aborted=aborted,
+    )
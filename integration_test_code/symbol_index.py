@@ -0,0 +1,271 @@
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from tree_sitter import Parser, Query, QueryCursor
+
+from integration_test_code.analyze_api import JAVA_LANGUAGE
+from tracing import span
+
+__doc__ = """
+project symbol index built with tree-sitter
+
+records package, classes, file path, imports and fields of every Java file, so that type names used by
+an endpoint, such as a UserRequest request body, can be resolved to their source file without asking a model.
+refresh re-indexes the files changed since they were indexed, for a long running server. a server whose jobs
+read the index on an event loop parses the changes in a thread and applies them on the loop:
+
+    symbol_index.apply(await asyncio.to_thread(symbol_index.changes))
+"""
+
+SYMBOL_QUERY = Query(JAVA_LANGUAGE, """
+(package_declaration [(identifier) (scoped_identifier)] @package)
+
+(import_declaration) @import
+
+[(class_declaration name: (identifier) @type.name)
+ (interface_declaration name: (identifier) @type.name)
+ (enum_declaration name: (identifier) @type.name)
+ (record_declaration name: (identifier) @type.name)] @type
+
+(field_declaration
+  type: (_) @field.type
+  declarator: (variable_declarator name: (identifier) @field.name)) @field
+""")
+
+TYPE_DECLARATIONS = ('class_declaration', 'interface_declaration', 'enum_declaration', 'record_declaration')
+
+IDENTIFIER = re.compile(r'[A-Za-z_$][\w$.]*')
+
+
+@dataclass(frozen=True, slots=True)
+class JavaField:
+    name: str
+    type: str
+    # annotation source, such as @Size(min = 2, max = 50)
+    annotations: tuple[str, ...]
+    # the whole field declaration including its annotations
+    source: str
+
+
+@dataclass(frozen=True, slots=True)
+class JavaClass:
+    name: str
+    # enclosing classes of a nested class followed by its name, such as Outer.Inner
+    nested_name: str
+    package_name: str
+    file_path: str
+    imports: tuple[str, ...]
+    fields: tuple[JavaField, ...]
+    # the declaration up to its body: annotations, modifiers, kind, name, type parameters, record components,
+    # extends and implements
+    header: str = ''
+    # constants of an enum as written, such as ACTIVE("active")
+    constants: tuple[str, ...] = ()
+
+    @property
+    def qualified_name(self):
+        return f"{self.package_name}.{self.nested_name}" if self.package_name else self.nested_name
+
+
+def _text(node):
+    return node.text.decode('utf-8')
+
+
+def _enclosing_type(node):
+    node = node.parent
+    while node is not None and node.type not in TYPE_DECLARATIONS:
+        node = node.parent
+    return node
+
+
+def _annotations(node):
+    modifiers = next((child for child in node.children if child.type == 'modifiers'), None)
+    if modifiers is None:
+        return ()
+    return tuple(_text(child) for child in modifiers.children if child.type in ('annotation', 'marker_annotation'))
+
+
+class SymbolIndex:
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.parser = Parser(JAVA_LANGUAGE)
+        self.by_qualified_name = {}
+        self.by_simple_name = {}
+        self.by_file = {}
+        # (mtime, size) of every indexed file
+        self.versions = {}
+        # the parser is not thread safe, changes runs in worker threads
+        self.lock = threading.Lock()
+        self.build()
+
+    def java_files(self):
+        for root, dirs, files in os.walk(self.dir_path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for file in sorted(files):
+                if file.endswith('.java'):
+                    yield os.path.join(root, file)
+
+    def build(self):
+        """
+        parse every Java file under dir_path and index its classes
+        """
+        with span('symbols.build', dir_path=self.dir_path) as current:
+            for java_file in self.java_files():
+                self.add_file(java_file)
+            current.set(files=len(self.by_file), classes=len(self.by_qualified_name))
+
+    def changes(self):
+        """
+        (java_file, version, classes) of every file added or changed since it was indexed, version and classes
+        None for a deleted file. only reads files, the index itself is changed by apply
+        """
+        with self.lock, span('symbols.refresh', dir_path=self.dir_path) as current:
+            versions = self.versions.copy()
+            changes = []
+            for java_file in self.java_files():
+                version = self.version(java_file)
+                if versions.pop(java_file, None) != version:
+                    changes.append((java_file, version, self.parse_file(java_file)))
+            changes.extend((java_file, None, None) for java_file in versions)
+            current.set(changed=len(changes))
+        return changes
+
+    def apply(self, changes):
+        """
+        index the result of changes, returns the number of files added, changed or removed
+        """
+        for java_file, version, classes in changes:
+            self.remove_file(java_file)
+            if classes is not None:
+                self.add_classes(java_file, version, classes)
+        return len(changes)
+
+    def refresh(self):
+        """
+        index the files added or changed since they were indexed and forget deleted ones, returns their number
+        """
+        return self.apply(self.changes())
+
+    @staticmethod
+    def version(java_file):
+        stat = os.stat(java_file)
+        return stat.st_mtime_ns, stat.st_size
+
+    def remove_file(self, java_file):
+        self.versions.pop(java_file, None)
+        for java_class in self.by_file.pop(java_file, []):
+            if self.by_qualified_name.get(java_class.qualified_name) is java_class:
+                del self.by_qualified_name[java_class.qualified_name]
+            same_name = [other for other in self.by_simple_name.get(java_class.name, []) if other is not java_class]
+            if same_name:
+                self.by_simple_name[java_class.name] = same_name
+            else:
+                self.by_simple_name.pop(java_class.name, None)
+
+    def parse_file(self, java_file):
+        with open(java_file, 'rb') as f:
+            tree = self.parser.parse(f.read())
+        return self.extract_classes(tree.root_node, java_file)
+
+    def add_file(self, java_file):
+        # stat before reading, so a write racing with the parse is seen as a change by the next refresh
+        version = self.version(java_file)
+        self.add_classes(java_file, version, self.parse_file(java_file))
+
+    def add_classes(self, java_file, version, classes):
+        self.versions[java_file] = version
+        for java_class in classes:
+            self.by_qualified_name[java_class.qualified_name] = java_class
+            self.by_simple_name.setdefault(java_class.name, []).append(java_class)
+            self.by_file.setdefault(java_file, []).append(java_class)
+
+    def extract_classes(self, root, java_file):
+        """
+        classes of one file with their fields, in source order
+        """
+        package_name = ''
+        imports = []
+        types = {}
+        fields = {}
+        for pattern, captures in QueryCursor(SYMBOL_QUERY).matches(root):
+            if 'package' in captures:
+                package_name = _text(captures['package'][0])
+            elif 'import' in captures:
+                # import static a.b.C.d; and import a.b.*; are kept as written without keyword and semicolon
+                text = _text(captures['import'][0])
+                imports.append(text.removeprefix('import').strip().rstrip(';').strip())
+            elif 'type' in captures:
+                types[captures['type'][0].id] = captures
+            else:
+                field = captures['field'][0]
+                owner = _enclosing_type(field)
+                if owner is not None:
+                    fields.setdefault(owner.id, {}).setdefault(field.id, JavaField(
+                        name=_text(captures['field.name'][0]),
+                        type=_text(captures['field.type'][0]),
+                        annotations=_annotations(field),
+                        source=_text(field),
+                    ))
+
+        result = []
+        for type_id, captures in types.items():
+            node = captures['type'][0]
+            names = [_text(captures['type.name'][0])]
+            outer = _enclosing_type(node)
+            while outer is not None:
+                names.insert(0, _text(outer.child_by_field_name('name')))
+                outer = _enclosing_type(outer)
+            body = node.child_by_field_name('body')
+            result.append(JavaClass(
+                name=names[-1],
+                nested_name='.'.join(names),
+                package_name=package_name,
+                file_path=java_file,
+                imports=tuple(imports),
+                fields=tuple(fields.get(type_id, {}).values()),
+                header=node.text[:body.start_byte - node.start_byte].decode('utf-8').rstrip() if body else _text(node),
+                constants=tuple(_text(child) for child in body.children if child.type == 'enum_constant')
+                if body else (),
+            ))
+        return result
+
+    def resolve(self, type_name, context_file):
+        """
+        resolve a simple or qualified type name used in context_file, the same way javac looks it up:
+        single type imports, the own package, wildcard imports, and last a class name unique in the project
+        """
+        if '.' in type_name:
+            return self.by_qualified_name.get(type_name)
+        context = self.by_file.get(context_file, [])
+        package_name = context[0].package_name if context else ''
+        imports = context[0].imports if context else ()
+
+        for imported in imports:
+            if imported.endswith('.' + type_name) and not imported.startswith('static '):
+                return self.by_qualified_name.get(imported)
+        for java_class in context:
+            if java_class.name == type_name:
+                return java_class
+        same_package = self.by_qualified_name.get(f"{package_name}.{type_name}" if package_name else type_name)
+        if same_package:
+            return same_package
+        for imported in imports:
+            if imported.endswith('.*') and not imported.startswith('static '):
+                found = self.by_qualified_name.get(f"{imported[:-2]}.{type_name}")
+                if found:
+                    return found
+        candidates = self.by_simple_name.get(type_name, [])
+        return candidates[0] if len(candidates) == 1 else None
+
+    def resolve_type(self, type_text, context_file):
+        """
+        project classes referenced by a type, including generic arguments, such as List<UserRequest>
+        """
+        result = []
+        for name in IDENTIFIER.findall(type_text):
+            java_class = self.resolve(name, context_file)
+            if java_class is not None and java_class not in result:
+                result.append(java_class)
+        return result
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from tracing import span
+
+__doc__ = """
+bounded in-process async job queue
+
+jobs are queued up to max_size, submitting to a full queue raises asyncio.QueueFull so the caller can apply
+backpressure, a fixed pool of worker tasks runs the handlers, and every job keeps a list of progress events
+that can be followed while it runs
+"""
+
+FINISHED = ('done', 'failed')
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    params: dict
+    status: str = 'queued'
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+    events: list = field(default_factory=list)
+    changed: asyncio.Condition = field(default_factory=asyncio.Condition, repr=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'events': len(self.events),
+        }
+
+
+class JobQueue:
+    def __init__(self, handlers, workers=2, max_size=100, max_jobs=1000):
+        """
+        handlers maps a job kind to `async def handler(job, report)`, report(event, **data) records progress
+        """
+        self.handlers = handlers
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.jobs = OrderedDict()
+        self.tasks = []
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, kind, params):
+        """
+        queue a job and return it at once, raises asyncio.QueueFull when the queue is full
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind {kind}")
+        job = Job(id=uuid.uuid4().hex, kind=kind, params=params)
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self.forget_finished()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def forget_finished(self):
+        # keep the most recent jobs only, oldest finished ones are dropped first
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id].status in FINISHED:
+                del self.jobs[job_id]
+
+    async def report(self, job, event, status=None, **data):
+        async with job.changed:
+            # a final status is set together with its event, so a follower never sees one without the other
+            if status is not None:
+                job.status = status
+            job.events.append({'event': event, 'time': time.time(), **data})
+            job.changed.notify_all()
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            status = 'failed'
+            try:
+                job.started = time.time()
+                await self.report(job, 'started', status='running')
+
+                async def report(event, **data):
+                    await self.report(job, event, **data)
+
+                async with span(f"job.{job.kind}", job_id=job.id):
+                    job.result = await self.handlers[job.kind](job, report)
+                status = 'done'
+            except asyncio.CancelledError:
+                job.error = 'cancelled'
+                raise
+            except Exception as e:
+                job.error = repr(e)
+            finally:
+                job.finished = time.time()
+                await self.report(job, status, status=status, error=job.error)
+                self.queue.task_done()
+
+    async def follow(self, job):
+        """
+        yield the progress events of a job, waiting for new ones until it has finished
+        """
+        position = 0
+        while True:
+            async with job.changed:
+                while position == len(job.events) and job.status not in FINISHED:
+                    await job.changed.wait()
+                events = job.events[position:]
+            for event in events:
+                yield event
+            position += len(events)
+            if job.status in FINISHED and position == len(job.events):
+                return
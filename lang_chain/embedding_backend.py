@@ -0,0 +1,29 @@
+from langchain_core.embeddings import Embeddings
+
+
+class BackendEmbeddings(Embeddings):
+    """
+    LangChain embeddings that delegate to an embedding backend.
+
+    A backend is any object with embed(texts) returning one vector per text and optionally an
+    async aembed(texts), such as the client of the resident embedding server.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def embed_documents(self, texts):
+        # the whole list goes to the backend, which batches on its own: the quantized backend groups texts of
+        # similar length across all of them, the server's backend encodes a request in batches of max_batch
+        return self.backend.embed(list(texts))
+
+    def embed_query(self, text):
+        return self.backend.embed([text])[0]
+
+    async def aembed_documents(self, texts):
+        if not hasattr(self.backend, "aembed"):
+            return self.embed_documents(texts)
+        return await self.backend.aembed(list(texts))
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, fields
+
+import faiss
+import numpy as np
+
+from tracing import span
+
+CONFIG_FILE = "index_config.json"
+REPORT_FILE = "recall_report.json"
+
+# faiss warns below 39 training points per IVF list, and PQ needs 2**bits points to train its codebooks
+MIN_POINTS_PER_LIST = 39
+
+
+@dataclass
+class IndexConfig:
+    """
+    Structure and search parameters of a FAISS index.
+
+    kind is "flat" (exact brute force search), "hnsw" (graph index, no training) or "ivfpq"
+    (inverted lists with product quantized vectors, trained on the first train_size vectors).
+    nprobe and ef_search trade recall for speed at query time and can be changed without a rebuild.
+    """
+    kind: str = "flat"
+    # hnsw
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 128
+    # ivfpq
+    nlist: int = 1024
+    pq_m: int = 64
+    pq_bits: int = 8
+    nprobe: int = 32
+    train_size: int = 65536
+
+    def __post_init__(self):
+        if self.kind not in ("flat", "hnsw", "ivfpq"):
+            raise ValueError(f"unknown index kind {self.kind!r}, expected flat, hnsw or ivfpq")
+
+    @property
+    def needs_training(self):
+        return self.kind == "ivfpq"
+
+
+def save_config(config, index_path):
+    with open(os.path.join(index_path, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(asdict(config), f, indent=2)
+
+
+def load_config(index_path):
+    """The config stored with an index, an exact index when there is none (indexes built before configs)."""
+    config_path = os.path.join(index_path, CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return IndexConfig()
+    with open(config_path, "r", encoding="utf-8") as f:
+        stored = json.load(f)
+    known = {field.name for field in fields(IndexConfig)}
+    return IndexConfig(**{key: value for key, value in stored.items() if key in known})
+
+
+def _pq_subquantizers(dimension, requested):
+    # the vector is split into pq_m equal parts, so pq_m has to divide the dimension
+    for m in range(min(requested, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(config, dimension):
+    """An empty FAISS index for config, ivfpq indexes still have to be trained."""
+    if config.kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, config.hnsw_m)
+        index.hnsw.efConstruction = config.ef_construction
+    elif config.kind == "ivfpq":
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, config.nlist,
+                                 _pq_subquantizers(dimension, config.pq_m), config.pq_bits)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    apply_search_params(index, config)
+    return index
+
+
+def train_index(config, vectors):
+    """
+    Create an index and train it on vectors, the training buffer.
+
+    With fewer vectors than the configured lists need, nlist is reduced, and when there are too
+    few to train the PQ codebooks at all an exact index is returned together with a flat config.
+    """
+    count, dimension = vectors.shape
+    if count < 2 ** config.pq_bits:
+        print(f"Only {count} vectors, too few to train product quantization, using an exact index")
+        config = IndexConfig(kind="flat")
+        return create_index(config, dimension), config
+    nlist = min(config.nlist, max(1, count // MIN_POINTS_PER_LIST))
+    if nlist != config.nlist:
+        print(f"Reducing nlist from {config.nlist} to {nlist} for {count} training vectors")
+        config = IndexConfig(**{**asdict(config), "nlist": nlist, "nprobe": min(config.nprobe, nlist)})
+    index = create_index(config, dimension)
+    with span("index.train", vectors=count, nlist=config.nlist):
+        index.train(vectors)
+    return index, config
+
+
+def apply_search_params(index, config):
+    """Set the query time recall/speed trade-off of an index."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(config.nprobe, index.nlist)
+
+
+def index_bytes(index):
+    return int(faiss.serialize_index(index).size)
+
+
+def recall_report(exact_index, approximate_index, config, k=100, queries=200, sweep=None, seed=0):
+    """
+    Recall@k and latency of an approximate index against the exact one, over a sweep of nprobe or ef_search.
+
+    Both indexes must hold the same vectors in the same order, as load_and_embed_documents builds them from
+    the same source. The query vectors are a random sample of the stored vectors, read back from the exact index.
+    """
+    total = exact_index.ntotal
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(total, size=min(queries, total), replace=False)
+    query_vectors = np.vstack([exact_index.reconstruct(int(i)) for i in ids]).astype("float32")
+    k = min(k, total)
+
+    def measure(index):
+        start = time.perf_counter()
+        results = [index.search(vector.reshape(1, -1), k)[1][0] for vector in query_vectors]
+        return results, (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    truth, exact_ms = measure(exact_index)
+    rows = [{"kind": "flat", "param": None, "value": None, "recall": 1.0, "latency_ms": exact_ms,
+             "bytes": index_bytes(exact_index)}]
+    param = "ef_search" if config.kind == "hnsw" else "nprobe"
+    if sweep is None:
+        sweep = [1, 2, 4, 8, 16, 32, 64, 128, 256] if param == "nprobe" else [16, 32, 64, 128, 256, 512]
+    if param == "nprobe":
+        # probing every list is the upper bound of what IVF can reach
+        sweep = sorted({min(value, config.nlist) for value in sweep})
+    approximate_bytes = index_bytes(approximate_index)
+    for value in sweep:
+        apply_search_params(approximate_index, IndexConfig(**{**asdict(config), param: value}))
+        found, latency_ms = measure(approximate_index)
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth)])
+        rows.append({"kind": config.kind, "param": param, "value": value, "recall": float(recall),
+                     "latency_ms": latency_ms, "bytes": approximate_bytes})
+    apply_search_params(approximate_index, config)
+    return rows
+
+
+def print_report(rows, k):
+    print(f"{'index':8} {'setting':16} {f'recall@{k}':>10} {'ms/query':>10} {'size MB':>10}")
+    for row in rows:
+        setting = f"{row['param']}={row['value']}" if row["param"] else "exact"
+        print(f"{row['kind']:8} {setting:16} {row['recall']:10.3f} {row['latency_ms']:10.3f} "
+              f"{row['bytes'] / (1024 * 1024):10.1f}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="recall versus latency of an approximate FAISS index")
+    arg_parser.add_argument("exact_index_path", help="index saved by load_and_embed_documents with kind flat")
+    arg_parser.add_argument("index_path", help="approximate index of the same source")
+    arg_parser.add_argument("--k", type=int, default=100)
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--sweep", type=int, nargs="*", help="nprobe or ef_search values to measure")
+    args = arg_parser.parse_args()
+
+    exact = faiss.read_index(os.path.join(args.exact_index_path, "index.faiss"))
+    approximate = faiss.read_index(os.path.join(args.index_path, "index.faiss"))
+    if exact.ntotal != approximate.ntotal:
+        raise SystemExit(f"indexes differ in size: {exact.ntotal} and {approximate.ntotal} vectors")
+    report = recall_report(exact, approximate, load_config(args.index_path), args.k, args.queries, args.sweep)
+    print_report(report, min(args.k, exact.ntotal))
+    with open(os.path.join(args.index_path, REPORT_FILE), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
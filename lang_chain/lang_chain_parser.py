@@ -1,46 +1,198 @@
 import json
 import os
+import shutil
+import uuid
 
-from langchain_community.adapters import openai
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.document_loaders.generic import GenericLoader
 from langchain_community.document_loaders.parsers import LanguageParser
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 
-def load_and_embed_documents():
+from embedding_server import ENCODE_KWARGS, default_backend
+from lang_chain.embedding_backend import BackendEmbeddings
+from lang_chain.faiss_index import IndexConfig, apply_search_params, create_index, load_config, save_config, train_index
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, symbol_query
+from llm_cache import default_cache
+from tracing import enable_tracing, export_trace, span
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _index_exists(index_path):
+    return os.path.exists(os.path.join(index_path, "index.faiss")) and os.path.exists(
+        os.path.join(index_path, "index.pkl"))
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
+def default_embeddings(model_name="Kwaipilot/OASIS-code-embedding-1.5B", backend_name=None):
+    """
+    Embeddings from the resident embedding server when it runs, otherwise the model loaded in process.
+
+    backend_name "quantized" loads the model as an int8 ONNX Runtime graph instead of with torch,
+    EMBEDDING_BACKEND sets the default.
+    """
+    backend = default_backend(model_name)
+    if backend is not None:
+        return BackendEmbeddings(backend)
+    if (backend_name or os.getenv("EMBEDDING_BACKEND", "torch")) == "quantized":
+        from quantized_embedding import QuantizedBackend
+        return BackendEmbeddings(QuantizedBackend(model_name))
+    # imported here, so runs that find the server never import torch and transformers
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name, encode_kwargs=ENCODE_KWARGS)
+
+def load_and_embed_documents(source_dir="", index_path="faiss_index", batch_size=512, embeddings=None,
+                             index_config=None):
+    """
+    Stream code chunks from source_dir into a FAISS index.
+
+    Each chunk is embedded exactly once, in batches of batch_size, and added to the
+    index incrementally, so only one batch of documents is held in memory at a time. The
+    backend groups the texts of a batch by length, so a larger batch pads less.
+    When a complete index already exists at index_path it is loaded without parsing.
+
+    index_config (an IndexConfig) selects an exact, HNSW or IVF-PQ index. An IVF-PQ index is
+    trained on the first train_size embeddings, which are buffered until then. The config is
+    saved as index_config.json next to the index; when loading, the stored structure is kept
+    and only the search parameters nprobe and ef_search of index_config are applied.
+
+    A BM25 index of the same chunks, under the same ids, is built in this pass and saved as
+    lexical_index.json, see load_lexical_index and hybrid_search.
+    """
+    if embeddings is None:
+        embeddings = default_embeddings()
+
+    if _index_exists(index_path):
+        print("Loading faiss index")
+        with span('index.load_storage', index_path=index_path):
+            vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+        stored = load_config(index_path)
+        if index_config is not None:
+            if index_config.kind != stored.kind:
+                print(f"Index at {index_path} is {stored.kind}, delete it to rebuild as {index_config.kind}")
+            stored.nprobe, stored.ef_search = index_config.nprobe, index_config.ef_search
+        apply_search_params(vector_store.index, stored)
+        return vector_store, embeddings
+
+    config = index_config or IndexConfig()
     loader = GenericLoader.from_filesystem(
-        "",
+        source_dir,
         glob="**/*",
         suffixes=[".java"],
         parser=LanguageParser("java")
     )
-    docs = loader.load()
+    vector_store = None
+    lexical_index = LexicalIndex()
+    # embedded chunks waiting for an IVF-PQ index to be trained
+    pending = []
+    count = 0
 
-    embeddings = HuggingFaceEmbeddings(
-        model_name="Kwaipilot/OASIS-code-embedding-1.5B"
-    )
+    def add(text_embeddings, metadatas):
+        nonlocal vector_store, config
+        if vector_store is None:
+            vectors = np.asarray([vector for _, vector in text_embeddings], dtype="float32")
+            if config.needs_training:
+                index, config = train_index(config, vectors)
+            else:
+                index = create_index(config, vectors.shape[1])
+            vector_store = FAISS(embeddings, index, InMemoryDocstore(), {})
+        ids = [str(uuid.uuid4()) for _ in text_embeddings]
+        with span('index.add', nodes=len(text_embeddings)):
+            vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        with span('index.lexical', nodes=len(text_embeddings)):
+            for doc_id, (text, _), metadata in zip(ids, text_embeddings, metadatas):
+                lexical_index.add(doc_id, text, metadata)
 
-    if os.path.exists("faiss_index"):
-        print("Loading faiss index")
-        vector_store = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
-        return vector_store, embeddings
-    embedded_docs = []
-    for doc in docs:
-        embedding_vector = embeddings.embed_query(doc.page_content)
-        embedded_docs.append({
-            'content': doc.page_content,
-            'embedding': embedding_vector,
-            'metadata': doc.metadata
-        })
+    for batch in _batched(loader.lazy_load(), batch_size):
+        texts = [doc.page_content for doc in batch]
+        metadatas = [doc.metadata for doc in batch]
+        with span('index.embed', nodes=len(texts), bytes=sum(len(text.encode('utf-8')) for text in texts)):
+            text_embeddings = list(zip(texts, embeddings.embed_documents(texts)))
+        if vector_store is None and config.needs_training:
+            pending.extend(zip(text_embeddings, metadatas))
+            if len(pending) >= config.train_size:
+                add([item for item, _ in pending], [metadata for _, metadata in pending])
+                pending = []
+        else:
+            add(text_embeddings, metadatas)
+        count += len(batch)
+        print(f"Embedded {count} chunks")
+    if pending:
+        # fewer chunks than train_size, the index is trained on all of them
+        add([item for item, _ in pending], [metadata for _, metadata in pending])
+    if vector_store is None:
+        raise ValueError(f"no .java files found in {source_dir!r}")
 
-    vector_store = FAISS.from_documents(docs, embeddings)
-    vector_store.save_local("faiss_index")
+    # write to a temporary directory first so a crash never leaves a half written index behind
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    vector_store.save_local(tmp_path)
+    save_config(config, tmp_path)
+    lexical_index.save(os.path.join(tmp_path, LEXICAL_INDEX_FILE))
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    os.replace(tmp_path, index_path)
     return vector_store, embeddings
 
-def search_and_summarize(vector_store, embeddings, query="summarize the codebase", top_k=100):
+def load_lexical_index(vector_store, index_path="faiss_index"):
+    """
+    The BM25 index saved with the FAISS index, rebuilt from its docstore for indexes saved without one.
+    """
+    path = os.path.join(index_path, LEXICAL_INDEX_FILE)
+    if os.path.exists(path):
+        with span('index.load_lexical'):
+            return LexicalIndex.load(path)
+    lexical_index = LexicalIndex()
+    with span('index.lexical', nodes=len(vector_store.index_to_docstore_id)):
+        for doc_id in vector_store.index_to_docstore_id.values():
+            doc = vector_store.docstore.search(doc_id)
+            lexical_index.add(doc_id, doc.page_content, doc.metadata)
+    if os.path.isdir(index_path):
+        lexical_index.save(path)
+    return lexical_index
+
+def hybrid_search(vector_store, embeddings, lexical_index, query, top_k=100):
+    """
+    Documents for query, ranked by reciprocal rank fusion of BM25 and vector search.
+
+    Pure symbol queries such as `UserRequest` or /api/users are answered from the
+    lexical index alone, without embedding the query, unless it has no hit for them.
+    """
+    symbols = symbol_query(query)
+    if symbols:
+        with span('retrieval.lexical', top_k=top_k, symbol_query=True):
+            hits = lexical_index.search_symbols(symbols, top_k)
+        if hits:
+            return [vector_store.docstore.search(doc_id) for doc_id, _ in hits]
+
+    with span('retrieval.embed_query'):
+        query_embedding = embeddings.embed_query(query)
+    with span('retrieval.search', top_k=top_k):
+        _, positions = vector_store.index.search(np.asarray([query_embedding], dtype="float32"), top_k)
+    vector_ids = [vector_store.index_to_docstore_id[position] for position in positions[0] if position != -1]
+    with span('retrieval.lexical', top_k=top_k, symbol_query=False):
+        lexical_ids = [doc_id for doc_id, _ in lexical_index.search(query, top_k)]
+    fused = reciprocal_rank_fusion([vector_ids, lexical_ids], limit=top_k)
+    return [vector_store.docstore.search(doc_id) for doc_id in fused]
+
+def search_and_summarize(vector_store, embeddings, query="summarize the codebase", top_k=100, lexical_index=None):
     # 将查询转换为 embedding 并搜索
-    query_embedding = embeddings.embed_query(query)
-    results = vector_store.similarity_search_by_vector(query_embedding, k=top_k)
+    if lexical_index is not None:
+        results = hybrid_search(vector_store, embeddings, lexical_index, query, top_k)
+    else:
+        with span('retrieval.embed_query'):
+            query_embedding = embeddings.embed_query(query)
+        with span('retrieval.search', top_k=top_k):
+            results = vector_store.similarity_search_by_vector(query_embedding, k=top_k)
 
     # 提取目录结构和关键文件
     directory_structure = {}
@@ -78,13 +230,24 @@ def save_summary_to_json(summary, filename="codebase_summary.json"):
         json.dump(summary, f, indent=2, ensure_ascii=False)
 
 if __name__ == '__main__':
+    # TRACE_PATH=trace.json writes a Chrome trace of indexing and retrieval
+    trace_path = os.getenv("TRACE_PATH")
+    if trace_path:
+        enable_tracing()
+
+    # FAISS_INDEX_KIND=hnsw or ivfpq builds an approximate index for large repositories
+    index_config = IndexConfig(kind=os.getenv("FAISS_INDEX_KIND", "flat"))
+
     # 加载和嵌入文档
     print("Loading and embedding documents...")
-    vector_store, embeddings = load_and_embed_documents()
+    vector_store, embeddings = load_and_embed_documents(index_config=index_config)
     print("Loaded and embedded documents.")
 
+    lexical_index = load_lexical_index(vector_store)
+
     # 执行查询并生成 summary
-    summary = search_and_summarize(vector_store, embeddings, query="summarize the codebase")
+    summary = search_and_summarize(vector_store, embeddings, query="summarize the codebase",
+                                   lexical_index=lexical_index)
 
     # 打印结果
     print("Directory Structure:")
@@ -97,11 +260,16 @@ if __name__ == '__main__':
     save_summary_to_json(summary)
 
     # call openai api to generate a summary
+    from langchain_community.adapters import openai
     openai.api_key = os.getenv("OPENAI_API_KEY")
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": f"Please summarize the following codebase: {summary}"}
-        ]
+    messages = [
+        {"role": "user", "content": f"Please summarize the following codebase: {summary}"}
+    ]
+    response = default_cache().cached(
+        "gpt-4o-mini", messages,
+        lambda: openai.ChatCompletion.create(model="gpt-4o-mini", messages=messages)
     )
-    print(response)
\ No newline at end of file
+    print(response)
+    print("llm cache = ", default_cache().stats())
+    if trace_path:
+        export_trace(trace_path)
\ No newline at end of file
@@ -0,0 +1,194 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+
+__doc__ = """
+BM25 inverted index over code tokens, used next to the vector indexes
+
+identifiers are indexed whole and split at camelCase and snake_case boundaries (UserRequest -> userrequest,
+user, request), annotations also as @name, declared type names as decl:name, and URL path literals with
+every prefix (/api/users/{id} -> /api, /api/users, /api/users/{id}). queries that only name symbols, such as `UserRequest` or /api/users,
+are answered from this index alone, other queries fuse its ranking with the vector ranking by reciprocal rank.
+"""
+
+IDENTIFIER = re.compile(r'@?[A-Za-z_$][\w$]*')
+PATH_LITERAL = re.compile(r'["\'](/[^"\'\s]*)["\']')
+QUERY_PATH = re.compile(r'(?<![\w/])(/[\w{}\-./]*)')
+CAMEL_PARTS = re.compile(r'[A-Z]+(?=[A-Z][a-z]|\d|\b)|[A-Z]?[a-z]+|[A-Z]+|\d+')
+DECLARATION = re.compile(r'\b(?:class|interface|enum|record|@interface)\s+([A-Za-z_$][\w$]*)')
+BACKTICKED = re.compile(r'`([^`]+)`')
+SYMBOL = re.compile(r'^(@?[A-Za-z_$][\w$]*(\.[A-Za-z_$][\w$]*)*(\(\))?|/[\w{}\-./]*)$')
+
+# rank constant of reciprocal rank fusion, 60 is the value of the original paper
+RRF_K = 60
+
+
+def split_identifier(identifier):
+    parts = []
+    for piece in identifier.split('_'):
+        parts.extend(part.lower() for part in CAMEL_PARTS.findall(piece))
+    return parts
+
+
+def path_tokens(path):
+    tokens = []
+    segments = [segment for segment in path.strip('/').split('/') if segment]
+    for index in range(len(segments)):
+        tokens.append('/' + '/'.join(segments[:index + 1]).lower())
+    return tokens
+
+
+def tokenize(text, paths=PATH_LITERAL):
+    """
+    BM25 terms of a code chunk or a query
+    """
+    tokens = []
+    for match in IDENTIFIER.finditer(text):
+        word = match.group()
+        if word.startswith('@'):
+            word = word[1:]
+            tokens.append('@' + word.lower())
+        tokens.append(word.lower())
+        parts = split_identifier(word)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    for match in paths.finditer(text):
+        tokens.extend(path_tokens(match.group(1)))
+    # declared type names get a term of their own, so a symbol lookup ranks the definition above its uses
+    tokens.extend('decl:' + name.lower() for name in DECLARATION.findall(text))
+    return tokens
+
+
+def tokenize_query(query):
+    return tokenize(query, paths=QUERY_PATH)
+
+
+def symbol_query(query):
+    """
+    the symbols a query asks for when it is a pure symbol lookup, otherwise None
+
+    the query has to be nothing but identifiers. a backticked one counts as code, a bare one has to look like
+    it: a camel case name, a name with an underscore, an annotation, a qualified name or a path. a sentence,
+    even one with a backticked name in it, or a single capitalized word such as "Summarize" goes to hybrid
+    retrieval.
+    """
+    words = query.strip().split()
+    if not words:
+        return None
+    symbols = []
+    for word in words:
+        match = BACKTICKED.fullmatch(word)
+        symbol = match.group(1) if match else word
+        if not SYMBOL.match(symbol):
+            return None
+        # a backticked word is marked as code, a bare one has to look like it
+        if not match and not (symbol[0] in '@/' or '.' in symbol or '_' in symbol
+                              or re.search(r'[a-z0-9][A-Z]', symbol)):
+            return None
+        symbols.append(symbol)
+    return symbols
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K, limit=None):
+    """
+    fuse several ranked lists of ids into one, ids ranked high in any list come first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    fused = sorted(scores, key=lambda item: -scores[item])
+    return fused[:limit] if limit else fused
+
+
+class LexicalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {doc id: term frequency}
+        self.postings = {}
+        # doc id -> (length in terms, metadata, distinct terms), the terms make removing a document cheap
+        self.docs = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, text, metadata=None):
+        if doc_id in self.docs:
+            self.remove(doc_id)
+        metadata = metadata or {}
+        terms = tokenize(text)
+        # the file name is a symbol too: UserController.java finds every chunk of that file
+        source = metadata.get('file_path') or metadata.get('source')
+        if source:
+            terms.extend(tokenize(os.path.basename(source)))
+        counts = Counter(terms)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        self.docs[doc_id] = (len(terms), metadata, list(counts))
+        self.total_length += len(terms)
+
+    def remove(self, doc_id):
+        length, _, terms = self.docs.pop(doc_id, (0, None, ()))
+        self.total_length -= length
+        for term in terms:
+            documents = self.postings[term]
+            del documents[doc_id]
+            if not documents:
+                del self.postings[term]
+
+    def remove_where(self, key, value):
+        """
+        remove every document whose metadata[key] is value, such as all chunks of a deleted file
+        """
+        for doc_id in [doc_id for doc_id, (_, metadata, _) in self.docs.items()
+                       if metadata.get(key) == value]:
+            self.remove(doc_id)
+
+    def search(self, query, k=10, terms=None):
+        """
+        (doc id, BM25 score) of the best k documents, best first
+        """
+        if not self.docs:
+            return []
+        terms = terms if terms is not None else tokenize_query(query)
+        count = len(self.docs)
+        average_length = self.total_length / count
+        scores = {}
+        for term in set(terms):
+            documents = self.postings.get(term)
+            if not documents:
+                continue
+            idf = math.log(1 + (count - len(documents) + 0.5) / (len(documents) + 0.5))
+            for doc_id, frequency in documents.items():
+                length = self.docs[doc_id][0]
+                norm = frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    def search_symbols(self, symbols, k=10):
+        terms = []
+        for symbol in symbols:
+            symbol = symbol.rstrip('()')
+            terms.extend(tokenize_query(symbol))
+            terms.append('decl:' + symbol.rsplit('.', 1)[-1].lower())
+        return self.search('', k, terms=terms)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'docs': self.docs, 'postings': self.postings}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        index = cls(data['k1'], data['b'])
+        index.docs = {doc_id: tuple(doc) for doc_id, doc in data['docs'].items()}
+        index.postings = data['postings']
+        index.total_length = sum(doc[0] for doc in index.docs.values())
+        return index
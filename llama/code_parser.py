@@ -1,14 +1,29 @@
 import asyncio
-from typing import List, Optional
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
 
-from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex, load_index_from_storage
 from llama_index.core.agent.workflow import AgentWorkflow
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.node_parser import CodeSplitter
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.llms.ollama import Ollama
 from llama_index.llms.openai import OpenAI
 from llama_index.embeddings.openai import OpenAIEmbedding
 
+from embedding_server import SentenceTransformerBackend, default_backend
+from lexical_index import LexicalIndex
+from llama.embedding_backend import BackendEmbedding
+from llama.hybrid_retriever import HybridRetriever
+from llama.mmap_vector_store import MmapVectorStore
+from tracing import span
+
+MANIFEST_FILE = "file_manifest.json"
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
 
 class CodeParser:
     """A class to handle code parsing and querying using LlamaIndex."""
@@ -20,7 +35,10 @@ class CodeParser:
         llm_model: str = "llama3.1:latest",
         # llm_model: str = "gpt-4o-mini",
         storage_path: str = "storage",
-        language: str = "java"
+        language: str = "java",
+        embed_model: Optional[BaseEmbedding] = None,
+        embed_backend: Optional[str] = None,
+        vector_store: str = "simple"
     ):
         """Initialize the CodeParser with configuration parameters.
         
@@ -30,45 +48,221 @@ class CodeParser:
             llm_model: Name of the LLM model to use
             storage_path: Path to store the index
             language: Programming language of the code files
+            embed_model: Embedding model to use instead of loading model_name
+            embed_backend: "torch" or "quantized" (int8 ONNX Runtime on CPU) when
+                model_name is loaded in process, EMBEDDING_BACKEND by default
+            vector_store: "simple" for the JSON vector store of LlamaIndex, "mmap"
+                for a memory-mapped float32 array, "mmap-float16" for half precision
         """
         self.input_dir = input_dir
         self.storage_path = storage_path
+        self.vector_store = vector_store
+        # BM25 index over the same nodes, built and updated together with the vector index
+        self.lexical_index = LexicalIndex()
         
         # Configure settings
-        self._setup_settings(model_name, llm_model, language)
+        self.embed_backend = embed_backend or os.getenv("EMBEDDING_BACKEND", "torch")
+        # model, backend and dimension of the embeddings, compared with the manifest
+        self._embedding: Optional[Dict[str, object]] = None
+        self._setup_settings(model_name, llm_model, language, embed_model)
         
         # Initialize components
         self.index = self._create_index()
         self.query_engine = self._create_query_engine()
         self.agent = self._create_agent()
 
-    def _setup_settings(self, model_name: str, llm_model: str, language: str) -> None:
+    def _setup_settings(
+        self, model_name: str, llm_model: str, language: str, embed_model: Optional[BaseEmbedding] = None
+    ) -> None:
         """Configure LlamaIndex settings."""
         code_splitter = CodeSplitter(language=language)
         Settings.code_splitter = code_splitter
-        Settings.embed_model = HuggingFaceEmbedding(model_name=model_name)
+        Settings.embed_model = embed_model or self._default_embed_model(model_name)
         # Settings.embed_model = OpenAIEmbedding(embed_batch_size=42)
-        Settings.llm = Ollama(model=llm_model, request_timeout=360.0)
+        Settings.llm = Ollama(model=llm_model, base_url=os.getenv("OLLAMA_HOST", "http://localhost:11434"),
+                              request_timeout=360.0)
         # Settings.llm = OpenAI(model=llm_model)
 
+    def _default_embed_model(self, model_name: str) -> BaseEmbedding:
+        """Use the resident embedding server when it runs, otherwise load the model in process."""
+        backend = default_backend(model_name)
+        if backend is not None:
+            return BackendEmbedding(backend, model_name)
+        if self.embed_backend == "quantized":
+            from quantized_embedding import QuantizedBackend
+            # LlamaIndex splits the nodes into embed_batch_size texts, the backend groups them by length
+            return BackendEmbedding(QuantizedBackend(model_name), model_name, embed_batch_size=1024)
+        # the backend the server runs with --backend torch, so both compute the same embedding space
+        return BackendEmbedding(SentenceTransformerBackend(model_name), model_name)
+
     def _create_index(self) -> VectorStoreIndex:
-        """Create and persist the vector store index."""
-        documents = SimpleDirectoryReader(
-            input_dir=self.input_dir,
-            required_exts=['.java'],
-            recursive=True
-        ).load_data()
-        
-        index = VectorStoreIndex.from_documents(
-            documents,
-            transformations=[Settings.code_splitter]
-        )
+        """Load the persisted index and re-embed only the files that changed.
+
+        A manifest of per-file content hashes is kept next to the persisted
+        storage context. Files that were added or modified since the last run
+        are re-embedded, nodes of removed files are deleted, and an unchanged
+        repository is only loaded from disk. The lexical index follows the
+        same updates.
+        """
+        with span('index.walk', input_dir=self.input_dir) as walk:
+            current = self._hash_files()
+            walk.set(files=len(current))
+        previous = self._load_manifest()
+        if previous is None:
+            return self._build_index(current)
+
+        with span('index.load_storage', storage_path=self.storage_path):
+            storage_context = StorageContext.from_defaults(persist_dir=self.storage_path,
+                                                           vector_store=self._create_vector_store())
+            index = load_index_from_storage(storage_context, transformations=[Settings.code_splitter])
+
+        self.lexical_index = self._load_lexical_index(index)
+
+        removed = previous.keys() - current.keys()
+        changed = sorted(path for path, digest in current.items() if previous.get(path) != digest)
+        if not removed and not changed:
+            return index
+
+        for path in sorted(removed) + [path for path in changed if path in previous]:
+            index.delete_ref_doc(path, delete_from_docstore=True)
+            self.lexical_index.remove_where('file_path', path)
+        if changed:
+            documents = self._load_documents(changed)
+            nodes = self._split(documents)
+            with span('index.embed', nodes=len(nodes)):
+                index.insert_nodes(nodes)
+            self._add_lexical(nodes)
+            for document in documents:
+                index.docstore.set_document_hash(document.doc_id, document.hash)
+        print(f"Re-indexed {len(changed)} changed and removed {len(removed)} deleted files")
+
+        index.storage_context.persist(self.storage_path)
+        self.lexical_index.save(os.path.join(self.storage_path, LEXICAL_INDEX_FILE))
+        self._save_manifest(current)
+        return index
+
+    def _build_index(self, hashes: Dict[str, str]) -> VectorStoreIndex:
+        """Embed every file from scratch and persist the index with its manifest."""
+        documents = self._load_documents(sorted(hashes))
+        nodes = self._split(documents)
+        # the same as VectorStoreIndex.from_documents, with splitting and embedding traced apart
+        # vectors of an earlier build would be mapped and appended to
+        MmapVectorStore.remove(self.storage_path)
+        storage_context = StorageContext.from_defaults(vector_store=self._create_vector_store())
+        for document in documents:
+            storage_context.docstore.set_document_hash(document.doc_id, document.hash)
+        with span('index.embed', nodes=len(nodes)):
+            index = VectorStoreIndex(nodes, storage_context=storage_context, transformations=[Settings.code_splitter])
+        self._add_lexical(nodes)
         index.storage_context.persist(self.storage_path)
+        self.lexical_index.save(os.path.join(self.storage_path, LEXICAL_INDEX_FILE))
+        self._save_manifest(hashes)
         return index
 
+    def _create_vector_store(self) -> Optional[MmapVectorStore]:
+        """Map the persisted vectors for the mmap store, None selects the default JSON store."""
+        if not self.vector_store.startswith("mmap"):
+            return None
+        dtype = "float16" if self.vector_store == "mmap-float16" else "float32"
+        return MmapVectorStore(persist_dir=self.storage_path, dtype=dtype)
+
+    def _add_lexical(self, nodes: list) -> None:
+        """Add nodes to the lexical index under their node ids."""
+        with span('index.lexical', nodes=len(nodes)):
+            for node in nodes:
+                self.lexical_index.add(node.node_id, node.get_content(), node.metadata)
+
+    def _load_lexical_index(self, index: VectorStoreIndex) -> LexicalIndex:
+        """Load the persisted lexical index, or rebuild it from the docstore of an older storage."""
+        path = os.path.join(self.storage_path, LEXICAL_INDEX_FILE)
+        if os.path.exists(path):
+            with span('index.load_lexical'):
+                return LexicalIndex.load(path)
+        lexical_index = LexicalIndex()
+        for node_id, node in index.docstore.docs.items():
+            lexical_index.add(node_id, node.get_content(), node.metadata)
+        lexical_index.save(path)
+        return lexical_index
+
+    def _split(self, documents: List[Document]) -> list:
+        """Split documents into code nodes with the configured splitter."""
+        with span('index.split', documents=len(documents)) as current:
+            nodes = run_transformations(documents, [Settings.code_splitter])
+            current.set(nodes=len(nodes))
+        return nodes
+
+    def _hash_files(self) -> Dict[str, str]:
+        """Return the sha256 content hash of every code file under input_dir."""
+        hashes = {}
+        for root, dirs, files in os.walk(self.input_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for file in files:
+                if file.endswith('.java') and not file.startswith('.'):
+                    path = os.path.join(root, file)
+                    with open(path, 'rb') as f:
+                        hashes[path] = hashlib.sha256(f.read()).hexdigest()
+        return hashes
+
+    def _load_documents(self, paths: List[str]) -> List[Document]:
+        """Load the given files as documents whose id is their file path."""
+        documents = []
+        with span('index.load', files=len(paths)) as current:
+            for path in paths:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                current.add('bytes', len(text.encode('utf-8')))
+                documents.append(Document(
+                    text=text,
+                    id_=path,
+                    metadata={'file_path': path, 'file_name': os.path.basename(path)}
+                ))
+        return documents
+
+    def _embedding_info(self) -> Dict[str, object]:
+        """Return the model, backend and dimension that identify the embedding space of the vectors.
+
+        A backend embedding reports the backend that computes the vectors, the embedding server's
+        when it runs, other embedding models are probed once for their dimension.
+        """
+        if self._embedding is None:
+            embed_model = Settings.embed_model
+            if isinstance(embed_model, BackendEmbedding):
+                info = embed_model.backend_info()
+            else:
+                info = {"backend": embed_model.class_name(), "dimension": None}
+            if info["dimension"] is None:
+                info["dimension"] = len(embed_model.get_text_embedding("dimension"))
+            self._embedding = {"model_name": embed_model.model_name, **info}
+        return self._embedding
+
+    def _load_manifest(self) -> Optional[Dict[str, str]]:
+        """Return the stored file hashes, or None when no usable index is persisted."""
+        manifest_path = os.path.join(self.storage_path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path) or not os.path.exists(os.path.join(self.storage_path, "docstore.json")):
+            return None
+        # storage persisted with the other vector store kind is embedded again
+        if self.vector_store.startswith("mmap") != MmapVectorStore.exists(self.storage_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        # vectors of another model or backend are in another embedding space, manifests
+        # written before the embedding was recorded count as another one
+        if manifest.get("embedding") != self._embedding_info():
+            print("Embedding model changed, re-indexing every file")
+            return None
+        return manifest["files"]
+
+    def _save_manifest(self, hashes: Dict[str, str]) -> None:
+        """Atomically write the file hashes and the embedding next to the persisted storage context."""
+        manifest_path = os.path.join(self.storage_path, MANIFEST_FILE)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"embedding": self._embedding_info(), "files": hashes}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
     def _create_query_engine(self):
-        """Create the query engine."""
-        return self.index.as_query_engine(llm=Settings.llm)
+        """Create the query engine over the hybrid BM25 and vector retriever."""
+        return RetrieverQueryEngine.from_args(HybridRetriever(self.index, self.lexical_index), llm=Settings.llm)
 
     def _create_agent(self) -> AgentWorkflow:
         """Create the agent workflow."""
@@ -88,7 +282,8 @@ class CodeParser:
         Returns:
             str: The response from the query engine
         """
-        response = await self.query_engine.aquery(query)
+        async with span('retrieval.query', query=query):
+            response = await self.query_engine.aquery(query)
         return str(response)
 
     async def analyze_repository(self) -> str:
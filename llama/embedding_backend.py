@@ -0,0 +1,86 @@
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from embedding_server import backend_info
+
+# instruction BGE English models expect in front of retrieval queries
+BGE_QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+
+
+def query_instruction_for(model_name: str) -> Optional[str]:
+    """Return the query instruction a model was trained with, if any."""
+    name = model_name.lower()
+    if "bge-" in name and "-en" in name:
+        return BGE_QUERY_INSTRUCTION
+    return None
+
+
+class BackendEmbedding(BaseEmbedding):
+    """LlamaIndex embedding model that delegates to an embedding backend.
+
+    A backend is any object with ``embed(texts) -> List[List[float]]`` and optionally an
+    async ``aembed(texts)``, such as the client of the resident embedding server.
+    """
+
+    query_instruction: Optional[str] = None
+    _backend: Any = PrivateAttr()
+
+    def __init__(
+        self,
+        backend: Any,
+        model_name: str,
+        query_instruction: Optional[str] = None,
+        embed_batch_size: int = 64,
+        **kwargs: Any,
+    ):
+        """Initialize the embedding model.
+
+        Args:
+            backend: Object computing the embeddings
+            model_name: Name of the model the backend runs
+            query_instruction: Prefix for queries, the model's default when None
+            embed_batch_size: Number of texts sent to the backend at once
+        """
+        super().__init__(
+            model_name=model_name,
+            embed_batch_size=embed_batch_size,
+            query_instruction=query_instruction or query_instruction_for(model_name),
+            **kwargs,
+        )
+        self._backend = backend
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BackendEmbedding"
+
+    def backend_info(self) -> Dict[str, Any]:
+        """Return the name and dimension of the backend, the server's when it is a client."""
+        return backend_info(self._backend)
+
+    def _query_text(self, query: str) -> str:
+        return f"{self.query_instruction}{query}" if self.query_instruction else query
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._backend.embed([self._query_text(query)])[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._backend.embed([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._backend.embed(texts)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return (await self._aembed([self._query_text(query)]))[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aembed([text]))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed(texts)
+
+    async def _aembed(self, texts: List[str]) -> List[List[float]]:
+        if hasattr(self._backend, "aembed"):
+            return await self._backend.aembed(texts)
+        return self._backend.embed(texts)
@@ -0,0 +1,52 @@
+from typing import List
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, symbol_query
+from tracing import span
+
+
+class HybridRetriever(BaseRetriever):
+    """Retrieve code nodes by fusing BM25 and vector search rankings.
+
+    Pure symbol queries, such as `UserRequest` or /api/users, are answered from the
+    lexical index alone, so they never embed the query. When the lexical index has
+    no hit for them they fall back to the fused ranking.
+    """
+
+    def __init__(self, index: VectorStoreIndex, lexical_index: LexicalIndex, similarity_top_k: int = 5):
+        """Initialize the retriever.
+
+        Args:
+            index: Vector index whose docstore holds the nodes of lexical_index
+            lexical_index: BM25 index over the same node ids
+            similarity_top_k: Number of nodes to return
+        """
+        super().__init__()
+        self.index = index
+        self.lexical_index = lexical_index
+        self.similarity_top_k = similarity_top_k
+        self.vector_retriever = index.as_retriever(similarity_top_k=similarity_top_k)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Return the fused ranking, scored by reciprocal rank."""
+        symbols = symbol_query(query_bundle.query_str)
+        if symbols:
+            with span('retrieval.lexical', top_k=self.similarity_top_k, symbol_query=True):
+                hits = self.lexical_index.search_symbols(symbols, self.similarity_top_k)
+            if hits:
+                return [NodeWithScore(node=self.index.docstore.get_node(node_id), score=score)
+                        for node_id, score in hits]
+
+        with span('retrieval.vector', top_k=self.similarity_top_k):
+            vector_nodes = self.vector_retriever.retrieve(query_bundle)
+        with span('retrieval.lexical', top_k=self.similarity_top_k, symbol_query=False):
+            lexical_ids = [node_id for node_id, _ in
+                           self.lexical_index.search(query_bundle.query_str, self.similarity_top_k)]
+        nodes = {result.node.node_id: result.node for result in vector_nodes}
+        fused = reciprocal_rank_fusion([list(nodes), lexical_ids], limit=self.similarity_top_k)
+        return [NodeWithScore(node=nodes.get(node_id) or self.index.docstore.get_node(node_id),
+                              score=1.0 / (rank + 1))
+                for rank, node_id in enumerate(fused)]
@@ -1,26 +1,41 @@
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings
 from llama_index.core.agent.workflow import AgentWorkflow
 from llama_index.llms.ollama import Ollama
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 import asyncio
 import os
 
-# Settings control global defaults
-Settings.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-base-en-v1.5")
-Settings.llm = Ollama(model="llama3.2:3b", request_timeout=360.0)
+from embedding_server import default_backend
+from llama.embedding_backend import BackendEmbedding
 
-# Create a RAG tool using LlamaIndex
-documents = SimpleDirectoryReader("data").load_data()
-index = VectorStoreIndex.from_documents(
-    documents,
-    # we can optionally override the embed_model here
-    embed_model=Settings.embed_model,
-)
-index.storage_context.persist("storage")
-query_engine = index.as_query_engine(
-    # we can optionally override the llm here
-    llm=Settings.llm,
-)
+EMBED_MODEL_NAME = "BAAI/bge-base-en-v1.5"
+
+query_engine = None
+
+
+def setup():
+    """Configure the models and build the RAG index, only when the agent is about to run."""
+    global query_engine
+    # Settings control global defaults
+    backend = default_backend(EMBED_MODEL_NAME)
+    if backend is not None:
+        Settings.embed_model = BackendEmbedding(backend, EMBED_MODEL_NAME)
+    else:
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        Settings.embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME)
+    Settings.llm = Ollama(model="llama3.2:3b", request_timeout=360.0)
+
+    # Create a RAG tool using LlamaIndex
+    documents = SimpleDirectoryReader("data").load_data()
+    index = VectorStoreIndex.from_documents(
+        documents,
+        # we can optionally override the embed_model here
+        embed_model=Settings.embed_model,
+    )
+    index.storage_context.persist("storage")
+    query_engine = index.as_query_engine(
+        # we can optionally override the llm here
+        llm=Settings.llm,
+    )
 
 
 def multiply(a: float, b: float) -> float:
@@ -34,17 +49,20 @@ async def search_documents(query: str) -> str:
     return str(response)
 
 
-# Create an enhanced workflow with both tools
-agent = AgentWorkflow.from_tools_or_functions(
-    [multiply, search_documents],
-    llm=Settings.llm,
-    system_prompt="""You are a helpful assistant that can perform calculations
-    and search through documents to answer questions.""",
-)
+def create_agent():
+    # Create an enhanced workflow with both tools
+    return AgentWorkflow.from_tools_or_functions(
+        [multiply, search_documents],
+        llm=Settings.llm,
+        system_prompt="""You are a helpful assistant that can perform calculations
+        and search through documents to answer questions.""",
+    )
 
 
 # Now we can ask questions about the documents or do calculations
 async def main():
+    setup()
+    agent = create_agent()
     response = await agent.run(
         "What did the author do in college? Also, what's 7 * 8?"
     )
@@ -53,4 +71,4 @@ async def main():
 
 # Run the agent
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
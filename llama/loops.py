@@ -7,7 +7,6 @@ from llama_index.core.workflow import (
     step,
     Event
 )
-from llama_index.utils.workflow import draw_all_possible_flows
 
 
 class LoopEvent(Event):
@@ -60,13 +59,27 @@ class BranchWorkflow(Workflow):
         print(ev.payload)
         return StopEvent(result="Branch B complete.")
 
-draw_all_possible_flows(BranchWorkflow, filename="basic_workflow.html")
+
 async def main():
     w = BranchWorkflow(timeout=10, verbose=False)
     result = await w.run(first_input="Start the workflow.")
     print(result)
 
+
+def draw(filename="basic_workflow.html"):
+    from llama_index.utils.workflow import draw_all_possible_flows
+
+    draw_all_possible_flows(BranchWorkflow, filename=filename)
+
+
 if __name__ == "__main__":
+    import argparse
     import asyncio
 
-    asyncio.run(main())
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--draw", help="write the workflow graph to this HTML file and exit")
+    args = arg_parser.parse_args()
+    if args.draw:
+        draw(args.draw)
+    else:
+        asyncio.run(main())
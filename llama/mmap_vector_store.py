@@ -0,0 +1,345 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import fsspec
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from tracing import span
+
+VECTORS_FILE = "vectors.bin"
+SIDECAR_FILE = "vectors.json"
+
+# rows scored per matrix product, bounds the memory of a query over a large mapped file
+QUERY_CHUNK_ROWS = 65536
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """Vector store that keeps embeddings in one memory-mapped array file.
+
+    Embeddings are stored normalized as a contiguous row-major float32 or float16
+    array in vectors.bin, node and document ids and the flat node metadata used by
+    metadata filters in the sidecar vectors.json. Loading
+    maps the file without reading it, the OS pages vectors in when a query touches
+    them. A query is a chunked matrix product over the mapped rows, so cosine
+    similarity never creates a Python object per node. Metadata is kept in one
+    column per key, so filters are NumPy masks over the rows, and deletes by
+    document look their rows up in an index.
+
+    Deleted rows are tombstoned and dropped when the store is persisted. Appends
+    without deletions are written to the end of the existing file.
+    """
+
+    stores_text: bool = False
+    flat_metadata: bool = True
+
+    persist_dir: str
+    dtype: str = "float32"
+
+    _vectors: Optional[np.ndarray] = PrivateAttr(default=None)
+    _pending: List[np.ndarray] = PrivateAttr(default_factory=list)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    # metadata key -> value of every row, None where a node has no such key
+    _columns: Dict[str, List[Any]] = PrivateAttr(default_factory=dict)
+    # object arrays of the columns used by filters, rebuilt after rows are added or compacted
+    _arrays: Dict[str, np.ndarray] = PrivateAttr(default_factory=dict)
+    # node id -> row, so node_ids filters index the array instead of scanning every id
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+    # ref doc id -> rows of its nodes, so deleting a document does not scan every row
+    _doc_rows: Dict[Optional[str], List[int]] = PrivateAttr(default_factory=dict)
+    _deleted: set = PrivateAttr(default_factory=set)
+    _dimension: Optional[int] = PrivateAttr(default=None)
+    # rows of vectors.bin when it was mapped, rows past it are pending and not written yet
+    _persisted_rows: int = PrivateAttr(default=0)
+
+    def __init__(self, persist_dir: str, dtype: str = "float32", **kwargs: Any) -> None:
+        """Initialize an empty store, or map the vectors persisted in persist_dir.
+
+        Args:
+            persist_dir: Directory of vectors.bin and vectors.json
+            dtype: Storage precision of the vectors, float32 or float16
+        """
+        super().__init__(persist_dir=persist_dir, dtype=dtype, **kwargs)
+        if self.exists(persist_dir):
+            self._load()
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        """Return whether persist_dir holds a persisted store."""
+        return os.path.exists(os.path.join(persist_dir, SIDECAR_FILE))
+
+    @staticmethod
+    def remove(persist_dir: str) -> None:
+        """Delete the files of a persisted store in persist_dir."""
+        for name in (SIDECAR_FILE, VECTORS_FILE):
+            path = os.path.join(persist_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, dtype: str = "float32") -> "MmapVectorStore":
+        """Map the store persisted in persist_dir, the stored dtype wins over dtype."""
+        return cls(persist_dir=persist_dir, dtype=dtype)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def count(self) -> int:
+        """Return the number of vectors that are not deleted."""
+        # not __len__, an empty store would be falsy and StorageContext.from_defaults would ignore it
+        return len(self._node_ids) - len(self._deleted)
+
+    def _load(self) -> None:
+        """Read the sidecar and map the vector file read-only."""
+        with span('index.load_vectors', persist_dir=self.persist_dir) as current:
+            with open(os.path.join(self.persist_dir, SIDECAR_FILE), 'r', encoding='utf-8') as f:
+                sidecar = json.load(f)
+            self.dtype = sidecar['dtype']
+            self._dimension = sidecar['dimension']
+            self._node_ids = sidecar['node_ids']
+            self._ref_doc_ids = sidecar['ref_doc_ids']
+            # stores persisted before metadata was kept match no metadata filter
+            self._columns = sidecar.get('columns', {})
+            self._index_rows()
+            self._persisted_rows = len(self._node_ids)
+            self._vectors = self._map(self._persisted_rows)
+            current.set(rows=self._persisted_rows)
+
+    def _index_rows(self) -> None:
+        self._rows = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._doc_rows = {}
+        for row, doc_id in enumerate(self._ref_doc_ids):
+            self._doc_rows.setdefault(doc_id, []).append(row)
+        self._arrays = {}
+
+    def _map(self, rows: int) -> Optional[np.ndarray]:
+        if not rows:
+            return None
+        return np.memmap(os.path.join(self.persist_dir, VECTORS_FILE), dtype=self.dtype, mode='r',
+                         shape=(rows, self._dimension))
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add the embeddings of nodes, normalized to unit length."""
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], dtype='float32')
+        if self._dimension is None:
+            self._dimension = vectors.shape[1]
+        elif vectors.shape[1] != self._dimension:
+            raise ValueError(f"embedding dimension {vectors.shape[1]} does not match the store ({self._dimension})")
+        vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        self._pending.append(vectors.astype(self.dtype))
+        for node in nodes:
+            row = len(self._node_ids)
+            # a node added again replaces its earlier row
+            if node.node_id in self._rows:
+                self._deleted.add(self._rows[node.node_id])
+            self._rows[node.node_id] = row
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id)
+            self._doc_rows.setdefault(node.ref_doc_id, []).append(row)
+            for key, value in node.metadata.items():
+                if value is None or isinstance(value, (str, int, float, bool)):
+                    self._columns.setdefault(key, [None] * row).append(value)
+            for column in self._columns.values():
+                if len(column) == row:
+                    column.append(None)
+        self._arrays = {}
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Tombstone the rows of every node of ref_doc_id."""
+        self._deleted.update(self._doc_rows.pop(ref_doc_id, []))
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Any = None, **delete_kwargs: Any) -> None:
+        """Tombstone the rows of node_ids that match filters, every row matching filters without node_ids."""
+        if node_ids is None and filters is None:
+            return
+        selected = self._select(node_ids, filters)
+        self._deleted.update(np.flatnonzero(selected).tolist())
+
+    def _select(self, node_ids: Optional[List[str]], filters: Any) -> Optional[np.ndarray]:
+        """Return a row mask of node_ids that match the metadata filters, None when both are empty."""
+        if not node_ids and filters is None:
+            return None
+        if node_ids:
+            selected = np.zeros(len(self._node_ids), dtype=bool)
+            selected[[self._rows[node_id] for node_id in node_ids if node_id in self._rows]] = True
+        else:
+            selected = np.ones(len(self._node_ids), dtype=bool)
+        if filters is not None and filters.filters:
+            selected &= self._match(filters)
+        return selected
+
+    def _column(self, key: str) -> np.ndarray:
+        """Return the values of key as an object array with one entry per row."""
+        array = self._arrays.get(key)
+        if array is None:
+            array = np.empty(len(self._node_ids), dtype=object)
+            if key in self._columns:
+                array[:] = self._columns[key]
+            self._arrays[key] = array
+        return array
+
+    def _match(self, filters: MetadataFilters) -> np.ndarray:
+        """Return the row mask of filters, with the semantics of the SimpleVectorStore filters."""
+        masks = [self._match(item) if isinstance(item, MetadataFilters) else self._match_filter(item)
+                 for item in filters.filters]
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        if filters.condition == FilterCondition.NOT:
+            return ~np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def _match_filter(self, metadata_filter: Any) -> np.ndarray:
+        column = self._column(metadata_filter.key)
+        operator, value = metadata_filter.operator, metadata_filter.value
+        present = np.not_equal(column, None)
+        if operator == FilterOperator.IS_EMPTY:
+            return ~present | np.equal(column, "")
+        # a row without the key only matches the negated operators
+        mask = np.zeros(len(column), dtype=bool)
+        values = column[present]
+        if operator == FilterOperator.EQ:
+            mask[present] = np.equal(values, value).astype(bool)
+        elif operator == FilterOperator.NE:
+            mask[present] = np.not_equal(values, value).astype(bool)
+            mask[~present] = True
+        elif operator == FilterOperator.GT:
+            mask[present] = np.greater(values, value).astype(bool)
+        elif operator == FilterOperator.GTE:
+            mask[present] = np.greater_equal(values, value).astype(bool)
+        elif operator == FilterOperator.LT:
+            mask[present] = np.less(values, value).astype(bool)
+        elif operator == FilterOperator.LTE:
+            mask[present] = np.less_equal(values, value).astype(bool)
+        elif operator in (FilterOperator.IN, FilterOperator.NIN):
+            found = np.zeros(len(values), dtype=bool)
+            for item in value:
+                found |= np.equal(values, item).astype(bool)
+            mask[present] = found if operator == FilterOperator.IN else ~found
+            if operator == FilterOperator.NIN:
+                mask[~present] = True
+        else:
+            # the metadata is flat, so containment operators test substrings of string values
+            text = values.astype(str)
+            if operator == FilterOperator.TEXT_MATCH_INSENSITIVE:
+                text, value = np.char.lower(text), value.lower()
+            needles = value if operator in (FilterOperator.ANY, FilterOperator.ALL) else [value]
+            found = [np.char.find(text, str(needle)) >= 0 for needle in needles]
+            if operator == FilterOperator.ANY:
+                mask[present] = np.logical_or.reduce(found) if found else False
+            else:
+                mask[present] = np.logical_and.reduce(found) if found else True
+        return mask
+
+    def clear(self) -> None:
+        """Remove every vector, the file is truncated by the next persist."""
+        self._deleted.update(range(len(self._node_ids)))
+
+    def _blocks(self):
+        """Yield (first row, rows) of the mapped file in chunks, then the pending arrays."""
+        if self._vectors is not None:
+            for start in range(0, self._persisted_rows, QUERY_CHUNK_ROWS):
+                yield start, self._vectors[start:start + QUERY_CHUNK_ROWS]
+        start = self._persisted_rows
+        for block in self._pending:
+            yield start, block
+            start += len(block)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Return the similarity_top_k rows with the highest cosine similarity among the selected rows."""
+        top_k = query.similarity_top_k
+        if query.query_embedding is None or not self.count():
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        vector = np.asarray(query.query_embedding, dtype='float32')
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        allowed = self._select(query.node_ids, query.filters)
+        deleted = np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted))
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype='float32')
+        with span('retrieval.vector_scan', rows=len(self._node_ids), top_k=top_k):
+            for start, block in self._blocks():
+                scores = np.asarray(block, dtype='float32') @ vector
+                end = start + len(block)
+                if len(deleted):
+                    in_block = deleted[(deleted >= start) & (deleted < end)]
+                    scores[in_block - start] = -np.inf
+                if allowed is not None:
+                    scores[~allowed[start:end]] = -np.inf
+                if len(scores) > top_k:
+                    candidates = np.argpartition(-scores, top_k)[:top_k]
+                else:
+                    candidates = np.arange(len(scores))
+                best_rows = np.concatenate([best_rows, candidates + start])
+                best_scores = np.concatenate([best_scores, scores[candidates]])
+                # only the best top_k of all chunks so far are kept
+                if len(best_scores) > top_k:
+                    keep = np.argpartition(-best_scores, top_k)[:top_k]
+                    best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores, kind='stable')
+        order = order[np.isfinite(best_scores[order])]
+        return VectorStoreQueryResult(ids=[self._node_ids[row] for row in best_rows[order].tolist()],
+                                      similarities=best_scores[order].tolist())
+
+    def persist(self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None) -> None:
+        """Write pending vectors and the sidecar to persist_dir.
+
+        persist_path is the per-namespace file name of the storage context, the store
+        always writes its two files to persist_dir instead.
+        """
+        os.makedirs(self.persist_dir, exist_ok=True)
+        path = os.path.join(self.persist_dir, VECTORS_FILE)
+        with span('index.persist_vectors', rows=len(self._node_ids), deleted=len(self._deleted)):
+            if self._deleted:
+                self._compact(path)
+            elif self._pending:
+                # a new store starts a new file, otherwise the rows go after the mapped ones
+                with open(path, 'ab' if self._persisted_rows else 'wb') as f:
+                    for block in self._pending:
+                        f.write(np.ascontiguousarray(block).tobytes())
+            self._pending = []
+            self._persisted_rows = len(self._node_ids)
+            self._write_sidecar()
+            self._vectors = self._map(self._persisted_rows)
+
+    def _compact(self, path: str) -> None:
+        """Rewrite the file without tombstoned rows."""
+        keep = np.ones(len(self._node_ids), dtype=bool)
+        keep[list(self._deleted)] = False
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            for start, block in self._blocks():
+                f.write(np.ascontiguousarray(block[keep[start:start + len(block)]]).tobytes())
+        self._vectors = None
+        os.replace(tmp_path, path)
+        self._columns = {key: self._column(key)[keep].tolist() for key in self._columns}
+        self._node_ids = [node_id for node_id, kept in zip(self._node_ids, keep) if kept]
+        self._ref_doc_ids = [doc_id for doc_id, kept in zip(self._ref_doc_ids, keep) if kept]
+        self._index_rows()
+        self._deleted = set()
+
+    def _write_sidecar(self) -> None:
+        sidecar_path = os.path.join(self.persist_dir, SIDECAR_FILE)
+        tmp_path = sidecar_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dtype': self.dtype, 'dimension': self._dimension, 'node_ids': self._node_ids,
+                       'ref_doc_ids': self._ref_doc_ids, 'columns': self._columns}, f, separators=(',', ':'))
+        os.replace(tmp_path, sidecar_path)
@@ -5,7 +5,6 @@ from llama_index.core.workflow import (
     step,
     Event
 )
-from llama_index.utils.workflow import draw_all_possible_flows
 
 class FirstEvent(Event):
     first_output: str
@@ -30,14 +29,27 @@ class MyWorkflow(Workflow):
         print(ev.second_output)
         return StopEvent(result="Workflow complete.")
 
-draw_all_possible_flows(MyWorkflow, filename="basic_workflow.html")
+
 async def main():
     w = MyWorkflow(timeout=10, verbose=False)
     result = await w.run(first_input="Start the workflow.")
     print(result)
 
 
+def draw(filename="basic_workflow.html"):
+    from llama_index.utils.workflow import draw_all_possible_flows
+
+    draw_all_possible_flows(MyWorkflow, filename=filename)
+
+
 if __name__ == "__main__":
+    import argparse
     import asyncio
 
-    asyncio.run(main())
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--draw", help="write the workflow graph to this HTML file and exit")
+    args = arg_parser.parse_args()
+    if args.draw:
+        draw(args.draw)
+    else:
+        asyncio.run(main())
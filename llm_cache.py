@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from tracing import span
+
+__doc__ = """
+content addressed on-disk cache of LLM responses, shared by every model call in this project
+
+the key is a hash of model, full message list, format schema and temperature, so a byte identical prompt
+is answered from disk instead of running the model again. entries are evicted least recently used first
+once the cache grows over max_bytes. every call site can opt out with use_cache=False.
+"""
+
+DEFAULT_CACHE_PATH = os.getenv('LLM_CACHE_PATH', '.llm_cache.sqlite3')
+DEFAULT_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def cache_key(model, messages, format=None, temperature=None):
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'format': format, 'temperature': temperature},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # one connection shared by the threads of a process, guarded by the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """
+        the cached response for key, or None on a miss
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        store a JSON serializable response and evict least recently used entries over max_bytes
+        """
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        with self._lock:
+            old = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time())
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.evictions += 1
+
+    def cached(self, model, messages, call, format=None, temperature=None, use_cache=True):
+        """
+        return the cached response of this request, or run call() and cache what it returns
+        """
+        if not use_cache:
+            return call()
+        key = cache_key(model, messages, format, temperature)
+        value = self.get(key)
+        if value is None:
+            value = call()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self._total_bytes = 0
+
+
+_default_cache = None
+
+
+def default_cache():
+    """
+    the process wide cache at LLM_CACHE_PATH, opened on first use
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = LLMCache()
+    return _default_cache
+
+
+def chat(model, messages, format=None, options=None, use_cache=True, cache=None, **kwargs):
+    """
+    ollama.chat without streaming, returns the message content and answers repeated requests from the cache
+    """
+    from ollama import chat as ollama_chat
+
+    temperature = (options or {}).get('temperature')
+    with span('llm.chat', model=model, cache_hit=use_cache) as current:
+        def call():
+            response = ollama_chat(model=model, messages=messages, format=format, options=options, stream=False,
+                                   **kwargs)
+            _record_response(current, response)
+            return response.message.content
+
+        return (cache or default_cache()).cached(
+            model, messages, call, format=format, temperature=temperature, use_cache=use_cache
+        )
+
+
+async def achat(model, messages, format=None, options=None, use_cache=True, cache=None, client=None,
+                on_response=None, **kwargs):
+    """
+    async variant of chat on ollama.AsyncClient, the cache lookup itself is a local SQLite read
+
+    on_response(response) is called with the ollama response of every request that reached the model
+    """
+    from ollama import AsyncClient
+
+    llm_cache = cache or default_cache()
+    temperature = (options or {}).get('temperature')
+    key = cache_key(model, messages, format, temperature)
+    with span('llm.chat', model=model, cache_hit=use_cache) as current:
+        if use_cache:
+            value = llm_cache.get(key)
+            if value is not None:
+                return value
+        response = await (client or AsyncClient()).chat(model=model, messages=messages, format=format,
+                                                        options=options, stream=False, **kwargs)
+        _record_response(current, response)
+        if on_response is not None:
+            on_response(response)
+        value = response.message.content
+        if use_cache:
+            llm_cache.put(key, value)
+        return value
+
+
+def _record_response(current, response):
+    current.set(cache_hit=False, prompt_tokens=response.prompt_eval_count or 0,
+                completion_tokens=response.eval_count or 0,
+                prefill_seconds=(response.prompt_eval_duration or 0) / 1e9)
+
+
+def langchain_cache(cache=None):
+    """
+    adapter to pass as cache= to a LangChain model, the key is the prompt and the model's llm_string,
+    which already contains model name and temperature. cache=False on a model opts out.
+    """
+    from langchain_core.caches import BaseCache
+    from langchain_core.load import dumps, loads
+
+    llm_cache = cache or default_cache()
+
+    class LangChainLLMCache(BaseCache):
+        def lookup(self, prompt, llm_string):
+            with span('llm.cache_lookup') as current:
+                value = llm_cache.get(cache_key(llm_string, prompt))
+                current.set(cache_hit=value is not None)
+            return loads(value) if value is not None else None
+
+        def update(self, prompt, llm_string, return_val):
+            llm_cache.put(cache_key(llm_string, prompt), dumps(list(return_val)))
+
+        def clear(self, **kwargs):
+            llm_cache.clear()
+
+    return LangChainLLMCache()
@@ -1,6 +1,107 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
-app = FastAPI()
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+from integration_test_code.agent_api_generate import APIGenerator
+from integration_test_code.analyze_api import AnalyzeAPI
+from job_queue import JobQueue
+from llm_cache import default_cache
+from tracing import tracer
+
+PROJECT_DIR = os.getenv('GENERATION_PROJECT_DIR', 'spring-request')
+# generated tests can only be written below this directory
+OUTPUT_ROOT = os.getenv('GENERATION_OUTPUT_ROOT', 'generated_tests')
+MAX_CONCURRENCY = int(os.getenv('MAX_GENERATION_CONCURRENCY', 16))
+MAX_ANALYZE_WORKERS = os.cpu_count() or 1
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 100))
+
+
+class AnalyzeJobRequest(BaseModel):
+    dir_path: Optional[str] = None
+    workers: int = Field(1, ge=1, le=MAX_ANALYZE_WORKERS)
+
+
+class GenerateJobRequest(BaseModel):
+    # a single controller file and optionally one method of it, all endpoints of the project when omitted
+    file_path: Optional[str] = None
+    method: Optional[str] = None
+    output_dir: str = OUTPUT_ROOT
+    concurrency: int = Field(4, ge=1, le=MAX_CONCURRENCY)
+    timeout: float = Field(600.0, gt=0)
+
+
+def confine(path, root, name):
+    """
+    reject a request path outside root, symlinks included
+    """
+    real_root = os.path.realpath(root)
+    if os.path.commonpath([real_root, os.path.realpath(path)]) != real_root:
+        raise HTTPException(status_code=400, detail=f"{name} has to be inside {root}")
+
+
+async def run_analyze(job, report):
+    params = job.params
+    endpoints = await asyncio.to_thread(
+        AnalyzeAPI(params['dir_path'] or PROJECT_DIR).analyze, params['workers'])
+    await report('analyzed', endpoints=len(endpoints))
+    return [endpoint.to_dict() for endpoint in endpoints]
+
+
+async def run_generate(job, report):
+    params = job.params
+    generator = app.state.generator
+    # the generator lives as long as the app, files edited since the last job are parsed again in a thread and
+    # indexed on the loop, where the other jobs read the index
+    generator.symbol_index.apply(await asyncio.to_thread(generator.symbol_index.changes))
+    # a tree-sitter parser must not be shared between threads, so every job scans with its own analyzer
+    analyzer = AnalyzeAPI(generator.project_dir)
+    if params['file_path']:
+        endpoints = await asyncio.to_thread(analyzer.scan_file, params['file_path'])
+    else:
+        endpoints = await asyncio.to_thread(analyzer.analyze)
+    if params['method']:
+        endpoints = [endpoint for endpoint in endpoints if endpoint.method == params['method']]
+    await report('analyzed', endpoints=len(endpoints))
+
+    async def progress(result):
+        await report('endpoint', api_path=result.endpoint.api_path, http_method=result.endpoint.http_method,
+                     ok=result.ok, error=result.error, seconds=result.seconds)
+
+    results = await generator.generate_all(
+        endpoints, params['output_dir'], params['concurrency'], params['timeout'], progress=progress)
+    return [
+        {
+            'method': result.endpoint.method,
+            'http_method': result.endpoint.http_method,
+            'api_path': result.endpoint.api_path,
+            'output_path': result.output_path,
+            'ok': result.ok,
+            'error': result.error,
+            'seconds': result.seconds,
+        }
+        for result in results
+    ]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # the symbol index and compiled queries are built once here, not per request
+    app.state.generator = await asyncio.to_thread(APIGenerator, PROJECT_DIR)
+    app.state.jobs = JobQueue({'analyze': run_analyze, 'generate': run_generate},
+                              workers=JOB_WORKERS, max_size=JOB_QUEUE_SIZE)
+    await app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -11,3 +112,93 @@ async def root():
 @app.get("/hello/{name}")
 async def say_hello(name: str):
     return {"message": f"Hello {name}"}
+
+
+def submit_job(kind, params):
+    try:
+        job = app.state.jobs.submit(kind, params)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail="job queue is full, retry later")
+    return {"job_id": job.id, "status": job.status}
+
+
+def get_job(job_id):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job
+
+
+@app.post("/jobs/analyze", status_code=202)
+async def submit_analyze(request: AnalyzeJobRequest):
+    if request.dir_path:
+        confine(request.dir_path, PROJECT_DIR, 'dir_path')
+    return submit_job('analyze', request.model_dump())
+
+
+@app.post("/jobs/generate", status_code=202)
+async def submit_generate(request: GenerateJobRequest):
+    if request.file_path:
+        confine(request.file_path, PROJECT_DIR, 'file_path')
+    confine(request.output_dir, OUTPUT_ROOT, 'output_dir')
+    return submit_job('generate', request.model_dump())
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status == 'failed':
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"job {job_id} is {job.status}")
+    return {"job_id": job.id, "result": job.result}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    stage durations, bytes, tokens and cache hits in the Prometheus text format
+    """
+    jobs = app.state.jobs
+    lines = ["# TYPE pipeline_job_queue_depth gauge", f"pipeline_job_queue_depth {jobs.queue.qsize()}",
+             "# TYPE pipeline_jobs gauge"]
+    statuses = {}
+    for job in list(jobs.jobs.values()):
+        statuses[job.status] = statuses.get(job.status, 0) + 1
+    lines.extend(f'pipeline_jobs{{status="{status}"}} {count}' for status, count in sorted(statuses.items()))
+    cache_stats = default_cache().stats()
+    for name in ('hits', 'misses', 'evictions'):
+        lines += [f"# TYPE llm_cache_{name}_total counter", f"llm_cache_{name}_total {cache_stats[name]}"]
+    lines += ["# TYPE llm_cache_bytes gauge", f"llm_cache_bytes {cache_stats['bytes']}"]
+    generator = getattr(app.state, 'generator', None)
+    if generator is not None:
+        prefix_stats = generator.prefix_stats
+        for name in ('prompt_tokens', 'evaluated_tokens', 'reused_tokens'):
+            lines += [f"# TYPE llm_prefix_cache_{name}_total counter",
+                      f"llm_prefix_cache_{name}_total {getattr(prefix_stats, name)}"]
+        lines += ["# TYPE llm_prefix_cache_saved_seconds_total counter",
+                  f"llm_prefix_cache_saved_seconds_total {prefix_stats.saved_seconds}"]
+        router_stats = generator.router.stats()
+        lines.append("# TYPE llm_router_served_total counter")
+        for key, count in sorted(router_stats['served'].items()):
+            task, model = key.split(':', 1)
+            lines.append(f'llm_router_served_total{{task="{task}",model="{model}"}} {count}')
+        for name in ('escalations', 'failures', 'saved_seconds'):
+            lines += [f"# TYPE llm_router_{name}_total counter", f"llm_router_{name}_total {router_stats[name]}"]
+    return tracer.prometheus() + '\n'.join(lines) + '\n'
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = get_job(job_id)
+
+    async def stream():
+        async for event in app.state.jobs.follow(job):
+            yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
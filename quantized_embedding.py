@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from tracing import span
+
+__doc__ = """
+int8 quantized ONNX Runtime embedding backend for CPU-only indexing
+
+the model is exported to ONNX once with optimum, graph optimized and dynamically quantized to int8, and
+cached under EXPORT_DIR, later runs load the quantized graph directly. texts are sorted by token length and
+batched with similar lengths, so a batch is padded to its own longest text instead of the longest text of the
+input. the backend has the embed(texts) interface of the embedding server client, so it plugs into LlamaIndex
+through llama/embedding_backend.BackendEmbedding and into LangChain through
+lang_chain/embedding_backend.BackendEmbeddings, and the server can run it with --backend quantized.
+
+    python quantized_embedding.py evaluate --model BAAI/bge-large-en-v1.5
+
+compares retrieval on the stored eval set data/embedding_eval.json against the sentence-transformers model.
+"""
+
+EXPORT_DIR = os.getenv('QUANTIZED_EMBEDDING_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'quantized_embeddings'))
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+EVAL_SET_PATH = os.path.join(ROOT_DIR, 'data', 'embedding_eval.json')
+# optimum names its outputs <input stem>_<file_suffix>.onnx
+OPTIMIZED_FILE = 'model_optimized.onnx'
+QUANTIZED_FILE = 'model_optimized_quantized.onnx'
+
+
+def default_pooling(model_name):
+    """
+    pooling the sentence-transformers config of the model uses: CLS for BGE, last token for decoder models
+    such as OASIS, mean pooling otherwise
+    """
+    name = model_name.lower()
+    if 'bge-' in name:
+        return 'cls'
+    if 'oasis' in name or 'qwen' in name:
+        return 'last'
+    return 'mean'
+
+
+def length_buckets(lengths, batch_size, max_tokens=None):
+    """
+    indexes of the texts grouped into batches of similar token length, shortest first
+
+    a batch is closed at batch_size texts or when padding it to its longest text would exceed max_tokens
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # sorted by length, so the text added last is the longest of the batch
+        if batch and (len(batch) == batch_size or (max_tokens and lengths[i] * (len(batch) + 1) > max_tokens)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def export_quantized(model_name, export_dir=None):
+    """
+    export, optimize and int8 quantize model_name, returns the directory of the quantized model
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+    from transformers import AutoTokenizer
+
+    export_dir = export_dir or os.path.join(EXPORT_DIR, model_name.replace('/', '--'))
+    if os.path.exists(os.path.join(export_dir, QUANTIZED_FILE)):
+        return export_dir
+    onnx_dir = export_dir + '.onnx'
+    with span('embedding.export', model=model_name):
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(onnx_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(onnx_dir)
+
+        optimizer = ORTOptimizer.from_pretrained(onnx_dir)
+        optimizer.optimize(OptimizationConfig(optimization_level=2), save_dir=onnx_dir + '.optimized',
+                           file_suffix='optimized')
+
+        quantizer = ORTQuantizer.from_pretrained(onnx_dir + '.optimized', file_name=OPTIMIZED_FILE)
+        # dynamic quantization needs no calibration data, activations are quantized at run time
+        config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(config, save_dir=export_dir, file_suffix='quantized')
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(export_dir)
+    if not os.path.exists(os.path.join(export_dir, QUANTIZED_FILE)):
+        raise RuntimeError(f"quantization of {model_name} did not write {QUANTIZED_FILE} to {export_dir}")
+    return export_dir
+
+
+class QuantizedBackend:
+    name = 'quantized'
+
+    def __init__(self, model_name, device=None, export_dir=None, pooling=None, max_length=512, batch_size=32,
+                 max_batch_tokens=16384, threads=None):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.pooling = pooling or default_pooling(model_name)
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        model_dir = export_quantized(model_name, export_dir)
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # last token pooling reads the token at length - 1, decoder tokenizers such as Qwen's pad on the left
+        self.tokenizer.padding_side = 'right'
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=QUANTIZED_FILE, session_options=options, provider='CPUExecutionProvider')
+        self.dimension = self.model.config.hidden_size
+        self.padded_tokens = 0
+        self.tokens = 0
+
+    def encode(self, texts):
+        """
+        float32 array of normalized embeddings, in the order of texts
+        """
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+        lengths = [len(ids) for ids in encoded['input_ids']]
+        result = None
+        with span('embedding.encode', texts=len(texts), tokens=sum(lengths)) as current:
+            for batch in length_buckets(lengths, self.batch_size, self.max_batch_tokens):
+                features = self.tokenizer.pad(
+                    {key: [encoded[key][i] for i in batch] for key in encoded.keys()}, return_tensors='np')
+                output = self.model(**features).last_hidden_state
+                vectors = self.pool(np.asarray(output), features['attention_mask'])
+                if result is None:
+                    result = np.empty((len(texts), vectors.shape[1]), dtype='float32')
+                result[batch] = vectors
+                self.padded_tokens += features['attention_mask'].size
+            self.tokens += sum(lengths)
+            current.set(padded_tokens=self.padded_tokens)
+        return result if result is not None else np.empty((0, 0), dtype='float32')
+
+    def pool(self, hidden, mask):
+        if self.pooling == 'cls':
+            vectors = hidden[:, 0]
+        elif self.pooling == 'last':
+            # right padded, so the last real token is at length - 1
+            vectors = hidden[np.arange(len(hidden)), mask.sum(axis=1) - 1]
+        else:
+            weights = mask[..., None].astype(hidden.dtype)
+            vectors = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.clip(norms, 1e-12, None)).astype('float32')
+
+    def embed(self, texts):
+        return self.encode(texts).tolist()
+
+
+class SentenceTransformerReference:
+    """
+    the full precision model as the embedding server runs it, the reference of evaluate
+    """
+
+    def __init__(self, model_name):
+        from embedding_server import SentenceTransformerBackend
+
+        self.backend = SentenceTransformerBackend(model_name)
+
+    def embed(self, texts):
+        return self.backend.encode(list(texts)).tolist()
+
+
+def load_eval_set(path=EVAL_SET_PATH):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def evaluate(backend, eval_set=None, corpus_dir=None, query_instruction=''):
+    """
+    recall@k and MRR of backend on the eval set
+
+    the documents are the files the eval set lists, relative to its corpus_dir, or every Java file of the
+    corpus when it lists none. a relative corpus_dir of the eval set is relative to the repository root
+    """
+    eval_set = eval_set or load_eval_set()
+    corpus_dir = corpus_dir or os.path.join(ROOT_DIR, eval_set['corpus_dir'])
+    k = eval_set.get('k', 5)
+    if 'documents' in eval_set:
+        paths = [os.path.join(corpus_dir, name) for name in eval_set['documents']]
+    else:
+        paths = []
+        for root, dirs, files in os.walk(corpus_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            paths.extend(os.path.join(root, file) for file in sorted(files) if file.endswith('.java'))
+    documents = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            documents.append(f.read())
+    names = [os.path.relpath(path, corpus_dir) for path in paths]
+
+    start = time.perf_counter()
+    document_vectors = np.asarray(backend.embed(documents), dtype='float32')
+    embed_seconds = time.perf_counter() - start
+    query_vectors = np.asarray(backend.embed([query_instruction + item['query'] for item in eval_set['queries']]),
+                               dtype='float32')
+
+    recalls = []
+    reciprocal_ranks = []
+    rankings = []
+    for item, scores in zip(eval_set['queries'], query_vectors @ document_vectors.T):
+        ranking = [names[i] for i in np.argsort(-scores)]
+        rankings.append(ranking)
+        relevant = set(item['relevant'])
+        recalls.append(len(relevant & set(ranking[:k])) / len(relevant))
+        first = next((rank for rank, name in enumerate(ranking) if name in relevant), None)
+        reciprocal_ranks.append(1.0 / (first + 1) if first is not None else 0.0)
+    return {
+        'k': k,
+        'recall': float(np.mean(recalls)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'documents': len(documents),
+        'embed_seconds': embed_seconds,
+        'rankings': rankings,
+        'document_vectors': document_vectors,
+    }
+
+
+def compare(reference, candidate):
+    """
+    quality of the candidate against the reference: both metrics, top-k overlap and cosine of the vectors
+    """
+    k = reference['k']
+    overlap = np.mean([len(set(a[:k]) & set(b[:k])) / k
+                       for a, b in zip(reference['rankings'], candidate['rankings'])])
+    cosine = np.mean(np.sum(reference['document_vectors'] * candidate['document_vectors'], axis=1))
+    return {
+        f"reference_recall@{k}": reference['recall'],
+        f"quantized_recall@{k}": candidate['recall'],
+        'reference_mrr': reference['mrr'],
+        'quantized_mrr': candidate['mrr'],
+        f"top{k}_overlap": float(overlap),
+        'mean_cosine': float(cosine),
+        'reference_seconds': reference['embed_seconds'],
+        'quantized_seconds': candidate['embed_seconds'],
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="int8 quantized embedding backend")
+    arg_parser.add_argument('command', choices=['export', 'evaluate'])
+    arg_parser.add_argument('--model', default='BAAI/bge-large-en-v1.5')
+    arg_parser.add_argument('--eval-set', default=EVAL_SET_PATH)
+    arg_parser.add_argument('--corpus-dir', help="corpus of the eval set, its corpus_dir by default")
+    arg_parser.add_argument('--max-recall-drop', type=float, default=0.05,
+                            help="exit with an error when quantized recall is this much below the reference")
+    args = arg_parser.parse_args()
+
+    if args.command == 'export':
+        print(export_quantized(args.model))
+    else:
+        from llama.embedding_backend import query_instruction_for
+
+        instruction = query_instruction_for(args.model) or ''
+        eval_set = load_eval_set(args.eval_set)
+        reference_result = evaluate(SentenceTransformerReference(args.model), eval_set, args.corpus_dir, instruction)
+        quantized_result = evaluate(QuantizedBackend(args.model), eval_set, args.corpus_dir, instruction)
+        report = compare(reference_result, quantized_result)
+        for name, value in report.items():
+            print(f"{name:24} {value:.4f}")
+        recall_drop = reference_result['recall'] - quantized_result['recall']
+        if recall_drop > args.max_recall_drop:
+            raise SystemExit(f"quantized recall dropped by {recall_drop:.3f}")
@@ -0,0 +1,10 @@
+from text_generate import _terms
+
+
+def test_terms_split_camel_and_snake_case():
+    assert _terms("getUserPath user_request") == ['get', 'user', 'path', 'user', 'request']
+
+
+def test_terms_keep_acronyms_and_constants():
+    assert _terms("HTTPServer getHTTP USER_ID parseJSON2Xml") == [
+        'http', 'server', 'get', 'http', 'user', 'id', 'parse', 'json', 'xml']
@@ -1,36 +1,149 @@
+import heapq
+import math
+import re
+from itertools import count
+
 from langchain.chains.llm import LLMChain
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import CharacterTextSplitter
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 
+from llm_cache import langchain_cache
+
+# acronyms first, so HTTPServer gives http and server and USER_ID gives user and id
+WORD = re.compile(r'[A-Z]+(?=[A-Z][a-z]|\b|\d|_)|[A-Z]?[a-z]+|\d+')
+
+
+def _terms(text):
+    # split camelCase and snake_case identifiers into lower case words
+    return [word.lower() for word in WORD.findall(text) if len(word) > 1]
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
 
 class TestGenerator:
-    def __init__(self):
-        self.llm = ChatOpenAI(temperature=0.1)
+    def __init__(self, use_cache=True, embeddings=None, context_tokens=3000, chunk_size=1000,
+                 embedding_weight=1.0, embedding_batch_size=32):
+        self.llm = ChatOpenAI(temperature=0.1, cache=langchain_cache() if use_cache else False)
         self.prompt = self._create_prompt()
+        # optional LangChain embeddings, chunks are ranked lexically only without them
+        self.embeddings = embeddings
+        self.context_tokens = context_tokens
+        self.chunk_size = chunk_size
+        self.embedding_weight = embedding_weight
+        self.embedding_batch_size = embedding_batch_size
 
     def _create_prompt(self):
-        return PromptTemplate()
+        return PromptTemplate(
+            input_variables=["requirements", "template", "context"],
+            template="""
+            Based on the following information, please generate a unit test:
 
-    def load_context(self, file_path):
-        # 加载代码文件
-        loader = TextLoader(file_path)
-        documents = loader.load()
-
-        # 分割代码以确保在上下文窗口内
-        text_splitter = CharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
+            Requirements:
+            {requirements}
+
+            Template:
+            {template}
+
+            Code Context:
+            {context}
+
+            Please generate a complete unit test that follows the template structure and meets the requirements.
+            """
         )
-        texts = text_splitter.split_documents(documents)
-        return texts
+
+    def load_context(self, file_path):
+        """
+        yield the file in chunks of at most chunk_size characters, split on line boundaries without overlap,
+        so only one chunk of the file is in memory at a time
+        """
+        chunk = []
+        size = 0
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                while len(line) > self.chunk_size:
+                    if chunk:
+                        yield ''.join(chunk)
+                        chunk, size = [], 0
+                    yield line[:self.chunk_size]
+                    line = line[self.chunk_size:]
+                if size + len(line) > self.chunk_size and chunk:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
+                chunk.append(line)
+                size += len(line)
+        if chunk:
+            yield ''.join(chunk)
+
+    def lexical_score(self, query_terms, chunk):
+        """
+        BM25 style term saturation, normalised by the chunk size instead of a corpus average
+        """
+        if not query_terms:
+            return 0.0
+        counts = {}
+        for term in _terms(chunk):
+            counts[term] = counts.get(term, 0) + 1
+        length_norm = 1.2 * (0.25 + 0.75 * len(chunk) / self.chunk_size)
+        score = sum(counts[term] / (counts[term] + length_norm) for term in query_terms if term in counts)
+        return score / len(query_terms)
+
+    def iter_scored_chunks(self, requirements, context_files):
+        """
+        yield (score, file index, chunk index, file, chunk) for every chunk of every file, lazily
+        """
+        query_terms = set(_terms(requirements))
+        query_vector = self.embeddings.embed_query(requirements) if self.embeddings else None
+        batch = []
+        for file_index, file in enumerate(context_files):
+            for chunk_index, chunk in enumerate(self.load_context(file)):
+                batch.append((file_index, chunk_index, file, chunk))
+                if len(batch) == self.embedding_batch_size:
+                    yield from self.score_batch(batch, query_terms, query_vector)
+                    batch = []
+        yield from self.score_batch(batch, query_terms, query_vector)
+
+    def score_batch(self, batch, query_terms, query_vector):
+        vectors = self.embeddings.embed_documents([item[3] for item in batch]) if query_vector and batch else None
+        for position, (file_index, chunk_index, file, chunk) in enumerate(batch):
+            score = self.lexical_score(query_terms, chunk)
+            if vectors:
+                score += self.embedding_weight * _cosine(query_vector, vectors[position])
+            yield score, file_index, chunk_index, file, chunk
+
+    def build_context(self, requirements, context_files):
+        """
+        the most relevant chunks for the requirements that fit into context_tokens, in file order
+
+        a min-heap holds only the chunks that currently fit the budget, so memory stays bounded
+        however many files are given
+        """
+        budget = self.context_tokens * 4
+        heap = []
+        used = 0
+        tie_breaker = count()
+        for score, file_index, chunk_index, file, chunk in self.iter_scored_chunks(requirements, context_files):
+            heapq.heappush(heap, (score, next(tie_breaker), file_index, chunk_index, file, chunk))
+            used += len(chunk)
+            while used > budget:
+                used -= len(heapq.heappop(heap)[5])
+
+        kept = sorted(heap, key=lambda item: (item[2], item[3]))
+        parts = []
+        current_file = None
+        for score, _, file_index, chunk_index, file, chunk in kept:
+            if file != current_file:
+                parts.append(f"// {file}\n")
+                current_file = file
+            parts.append(chunk)
+        return ''.join(parts)
 
     def generate_test(self, requirements, template, context_files):
-        # 加载所有相关文件的上下文
-        context = ""
-        for file in context_files:
-            context += self.load_context(file)
+        # 按相关度加载上下文，限制在上下文窗口内
+        context = self.build_context(requirements, context_files)
 
         # 生成测试代码
         chain = LLMChain(llm=self.llm, prompt=self.prompt)
@@ -0,0 +1,207 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+
+__doc__ = """
+in-process spans and metrics for the stages of the generation pipeline
+
+    with span('analyze.parse', file=java_file) as current:
+        current.set(bytes=len(source))
+
+every finished span adds its duration and the attributes named in METRIC_ATTRIBUTES (bytes, tokens, cache
+hits) to per stage metrics, which main.py serves in the Prometheus text format on /metrics. other attributes,
+such as top_k or workers, only describe the span. while tracing is enabled the spans themselves are kept as
+well and the CLIs write them with --trace as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+spans nest through a context variable, so they work in threads and asyncio tasks.
+"""
+
+# upper bounds in seconds of the duration histogram
+BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0, 600.0)
+
+# span attributes summed into per stage counters, bools count, so cache_hit=True sums up to the number of hits
+METRIC_ATTRIBUTES = frozenset({
+    'bytes', 'code_bytes', 'tokens', 'prefix_tokens', 'prompt_tokens', 'completion_tokens', 'padded_tokens',
+    'prefill_seconds', 'cache_hit', 'cache_hits', 'memo_hit', 'files', 'classes', 'documents', 'nodes', 'texts',
+    'rows', 'endpoints', 'parameters', 'turns', 'requests', 'changed', 'errors', 'truncated', 'dropped',
+    'escalated', 'aborted',
+})
+
+# finished spans kept while tracing, the oldest are dropped first
+MAX_SPANS = 100_000
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'attributes', 'start', 'end', 'parent', 'thread_id')
+
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, value=1):
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    @property
+    def seconds(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class StageMetrics:
+    __slots__ = ('count', 'errors', 'seconds', 'buckets', 'totals')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.totals = {}
+
+
+class Tracer:
+    def __init__(self, max_spans=MAX_SPANS):
+        self.enabled = False
+        self.spans = deque(maxlen=max_spans)
+        self.stages = {}
+        self._lock = threading.Lock()
+        # perf_counter and wall clock at the same moment, to give trace events absolute timestamps
+        self._origin = (time.perf_counter(), time.time())
+
+    def start(self, name, attributes):
+        return Span(name, attributes, _current.get())
+
+    def finish(self, span, error=False):
+        span.end = time.perf_counter()
+        seconds = span.end - span.start
+        with self._lock:
+            stage = self.stages.get(span.name)
+            if stage is None:
+                stage = self.stages[span.name] = StageMetrics()
+            stage.count += 1
+            stage.errors += 1 if error else 0
+            stage.seconds += seconds
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stage.buckets[index] += 1
+                    break
+            for key, value in span.attributes.items():
+                if key in METRIC_ATTRIBUTES and isinstance(value, (int, float)):
+                    stage.totals[key] = stage.totals.get(key, 0) + value
+            if self.enabled:
+                self.spans.append(span)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.stages.clear()
+
+    def chrome_trace(self):
+        """
+        finished spans in the Chrome trace event format
+        """
+        perf_origin, wall_origin = self._origin
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for span in spans:
+            events.append({
+                'name': span.name,
+                'cat': span.name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': (wall_origin + span.start - perf_origin) * 1_000_000,
+                'dur': (span.end - span.start) * 1_000_000,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': {key: value if isinstance(value, (int, float, bool, str)) or value is None else str(value)
+                         for key, value in span.attributes.items()},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+        os.replace(tmp_path, path)
+        return len(self.spans)
+
+    def prometheus(self, prefix='pipeline'):
+        """
+        stage metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            stages = sorted(self.stages.items())
+            lines = [f"# TYPE {prefix}_stage_seconds histogram"]
+            for name, stage in stages:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stage.buckets):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage.count}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage.seconds:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage.count}')
+            lines.append(f"# TYPE {prefix}_stage_errors_total counter")
+            for name, stage in stages:
+                lines.append(f'{prefix}_stage_errors_total{{stage="{name}"}} {stage.errors}')
+            totals = sorted({key for _, stage in stages for key in stage.totals})
+            for key in totals:
+                lines.append(f"# TYPE {prefix}_{key}_total counter")
+                for name, stage in stages:
+                    if key in stage.totals:
+                        lines.append(f'{prefix}_{key}_total{{stage="{name}"}} {stage.totals[key]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+tracer = Tracer()
+
+
+class span:
+    """
+    time a stage, usable as a sync or async context manager
+    """
+    __slots__ = ('name', 'attributes', 'current', 'token')
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.current = tracer.start(self.name, self.attributes)
+        self.token = _current.set(self.current)
+        return self.current
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current.reset(self.token)
+        if exc_type is not None:
+            self.current.set(error=exc_type.__name__)
+        tracer.finish(self.current, error=exc_type is not None)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return self.__exit__(exc_type, exc, traceback)
+
+
+def enable_tracing():
+    tracer.enabled = True
+
+
+def export_trace(path):
+    """
+    write the spans recorded so far as a Chrome trace, returns the number of spans
+    """
+    count = tracer.export_chrome_trace(path)
+    print(f"wrote {count} spans to {path}")
+    return count